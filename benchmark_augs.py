@@ -0,0 +1,62 @@
+import argparse
+import time
+import random
+
+import numpy as np
+
+from data.audio_aug import (ChangeAudioSpeed,
+                            PitchShift,
+                            TorchAudioSoxChain,
+                            FastChangeAudioSpeed,
+                            FastPitchShift,
+                            FastSoxChain)
+
+parser = argparse.ArgumentParser(description='Throughput of speed / pitch augs, current vs sox-free ones')
+parser.add_argument('--manifest', default='', help='Optional manifest csv to take real audio from')
+parser.add_argument('--seconds', type=float, default=5, help='Duration of the synthetic audio')
+parser.add_argument('--sample-rate', default=16000, type=int, help='Sample rate')
+parser.add_argument('--runs', type=int, default=50, help='Samples per aug')
+parser.add_argument('--skip-sox', action='store_true', help='Do not run TorchAudioSoxChain')
+args = parser.parse_args()
+
+
+def get_waves():
+    if args.manifest:
+        import csv
+        from data.audio_loader import load_audio_norm
+        with open(args.manifest) as f:
+            paths = [row[0] for row in csv.reader(f)][:args.runs]
+        return [load_audio_norm(path)[0] for path in paths]
+    t = np.arange(int(args.seconds * args.sample_rate)) / args.sample_rate
+    wav = 0.5 * np.sin(2 * np.pi * 220 * t) + 0.05 * np.random.randn(len(t))
+    return [wav.astype(np.float32)] * args.runs
+
+
+def run(aug, waves):
+    # force the aug to fire
+    aug.prob = 1.0
+    aug(wav=waves[0], sr=args.sample_rate)
+    start = time.time()
+    for wav in waves:
+        aug(wav=wav, sr=args.sample_rate)
+    elapsed = time.time() - start
+    audio = sum(len(wav) for wav in waves) / args.sample_rate
+    return elapsed, audio
+
+
+augs = [('ChangeAudioSpeed (librosa)', ChangeAudioSpeed(limit=0.15, sr=args.sample_rate)),
+        ('FastChangeAudioSpeed', FastChangeAudioSpeed(limit=0.15, sr=args.sample_rate)),
+        ('PitchShift (librosa)', PitchShift(limit=2)),
+        ('FastPitchShift', FastPitchShift(limit=2))]
+if not args.skip_sox:
+    augs.append(('TorchAudioSoxChain', TorchAudioSoxChain(sr=args.sample_rate)))
+augs.append(('FastSoxChain', FastSoxChain(sr=args.sample_rate)))
+
+random.seed(0)
+waves = get_waves()
+print('{:<28} {:>12} {:>18}'.format('aug', 'ms / sample', 'x realtime'))
+for name, aug in augs:
+    elapsed, audio = run(aug, waves)
+    print('{:<28} {:>12.1f} {:>18.1f}'.format(name,
+                                             1000 * elapsed / len(waves),
+                                             audio / elapsed))
@@ -0,0 +1,59 @@
+import argparse
+import json
+import time
+
+import torch
+
+from model import DeepSpeech, inference_mode, prepare_inference
+
+parser = argparse.ArgumentParser(description='Inference real time factor per rnn_type, random weights')
+parser.add_argument('--rnn-types', default='gru,lstm,cnn',
+                    help='Comma separated rnn types to benchmark')
+parser.add_argument('--seconds', type=float, default=10, help='Duration of the fake input, 0.01 s stride')
+parser.add_argument('--batch-size', type=int, default=1, help='Utterances per forward')
+parser.add_argument('--dry-runs', type=int, default=1, help='Dry runs before measuring performance')
+parser.add_argument('--runs', type=int, default=5, help='Measured runs per rnn type')
+parser.add_argument('--labels-path', default='labels.json', help='Path to the labels of the model')
+parser.add_argument('--hidden-size', default=512, type=int, help='Hidden size of RNNs')
+parser.add_argument('--hidden-layers', default=5, type=int, help='Number of RNN layers')
+parser.add_argument('--unidirectional', action='store_true', help='Unidirectional RNNs + lookahead')
+parser.add_argument('--cuda', action='store_true', help='Benchmark on GPU instead of CPU')
+parser.add_argument('--cpu-threads', default=0, type=int,
+                    help='Intra-op threads for CPU inference, 0 - pytorch default')
+args = parser.parse_args()
+
+with open(args.labels_path) as label_file:
+    labels = str(''.join(json.load(label_file)))
+
+device = torch.device('cuda' if args.cuda else 'cpu')
+frames = int(args.seconds * 100)
+inputs = torch.randn(args.batch_size, 1, 161, frames).to(device)
+input_sizes = torch.IntTensor([frames] * args.batch_size)
+audio = args.seconds * args.batch_size
+
+print('{} threads'.format(torch.get_num_threads() if args.cpu_threads == 0 else args.cpu_threads))
+print('{:<56} {:>12} {:>10}'.format('rnn_type', 'ms / batch', 'RTF'))
+for rnn_type in args.rnn_types.split(','):
+    try:
+        model = DeepSpeech(rnn_type=rnn_type,
+                           labels=labels,
+                           rnn_hidden_size=args.hidden_size,
+                           nb_layers=args.hidden_layers,
+                           audio_conf=dict(sample_rate=16000, window_size=0.02),
+                           bidirectional=not args.unidirectional)
+        model = prepare_inference(model, device, args.cpu_threads)
+        with inference_mode():
+            for _ in range(args.dry_runs):
+                model(inputs, input_sizes)
+    except Exception as e:
+        # some types need a matching hidden size / cnn width
+        print('{:<56} failed: {}'.format(rnn_type, str(e)))
+        continue
+    with inference_mode():
+        start = time.time()
+        for _ in range(args.runs):
+            model(inputs, input_sizes)
+            if args.cuda:
+                torch.cuda.synchronize()
+        elapsed = (time.time() - start) / args.runs
+    print('{:<56} {:>12.1f} {:>10.3f}'.format(rnn_type, 1000 * elapsed, elapsed / audio))
@@ -9,7 +9,16 @@ from data.audio_loader import load_audio_norm
 from scipy.io.wavfile import read as wav_read
 from scipy.io.wavfile import write as wav_write
 from data.audio_loader import (float2int,
-                               int2float)
+                               int2float,
+                               wav_info)
+from data.tempo_pitch import (time_stretch,
+                              pitch_shift,
+                              tempo_pitch)
+from data.codec_sim import (simulate,
+                            get_pool)
+from data.ir_bank import (get_bank,
+                          MAX_TAPS,
+                          IR_KINDS)
 
 use_shm = True
 if use_shm:
@@ -53,6 +62,7 @@ class Shift:
                  max_duration=10, sr=16000):
         self.limit = int(limit)
         self.prob = prob
+        self.sr = sr
         self.max_duration = max_duration * sr
 
     def __call__(self, wav=None,
@@ -105,6 +115,60 @@ class PitchShift:
         return {'wav': wav,'sr': sr}
 
 
+class FastChangeAudioSpeed:
+    """ChangeAudioSpeed via in-memory WSOLA, see data/tempo_pitch.py"""
+    def __init__(self, limit=0.3, prob=0.5,
+                 max_duration=10, sr=16000):
+        self.limit = limit
+        self.prob = prob
+        self.max_duration = max_duration * sr
+
+    def __call__(self, wav=None,
+                 sr=None):
+        assert len(wav.shape)==1
+        if random.random() < self.prob:
+            alpha = 1.0 + self.limit * random.uniform(-1, 1)
+            _wav = time_stretch(wav.astype(np.float32), alpha)
+            if _wav.shape[0] < self.max_duration:
+                wav = _wav
+        return {'wav':wav,'sr':sr}
+
+
+class FastPitchShift:
+    """PitchShift via WSOLA + polyphase resampling, see data/tempo_pitch.py"""
+    def __init__(self, limit=5, prob=0.5):
+        self.limit = abs(limit)
+        self.prob = prob
+
+    def __call__(self, wav=None,
+                 sr=None):
+        assert len(wav.shape)==1
+        if random.random() < self.prob:
+            alpha = self.limit * random.uniform(-1, 1)
+            wav = pitch_shift(wav.astype(np.float32), n_steps=alpha)
+        return {'wav': wav,'sr': sr}
+
+
+class FastSoxChain:
+    """The same pitch + tempo chain as TorchAudioSoxChain,
+    w/o temp files and sox, see data/tempo_pitch.py
+    """
+    def __init__(self, speed_limit=0.3, prob=0.5,
+                 pitch_limit=4, max_duration=10, sr=16000):
+        self.speed_limit = speed_limit
+        self.pitch_limit = pitch_limit
+        self.prob = prob
+        self.max_duration = max_duration * sr
+
+    def __call__(self, wav=None, sr=None):
+        assert len(wav.shape) == 1
+        if random.random() < self.prob:
+            speed_alpha = 1.0 + self.speed_limit * random.uniform(-1, 1)
+            pitch_alpha = self.pitch_limit * random.uniform(-1, 1) * 100 # in cents
+            wav = tempo_pitch(wav.astype(np.float32), speed_alpha, pitch_alpha)
+        return {'wav': wav, 'sr': sr}
+
+
 class TorchAudioSoxChain:
     """Using a torchaudio proper C++ wrapper around soxi
     Also requires a file, but looks like it does not spawn processes
@@ -164,15 +228,22 @@ class TorchAudioSoxChain:
 class SoxPhoneCodec:
     """Using a torchaudio proper C++ wrapper around soxi
     Also requires a file, but looks like it does not spawn processes
+    engine:
+        sox - two temp files and two sox processes per sample
+        inprocess - see data/codec_sim.py, in-memory codecs / approximations
+        pool - same, but done by the shared codec pool, if it was started
     """
     def __init__(self, prob=0.5,
                  sox_codec_list=['gsm', 'amr-nb', 'ogg'],
                  sox_sr_list=[8, 16],
-                 quality_presets=list(range(1, 8))):
+                 quality_presets=list(range(1, 8)),
+                 engine='sox'):
+        assert engine in ['sox', 'inprocess', 'pool']
         self.prob = prob
         self.sox_codec_list = sox_codec_list
         self.sox_sr_list = sox_sr_list
         self.quality_presets = quality_presets
+        self.engine = engine
 
     def __call__(self, wav=None, sr=None):
 
@@ -187,6 +258,14 @@ class SoxPhoneCodec:
             if codec in ['amr-nb', 'gsm']:
                 sox_sr = 8
 
+            if self.engine != 'sox':
+                if wav.dtype == np.int16():
+                    wav = int2float(wav)
+                pool = get_pool() if self.engine == 'pool' else None
+                codec_fn = pool if pool is not None else simulate
+                _wav = codec_fn(wav, sr, codec, quality, sox_sr * 1000)
+                return {'wav': _wav, 'sr': sr}
+
             with NamedTemporaryFile(suffix="."+codec,
                                     dir=tempfile_dir) as codec_temp_file:
                 with NamedTemporaryFile(suffix=".wav",
@@ -247,10 +326,13 @@ class SoxPhoneCodec:
 
 class AddNoise:
     def __init__(self, limit=0.2, prob=0.5,
-                 noise_samples=[]):
+                 noise_samples=[],
+                 noise_bank=None):
         self.limit = abs(limit)
         self.prob = prob
         self.noise_samples = noise_samples
+        # pre-resampled noises, see data/noise_bank.py
+        self.noise_bank = noise_bank
 
 
     def __call__(self, wav=None,
@@ -261,9 +343,15 @@ class AddNoise:
         for i in range(0, 2):
             if random.random() < self.prob:
                 if i == 0:
-                    _noise = get_stacked_noise(self.noise_samples,
-                                               wav=wav,
-                                               sr=sr)
+                    if self.noise_bank is not None:
+                        # already a random slice of the right length
+                        _noise = self.noise_bank.random_slice(wav.shape[0])
+                        if _noise is None:
+                            return {'wav': wav, 'sr': sr}
+                    else:
+                        _noise = get_stacked_noise(self.noise_samples,
+                                                   wav=wav,
+                                                   sr=sr)
                     # noise still should be longer than audio
                     if _noise.shape[0] < wav.shape[0]:
                         return {'wav': wav, 'sr': sr}
@@ -282,46 +370,42 @@ class AddNoise:
 
 
 class AddEcho:
+    """The audio itself shifted, echoes are synthesized once into an IR bank
+    so that each sample is one FFT convolution
+
+    max_echos is the max number of taps per response, at most MAX_TAPS,
+    the summed tap gains are capped by the old single echo alpha anyway
+    """
     def __init__(self,
-                 max_echos=100,
+                 max_echos=MAX_TAPS,
                  sound_speed=0.33,
                  echo_arrivals_ms=list(range(0, 400, 10)),
-                 prob=0.5):
+                 prob=0.5,
+                 ir_kinds=IR_KINDS,
+                 ir_bank=None):
+        if not 1 <= max_echos <= MAX_TAPS:
+            raise ValueError('max_echos should be in [1, {}], got {}'.format(MAX_TAPS, max_echos))
         self.prob = prob
         self.max_echos = max_echos
         self.sound_speed = sound_speed
         self.echo_arrivals_ms = echo_arrivals_ms
+        self.ir_kinds = ir_kinds
+        self.ir_bank = ir_bank
 
-    @staticmethod
-    def dampen(ms):
-        if ms < 50:
-            return 0.8
-        if ms < 100:
-            return 0.5
-        return 0.3
+    def get_bank(self, sr):
+        if self.ir_bank is None or self.ir_bank.sr != sr:
+            taps_conf = {'max_taps': self.max_echos,
+                         'sound_speed': self.sound_speed,
+                         'echo_arrivals_ms': self.echo_arrivals_ms}
+            self.ir_bank = get_bank(sr, kinds=self.ir_kinds, taps_conf=taps_conf)
+        return self.ir_bank
 
     def __call__(self, wav=None,
                  sr=None):
         assert len(wav.shape) == 1
-        # apply noise 2 times with some probability
-        # audio and noise are both normalized
-        _wav = None
         if random.random() < self.prob:
-            for i in range(0, self.max_echos):
-                if random.random() < self.prob:
-                    # noise is audio itself shifted
-                    echo_arrival = random.choice(self.echo_arrivals_ms)
-                    shift_frames = int(sr * echo_arrival * self.sound_speed / 1000) + 1
-                    if shift_frames < (wav.shape[0] - 1):
-                        noise = np.zeros_like(wav)
-                        noise[shift_frames:] = wav[:-shift_frames]
-                        # vary dampening a bit
-                        alpha = self.dampen(echo_arrival) * random.uniform(0.5, 1)
-                        _wav = (wav + alpha * noise) / (1+alpha)
-        if _wav is not None:
-            return {'wav': _wav, 'sr': sr}
-        else:
-            return {'wav': wav, 'sr': sr}
+            return {'wav': self.get_bank(sr)(wav), 'sr': sr}
+        return {'wav': wav, 'sr': sr}
 
 
 def get_stacked_noise(noise_paths=None,
@@ -330,13 +414,22 @@ def get_stacked_noise(noise_paths=None,
     # randomly read noises to stack them
     # into one noise file longer than our audio
     # 10 files max
+    # only the samples still missing are read from memory mapped wavs,
+    # long noise files are not decoded as a whole
+    needed = wav.shape[0] + 1
     for _ in range(0,10):
         noise_path = random.sample(noise_paths,
                                    k=1)[0]
-        _noise, _sample_rate = load_audio_norm(noise_path)
+        _sample_rate, noise_len = wav_info(noise_path)
+        # a bit more for the resampling filter edges
+        length = int(np.ceil(needed * _sample_rate / sr)) + 16
+        offset = random.randint(0, max(noise_len - length, 0))
+        _noise, _sample_rate = load_audio_norm(noise_path, mmap=True,
+                                               offset=offset, length=length)
         assert len(_noise.shape)==1
         if _sample_rate!=sr:
-            _noise = librosa.resample(_noise, _sample_rate, sr)
+            _noise = librosa.resample(_noise, orig_sr=_sample_rate, target_sr=sr)
+        needed -= _noise.shape[0]
 
         if _>0:
             noise = np.concatenate((noise, _noise),
@@ -352,6 +445,21 @@ def get_stacked_noise(noise_paths=None,
     return noise
 
 
+def max_aug_duration(transforms, duration):
+    """Worst case duration after one of the transforms, i.e. for OneOf
+    Speed augs stretch by up to 1 / (1 - limit), Shift pads by up to limit samples
+    """
+    worst = duration
+    for t in transforms:
+        if isinstance(t, (ChangeAudioSpeed, FastChangeAudioSpeed)):
+            worst = np.maximum(worst, duration / (1 - t.limit))
+        elif isinstance(t, (TorchAudioSoxChain, FastSoxChain)):
+            worst = np.maximum(worst, duration / (1 - t.speed_limit))
+        elif isinstance(t, Shift):
+            worst = np.maximum(worst, duration + t.limit / t.sr)
+    return worst
+
+
 class Compose(object):
     def __init__(self, transforms, p=1.):
         self.transforms = [t for t in transforms if t is not None]
@@ -1,16 +1,58 @@
+import os
+from multiprocessing import Pool
+
 import numpy as np
 from scipy.io import wavfile
 
-def load_audio_norm(path, channel=-1):
+# samples per chunk when scanning memory mapped files
+PEAK_CHUNK = 1 << 20
+
+
+def read_wav(path, mmap=False):
+    if mmap:
+        try:
+            return wavfile.read(path, mmap=True)
+        except ValueError:
+            # 24 bit / non PCM wavs cannot be memory mapped
+            pass
+    return wavfile.read(path)
+
+
+def wav_info(path):
+    """(sample_rate, number of samples), only the header is read"""
+    sample_rate, sound = read_wav(path, mmap=True)
+    return sample_rate, len(sound)
+
+
+def wav_peak(path):
+    """abs max of the raw samples of the whole file, i.e. what load_audio_norm divides by"""
+    _, sound = read_wav(path, mmap=True)
+    peak = 0.
+    for start in range(0, len(sound), PEAK_CHUNK):
+        peak = max(peak, float(np.abs(sound[start:start + PEAK_CHUNK].astype(np.float64)).max()))
+    return peak
+
+
+def load_audio_norm(path, channel=-1,
+                    mmap=False, offset=0, length=None, peak=None):
+    """
+    mmap - memory map the file, i.e. only the samples in the window are read and decoded
+    offset, length - window in samples, the whole file by default
+    peak - precomputed wav_peak of the file, otherwise
+           the window is normalized by its own abs max
+    """
     # sound, sample_rate = torchaudio.load(path, normalization=lambda x: torch.abs(x).max())
     # sound = sound.numpy().T
 
     # use scipy, as all files are wavs for now
     # Fix https://github.com/pytorch/audio/issues/14 later
-    sample_rate, sound = wavfile.read(path)
+    sample_rate, sound = read_wav(path, mmap=mmap)
+    if offset or length is not None:
+        # crop before the float conversion
+        sound = sound[offset:None if length is None else offset + length]
 
     try:
-        abs_max = np.abs(sound).max()
+        abs_max = np.abs(sound).max() if peak is None else peak
         sound = sound.astype('float32')
         if abs_max > 0:
             sound *= 1/abs_max
@@ -28,6 +70,33 @@ def load_audio_norm(path, channel=-1):
     return sound, sample_rate
 
 
+def peaks_path(manifest_path):
+    return manifest_path + '.peaks.npy'
+
+
+def compute_peaks(manifest_path, num_workers=None):
+    """Peaks of all manifest wavs, saved next to the manifest, rows are aligned with it"""
+    import csv
+    with open(manifest_path, newline='') as f:
+        paths = [row[0] for row in csv.reader(f)]
+    with Pool(num_workers) as pool:
+        peaks = pool.map(wav_peak, paths, chunksize=64)
+    peaks = np.array(peaks, dtype=np.float32)
+    np.save(peaks_path(manifest_path), peaks)
+    return peaks
+
+
+def load_peaks(manifest_path, n_rows):
+    path = peaks_path(manifest_path)
+    if not os.path.exists(path):
+        return None
+    peaks = np.load(path, mmap_mode='r')
+    if len(peaks) < n_rows or os.path.getmtime(path) < os.path.getmtime(manifest_path):
+        print('Stale peaks in {}, ignoring them'.format(path))
+        return None
+    return np.asarray(peaks[:n_rows])
+
+
 def int2float(sound):
     _sound = np.copy(sound)
     abs_max = np.abs(_sound).max()
@@ -44,3 +113,14 @@ def float2int(sound):
     _sound = _sound.astype('int16')
     _sound = _sound.squeeze()
     return _sound
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Precomputes peak normalization stats of a manifest')
+    parser.add_argument('manifests', nargs='+', help='Manifest csv files')
+    parser.add_argument('--num-workers', type=int, default=None, help='Processes reading the wavs')
+    args = parser.parse_args()
+    for manifest in args.manifests:
+        peaks = compute_peaks(manifest, args.num_workers)
+        print('Saved {:,} peaks to {}'.format(len(peaks), peaks_path(manifest)))
@@ -45,7 +45,10 @@ def window_sumsquare(window, n_frames, hop_length=200, win_length=800,
     x = np.zeros(n, dtype=dtype)
 
     # Compute the squared window at the desired length
-    win_sq = get_window(window, win_length, fftbins=True)
+    if callable(window):
+        win_sq = window(win_length)
+    else:
+        win_sq = get_window(window, win_length, fftbins=True)
     win_sq = librosa_util.normalize(win_sq, norm=norm)**2
     win_sq = librosa_util.pad_center(win_sq, n_fft)
 
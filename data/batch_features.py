@@ -0,0 +1,194 @@
+import random
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from data.pytorch_stft import STFT
+from data.collate import Collator
+from data.ir_bank import batch_convolve
+
+
+# sigmas of the gaussian smoothing of the per frame mean
+# same as in SpectrogramParser.normalize_audio
+FRAME_SIGMAS = {'frame': 50,
+                'max_frame': 20}
+
+
+def pad_waves(waves):
+    """List of 1d waves -> zero padded (B, L) batch and lengths"""
+    waves = [torch.as_tensor(np.asarray(w, dtype=np.float32)) for w in waves]
+    lengths = torch.LongTensor([len(w) for w in waves])
+    batch = torch.nn.utils.rnn.pad_sequence(waves, batch_first=True)
+    return batch, lengths
+
+
+def reflect_pad_batch(waves, lengths, pad):
+    """Reflect-pads each utterance of a zero padded (B, L) batch on its own,
+    i.e. the same way librosa.stft / STFT pad a single utterance
+    Everything after the padded utterance is zeroed
+    """
+    batch_size, max_len = waves.shape
+    j = torch.arange(-pad, max_len + pad, device=waves.device).view(1, -1)
+    n = lengths.to(waves.device).view(-1, 1)
+    # numpy-style reflection, repeated for utterances shorter than pad
+    period = (2 * (n - 1)).clamp(min=1)
+    m = j % period
+    idx = torch.where(m < n, m, period - m).clamp(max=max_len - 1)
+    padded = torch.gather(waves, 1, idx.expand(batch_size, -1))
+    return padded * (j < n + pad).to(waves.dtype)
+
+
+_KERNELS = {}
+
+
+def gaussian_kernel(sigma, device, dtype):
+    """Same kernel as scipy.ndimage.gaussian_filter1d with truncate=4.0"""
+    key = (sigma, str(device), dtype)
+    if key not in _KERNELS:
+        radius = int(4.0 * sigma + 0.5)
+        x = torch.arange(-radius, radius + 1, dtype=torch.float64)
+        phi = torch.exp(-0.5 * (x / sigma) ** 2)
+        _KERNELS[key] = (phi / phi.sum()).to(device=device, dtype=dtype).view(1, 1, -1)
+    return _KERNELS[key]
+
+
+def smooth_frames(x, lengths, sigma):
+    """gaussian_filter1d(mode='reflect') of each (B, T) row over its own length
+    Values after the length are garbage
+    """
+    kernel = gaussian_kernel(sigma, x.device, x.dtype)
+    radius = kernel.size(2) // 2
+    j = torch.arange(-radius, x.size(1) + radius, device=x.device).view(1, -1)
+    n = lengths.to(x.device).view(-1, 1).clamp(min=1)
+    # d c b a | a b c d | d c b a, repeated for rows shorter than the radius
+    m = j % (2 * n)
+    idx = torch.where(m < n, m, 2 * n - 1 - m)
+    padded = torch.gather(x, 1, idx)
+    return F.conv1d(padded.unsqueeze(1), kernel).squeeze(1)
+
+
+def frame_mask(lengths, max_len):
+    """(B, T) float mask of valid frames"""
+    return (torch.arange(max_len, device=lengths.device).view(1, -1)
+            < lengths.view(-1, 1)).float()
+
+
+def normalize_batch(spect, lengths, normalize):
+    """Torch version of all the SpectrogramParser.normalize_audio modes
+    spect: (B, F, T) magnitudes, lengths: (B,) valid frames
+    Returns normalized log-magnitudes with zeroed padding
+    """
+    mask = frame_mask(lengths, spect.size(2))
+    mask3 = mask.unsqueeze(1)
+    n_freqs = spect.size(1)
+    frames = lengths.to(spect.dtype)
+    # single utterances and equal lengths need no masking
+    padded = bool((lengths < spect.size(2)).any())
+
+    # a new tensor, modified in place below
+    if normalize == 'max_frame':
+        spect = torch.log1p(spect * 1048576)
+    else:
+        spect = torch.log1p(spect)
+    if padded:
+        spect.mul_(mask3)
+
+    if normalize in ('mean', 'norm'):
+        mean = spect.sum(dim=(1, 2)) / (frames * n_freqs)
+        spect.sub_(mean.view(-1, 1, 1))
+        if normalize == 'norm':
+            std = spect.std(dim=1)
+            std = (std * mask).sum(dim=1) / frames
+            spect.div_(std.view(-1, 1, 1))
+    elif normalize in FRAME_SIGMAS:
+        smooth = smooth_frames(spect.mean(dim=1), lengths, FRAME_SIGMAS[normalize])
+        mean = (smooth * mask).sum(dim=1) / frames
+        spect.sub_(mean.view(-1, 1, 1))
+    elif normalize and normalize != 'none':
+        raise Exception("No such normalization")
+    if padded:
+        spect.mul_(mask3)
+    return spect
+
+
+class BatchFeatureCollate(object):
+    """Computes features for the whole batch in the collate function
+
+    Workers return augmented waves instead of spectrograms,
+    the batch is padded once and goes through one STFT / MelSTFT call.
+    The result is then passed to the usual collate function
+    """
+    def __init__(self, parser, collate_fn):
+        self.parser = parser
+        self.collate_fn = collate_fn
+        if parser.pytorch_mel or parser.pytorch_stft:
+            self.stft = parser.stft
+        else:
+            # same window as librosa.stft gets in the per sample pipeline
+            self.stft = STFT(parser.n_fft,
+                             parser.hop_length,
+                             parser.n_fft,
+                             window=parser.window)
+
+    def add_echo(self, waves):
+        # one FFT convolution for all the picked utterances
+        picked = (torch.rand(waves.size(0)) < self.parser.batch_echo_prob).nonzero().view(-1)
+        if len(picked) > 0:
+            irs = self.parser.ir_bank.random_batch(len(picked))
+            waves[picked] = batch_convolve(waves[picked], irs)
+        return waves
+
+    def features(self, waves, lengths):
+        parser = self.parser
+        if getattr(parser, 'batch_echo_prob', 0) > 0:
+            # tails end up in the padding, reflect_pad_batch ignores it
+            waves = self.add_echo(waves)
+        pad = int(parser.n_fft / 2)
+        padded = reflect_pad_batch(waves, lengths, pad)
+        frames = (lengths + 2 * pad - parser.n_fft) // parser.hop_length + 1
+
+        with torch.no_grad():
+            if parser.pytorch_mel:
+                spect = self.stft.mel_spectrogram(padded, center=False)
+            else:
+                spect, _ = self.stft.transform(padded, center=False)
+
+        if not parser.pytorch_mel and spect.size(1) < 161:
+            # same mirroring as in audio_to_stft
+            spect = torch.cat([spect[:, :81], spect[:, 1:81].flip(1)], dim=1)
+
+        if getattr(parser, 'batch_augs_spect', None) is not None:
+            # masked magnitudes, i.e. silence, and they count towards the normalization
+            # stats, like with the per utterance augs
+            spect = parser.batch_augs_spect(spect, frames)
+
+        # random per utterance augs, applied in place on views
+        for i, n in enumerate(frames.tolist()):
+            if parser.aug_prob_spect > 0:
+                parser.augs_spect(spect[i, :, :n])
+            if parser.aug_prob_8khz > 0:
+                if random.random() < parser.aug_prob_8khz:
+                    spect[i, 81:, :n] = 0
+        spect = spect[:, :161]
+
+        if parser.pytorch_mel:
+            spect = spect * frame_mask(frames, spect.size(2)).unsqueeze(1)
+        else:
+            spect = normalize_batch(spect, frames, parser.normalize)
+            if parser.augment and parser.normalize == 'max_frame':
+                shift = torch.rand(spect.size(0), 1, 1) - 0.5
+                spect = spect + shift * frame_mask(frames, spect.size(2)).unsqueeze(1)
+        return spect, frames
+
+    def __call__(self, batch):
+        # longer waves never have less frames, so sorting waves sorts spectrograms
+        batch = sorted(batch, key=lambda sample: len(sample[0]), reverse=True)
+        waves, lengths = pad_waves([sample[0] for sample in batch])
+        spect, frames = self.features(waves, lengths)
+        if isinstance(self.collate_fn, Collator):
+            # already padded, no need to copy once again
+            return self.collate_fn.collate_padded(batch, spect.unsqueeze(1), frames.tolist())
+        batch = [(spect[i, :, :n],) + tuple(sample[1:])
+                 for i, (n, sample) in enumerate(zip(frames.tolist(), batch))]
+        return self.collate_fn(batch)
@@ -8,6 +8,8 @@ import sentencepiece as sp
 from functools import reduce
 from string import punctuation, printable
 
+from data.token_store import file_digest
+
 russian_alphabet = 'АаБбВвГгДдЕеЁёЖжЗзИиЙйКкЛлМмНнОоПпРрСсТтУуФфХхЦцЧчШшЩщЪъЫыЬьЭэЮюЯя'
 punctuation = punctuation.replace('-', '')
 printable = printable.replace('\n', '') + russian_alphabet
@@ -64,6 +66,9 @@ class Labels:
             'subword_regularization': subword_regularization
         }
         print(kwargs)
+        self.config = {**kwargs,
+                       'double_supervision': double_supervision,
+                       'omit_spaces': omit_spaces}
         if use_phonemes:
             only_phonemes_kwargs = {**kwargs,
                                     'use_phonemes': True,
@@ -83,6 +88,14 @@ class Labels:
         elif s2s_decoder and double_supervision:
             raise NotImplementedError('This case should be impossible')
 
+    def fingerprint(self):
+        # everything that changes the parse output, incl. the sentencepiece models
+        return {'type': 'bpe',
+                **self.config,
+                'sp_model_digest': file_digest(self.config['sp_model']),
+                'sp_model_phoneme_digest': file_digest(self.config['sp_model_phoneme']),
+                'naive_split_list_digest': file_digest(self.config['naive_split_list'])}
+
     def parse(self, text):
         if type(self.labels) != list:
             # ordinary case pass through
@@ -0,0 +1,202 @@
+"""Phone codec simulation w/o temp files and sox processes
+
+- simulate - real GSM 06.10 / Vorbis round trips in memory via libsndfile
+  (if soundfile is installed), approximations for everything else
+- approximate - narrowband approximation: band-limit to the codec sample rate,
+  mu-law / A-law quantization, packet loss with naive concealment
+- CodecPool - long-lived codec processes, PCM goes over queues,
+  started once in the main process before the DataLoader workers fork
+"""
+import io
+import os
+import queue
+import multiprocessing
+
+import numpy as np
+from scipy.signal import butter, sosfilt
+from torch.utils.data import get_worker_info
+
+from data.tempo_pitch import approx_ratio, resample_ratio, fix_length
+
+try:
+    import soundfile as sf
+except ImportError:
+    sf = None
+
+
+# codecs libsndfile can encode / decode in memory
+SF_FORMATS = {'gsm': ('WAV', 'GSM610'),
+              'ogg': ('OGG', 'VORBIS')}
+NARROWBAND_CODECS = ['gsm', 'amr-nb']
+
+_HIGHPASS = {}
+
+
+def highpass(wav, sr, cutoff=300):
+    # telephone band starts at ~300 Hz
+    if sr not in _HIGHPASS:
+        _HIGHPASS[sr] = butter(2, cutoff / (sr / 2), btype='highpass', output='sos')
+    return sosfilt(_HIGHPASS[sr], wav).astype(np.float32)
+
+
+def companding(wav, law='mulaw', bits=8):
+    """mu-law / A-law companding + uniform quantization, like G.711"""
+    x = np.clip(wav, -1, 1)
+    if law == 'mulaw':
+        mu = 255.
+        y = np.sign(x) * np.log1p(mu * np.abs(x)) / np.log1p(mu)
+    else:
+        a = 87.6
+        ax = np.abs(x)
+        y = np.sign(x) * np.where(ax < 1 / a,
+                                  a * ax / (1 + np.log(a)),
+                                  (1 + np.log(np.maximum(a * ax, 1))) / (1 + np.log(a)))
+    levels = 2 ** (bits - 1)
+    y = np.round(y * levels) / levels
+    if law == 'mulaw':
+        x = np.sign(y) * np.expm1(np.abs(y) * np.log1p(mu)) / mu
+    else:
+        ay = np.abs(y)
+        x = np.sign(y) * np.where(ay < 1 / (1 + np.log(a)),
+                                  ay * (1 + np.log(a)) / a,
+                                  np.exp(ay * (1 + np.log(a)) - 1) / a)
+    return x.astype(np.float32)
+
+
+def packet_loss(wav, sr, loss_prob, frame_ms=20, rng=None):
+    """Drops 20 ms frames, lost frames repeat the last received one, attenuated
+    :param rng: a RandomState, np.random by default
+    """
+    frame = int(sr * frame_ms / 1000)
+    n_frames = len(wav) // frame
+    if n_frames < 2 or loss_prob <= 0:
+        return wav
+    frames = wav[:n_frames * frame].reshape(n_frames, frame)
+    lost = (rng or np.random).rand(n_frames) < loss_prob
+    lost[0] = False
+    last_received = np.maximum.accumulate(np.where(lost, 0, np.arange(n_frames)))
+    out = frames[last_received] * np.where(lost, 0.5, 1.0)[:, None].astype(np.float32)
+    return np.concatenate((out.reshape(-1), wav[n_frames * frame:]))
+
+
+def approximate(wav, sr, codec, quality, codec_sr, rng=None):
+    """quality - 1 (worst) .. 7 (best), like the sox -C presets used before"""
+    ratio = approx_ratio(codec_sr / sr)
+    x = resample_ratio(wav, ratio)
+    if codec in NARROWBAND_CODECS:
+        x = highpass(x, codec_sr)
+        # coarser quantization and more losses for lower presets
+        x = companding(x, law='alaw' if codec == 'amr-nb' else 'mulaw',
+                       bits=4 + (quality + 1) // 2)
+        x = packet_loss(x, codec_sr, loss_prob=0.01 * (8 - quality), rng=rng)
+    else:
+        x = companding(x, law='mulaw', bits=8 + quality // 2)
+    return fix_length(resample_ratio(x, 1 / ratio), len(wav))
+
+
+def encode_decode(wav, sr, codec, codec_sr):
+    """Real codec round trip in memory"""
+    fmt, subtype = SF_FORMATS[codec]
+    ratio = approx_ratio(codec_sr / sr)
+    x = resample_ratio(wav, ratio)
+    buf = io.BytesIO()
+    sf.write(buf, np.clip(x, -1, 1), ratio.numerator * sr // ratio.denominator,
+             format=fmt, subtype=subtype)
+    buf.seek(0)
+    x, _ = sf.read(buf, dtype='float32')
+    return fix_length(resample_ratio(x, 1 / ratio), len(wav))
+
+
+def simulate(wav, sr, codec, quality, codec_sr, rng=None):
+    if codec in NARROWBAND_CODECS:
+        codec_sr = 8000
+    if sf is not None and codec in SF_FORMATS:
+        try:
+            return encode_decode(wav, sr, codec, codec_sr)
+        except Exception as e:
+            # i.e. libsndfile built w/o vorbis
+            print('Codec {} failed: {}, using an approximation'.format(codec, str(e)))
+            SF_FORMATS.pop(codec, None)
+    return approximate(wav, sr, codec, quality, codec_sr, rng=rng)
+
+
+def _codec_worker(requests, responses):
+    while True:
+        item = requests.get()
+        if item is None:
+            break
+        slot, seq, seed, pcm, sr, codec, quality, codec_sr = item
+        wav = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768
+        # the seed comes from the client, i.e. from the per sample aug seed
+        out = simulate(wav, sr, codec, quality, codec_sr,
+                       rng=np.random.RandomState(seed))
+        out = (np.clip(out, -1, 1) * 32767).astype(np.int16)
+        responses[slot].put((seq, out.tobytes()))
+
+
+class CodecPool(object):
+    """A bounded pool of codec processes shared by all the DataLoader workers
+
+    Each client (main process + DataLoader workers) has its own response queue,
+    i.e. its slot, so it has to be started before the workers fork
+    """
+    TIMEOUT = 10
+
+    def __init__(self, num_clients, size=None):
+        if size is None:
+            # codec work is a fraction of the loading work
+            size = max(1, min(num_clients // 2, (os.cpu_count() or 2) // 2))
+        self.size = size
+        self.requests = multiprocessing.Queue(maxsize=4 * num_clients)
+        self.responses = [multiprocessing.Queue() for _ in range(num_clients)]
+        self.seq = 0
+        self.workers = [multiprocessing.Process(target=_codec_worker,
+                                                args=(self.requests, self.responses),
+                                                daemon=True)
+                        for _ in range(size)]
+        for worker in self.workers:
+            worker.start()
+        print('Started {} codec processes for {} clients'.format(size, num_clients))
+
+    def slot(self):
+        info = get_worker_info()
+        return 0 if info is None else (info.id + 1) % len(self.responses)
+
+    def __call__(self, wav, sr, codec, quality, codec_sr):
+        slot = self.slot()
+        # workers forked for the next epoch reuse the slots
+        self.seq += 1
+        seq = (os.getpid(), self.seq)
+        # drawn by the client, the same packets are lost whichever process runs the job
+        seed = np.random.randint(2 ** 31)
+        pcm = (np.clip(wav, -1, 1) * 32767).astype(np.int16).tobytes()
+        try:
+            self.requests.put((slot, seq, seed, pcm, sr, codec, quality, codec_sr),
+                              timeout=self.TIMEOUT)
+            while True:
+                response_seq, out = self.responses[slot].get(timeout=self.TIMEOUT)
+                # skip responses to requests that already timed out
+                if response_seq == seq:
+                    return np.frombuffer(out, dtype=np.int16).astype(np.float32) / 32768
+        except (queue.Full, queue.Empty):
+            print('Codec pool timed out, simulating in process')
+            return simulate(wav, sr, codec, quality, codec_sr,
+                            rng=np.random.RandomState(seed))
+
+    def close(self):
+        for _ in self.workers:
+            self.requests.put(None)
+
+
+_POOL = None
+
+
+def start_pool(num_clients, size=None):
+    global _POOL
+    if _POOL is None:
+        _POOL = CodecPool(num_clients, size=size)
+    return _POOL
+
+
+def get_pool():
+    return _POOL
@@ -0,0 +1,190 @@
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from torch.utils.data import get_worker_info
+
+
+def as_label_tensor(target):
+    if isinstance(target, torch.Tensor):
+        return target.int()
+    # int32 label arrays are wrapped w/o a copy
+    return torch.from_numpy(np.asarray(target, dtype=np.int32))
+
+
+def cat_targets(targets):
+    tensors = [as_label_tensor(target) for target in targets]
+    sizes = torch.IntTensor([len(t) for t in tensors])
+    return torch.cat(tensors), sizes
+
+
+class BufferPool(object):
+    """Size-bucketed staging buffers
+
+    Each bucket is a ring of `depth` flat buffers, so a batch stays valid
+    until `depth` more batches of the same bucket are collated.
+    Views of flat buffers are contiguous, which also keeps pin_memory a no-op
+    for pinned buffers.
+    """
+    def __init__(self, depth=2, pin=False, max_buckets=8):
+        self.depth = depth
+        self.pin = pin
+        self.max_buckets = max_buckets
+        self.buckets = OrderedDict()
+
+    @staticmethod
+    def bucket_size(numel):
+        # next power of 2
+        return 1 << max(numel - 1, 0).bit_length()
+
+    def get(self, shape):
+        numel = int(np.prod(shape))
+        size = self.bucket_size(numel)
+        if size not in self.buckets:
+            if len(self.buckets) >= self.max_buckets:
+                self.buckets.popitem(last=False)
+            self.buckets[size] = [[], 0]
+        self.buckets.move_to_end(size)
+        ring, i = self.buckets[size]
+        if len(ring) <= i:
+            ring.append(torch.empty(size, pin_memory=self.pin))
+        self.buckets[size][1] = (i + 1) % self.depth
+        return ring[i][:numel].view(*shape)
+
+    @property
+    def nbytes(self):
+        return sum(buf.numel() * buf.element_size()
+                   for ring, _ in self.buckets.values()
+                   for buf in ring)
+
+
+class CollateStats(object):
+    def __init__(self):
+        self.batches = 0
+        self.time = 0
+        self.bytes = 0
+
+    def update(self, elapsed, nbytes):
+        self.batches += 1
+        self.time += elapsed
+        self.bytes += nbytes
+
+    def report(self, pool=None):
+        return ('Collate pid {}: {:.1f} ms / batch, {:.1f} MB / batch, '
+                '{:.1f} MB staging buffers').format(os.getpid(),
+                                                     1000 * self.time / max(self.batches, 1),
+                                                     self.bytes / max(self.batches, 1) / 2 ** 20,
+                                                     (pool.nbytes if pool is not None else 0) / 2 ** 20)
+
+
+class Collator(object):
+    """One collate engine for all the batch formats
+
+    kind:
+        ctc     - (spect, target, path)
+        double  - (spect, (ctc_target, s2s_target), path)
+        denoise - ((spect, mask, wav), target, path)
+        phoneme - (spect, target, path, phoneme_target)
+
+    Staging buffers are reused only when collating in the main process,
+    tensors produced in workers are moved to shared memory by the DataLoader
+    and can not be safely overwritten by the worker afterwards
+    """
+    KINDS = ['ctc', 'double', 'denoise', 'phoneme']
+
+    def __init__(self, kind='ctc', reuse_buffers=True, pin_memory=True,
+                 depth=2, report_every=0):
+        if kind not in self.KINDS:
+            raise ValueError('Unknown collate kind {}'.format(kind))
+        self.kind = kind
+        self.reuse_buffers = reuse_buffers
+        self.pin_memory = pin_memory
+        self.depth = depth
+        self.report_every = report_every
+        self.stats = CollateStats()
+        self.pool = None
+        self._pool_pid = None
+
+    def get_pool(self):
+        if not self.reuse_buffers or get_worker_info() is not None:
+            return None
+        if self._pool_pid != os.getpid():
+            self._pool_pid = os.getpid()
+            self.pool = BufferPool(depth=self.depth,
+                                   pin=self.pin_memory and torch.cuda.is_available())
+        return self.pool
+
+    def empty(self, shape):
+        pool = self.get_pool()
+        if pool is not None:
+            return pool.get(shape)
+        return torch.empty(*shape)
+
+    def pad(self, tensors, lengths, max_len):
+        # single pass: copy each sample and zero only its padding tail
+        # no full size torch.zeros followed by a second write
+        out = self.empty((len(tensors), 1, tensors[0].size(0), max_len))
+        for x, (tensor, n) in enumerate(zip(tensors, lengths)):
+            out[x, 0, :, :n].copy_(tensor)
+            if n < max_len:
+                out[x, 0, :, n:].zero_()
+        return out
+
+    def __call__(self, batch):
+        t0 = time.time()
+        if self.kind == 'denoise':
+            specs = [sample[0][0] for sample in batch]
+        else:
+            specs = [sample[0] for sample in batch]
+        lengths = [spect.size(1) for spect in specs]
+        # stable, the same order as sorted(batch, reverse=True) before
+        order = sorted(range(len(batch)), key=lambda i: lengths[i], reverse=True)
+        batch = [batch[i] for i in order]
+        specs = [specs[i] for i in order]
+        lengths = [lengths[i] for i in order]
+
+        inputs = self.pad(specs, lengths, lengths[0])
+        masks = None
+        if self.kind == 'denoise':
+            masks = self.pad([sample[0][1] for sample in batch], lengths, lengths[0])
+        return self._finish(batch, inputs, lengths, t0, masks=masks)
+
+    def collate_padded(self, batch, inputs, lengths):
+        """For batches already sorted by length and padded, i.e. batch features"""
+        return self._finish(batch, inputs, lengths, time.time())
+
+    def _finish(self, batch, inputs, lengths, t0, masks=None):
+        input_percentages = torch.FloatTensor(lengths) / float(lengths[0])
+        filenames = [sample[2] for sample in batch]
+
+        if self.kind == 'double':
+            ctc_targets, ctc_target_sizes = cat_targets([sample[1][0] for sample in batch])
+            s2s_targets, s2s_target_sizes = cat_targets([sample[1][1] for sample in batch])
+            out = (inputs,
+                   ctc_targets, s2s_targets,
+                   filenames, input_percentages,
+                   ctc_target_sizes, s2s_target_sizes)
+            target_bytes = 4 * (len(ctc_targets) + len(s2s_targets))
+        else:
+            targets, target_sizes = cat_targets([sample[1] for sample in batch])
+            target_bytes = 4 * len(targets)
+            if self.kind == 'phoneme' and len(batch[0]) > 3:
+                phoneme_targets, phoneme_target_sizes = cat_targets([sample[3] for sample in batch])
+                target_bytes += 4 * len(phoneme_targets)
+                out = (inputs, targets, filenames, input_percentages, target_sizes,
+                       phoneme_targets, phoneme_target_sizes)
+            elif self.kind == 'denoise':
+                out = (inputs, targets, filenames, input_percentages, target_sizes, masks)
+            else:
+                # phoneme datasets w/o phonemes (validation) end up here as well
+                out = (inputs, targets, filenames, input_percentages, target_sizes)
+
+        nbytes = inputs.numel() * inputs.element_size() + target_bytes
+        if masks is not None:
+            nbytes += masks.numel() * masks.element_size()
+        self.stats.update(time.time() - t0, nbytes)
+        if self.report_every and self.stats.batches % self.report_every == 0:
+            print(self.stats.report(self.pool))
+        return out
@@ -1,5 +1,4 @@
-import random
-from tqdm import tqdm
+import numpy as np
 
 
 class Curriculum:
@@ -10,47 +9,63 @@ class Curriculum:
     ONLY_ONE_USE_BONUS = 0.1
 
     @classmethod
-    def sample(cls, items, getter, epoch,
-               min=1, domains=[]):
-        random.seed(epoch)
-        total = 0
+    def sample(cls, text_len, cer, times_used, epoch,
+               size=1, domains=None):
+        """
+        Samples `size` manifest rows, all the arrays are aligned with the manifest
+        domains - per row domain codes, if given, each domain gets an equal share
+        Deterministic for a given epoch
+        """
+        rng = np.random.RandomState(epoch)
+        probs = cls.get_probs(text_len, cer, times_used)
+        size = int(size)
 
-        if len(domains) == 0:
-            while total < min:
-                for item in items:
-                    text, cer, times_used = getter(item)
-                    prob = cls.get_prob(text, cer, times_used)
-                    if random.random() < prob:
-                        yield item
-                        total += 1
-        elif len(domains) > 0:
-            domain_items = {}
-            for domain in domains:
-                domain_items[domain] = []
-
-            print('Indexing items by domains')
-            for item in tqdm(items):
-                domain_items[item[3]].append(item)  # split items into domain buckets
-
-            while total < min:
-                domain = random.choice(domains)
-                # equal sampling for domains
-                item = random.choice(domain_items[domain])
-                text, cer, times_used = getter(item)
-                prob = cls.get_prob(text, cer, times_used)
-                if random.random() < prob:
-                    yield item
-                    total += 1
+        if domains is None or len(domains) == 0:
+            # independent draws, pass after pass, until there is enough
+            chosen = [np.zeros(0, dtype=np.int64)]
+            total = 0
+            while total < size:
+                rows = np.flatnonzero(rng.random_sample(len(probs)) < probs)
+                chosen.append(rows)
+                total += len(rows)
+            chosen = np.concatenate(chosen)
+            # ensure the exact sample size
+            return chosen[np.sort(rng.choice(len(chosen), size, replace=False))]
         else:
-            raise ValueError()
+            # equal sampling for domains
+            # then rows with replacement proportional to prob within a domain
+            codes = np.unique(domains)
+            shares = rng.multinomial(size, np.full(len(codes), 1 / len(codes)))
+            chosen = []
+            for code, share in zip(codes, shares):
+                rows = np.flatnonzero(domains == code)
+                p = probs[rows]
+                chosen.append(rng.choice(rows, share, replace=True, p=p / p.sum()))
+            chosen = np.concatenate(chosen)
+            return chosen[rng.permutation(len(chosen))]
+
+    @classmethod
+    def get_probs(cls, text_len, cer, times_used):
+        """Vectorized get_prob"""
+        cer = np.asarray(cer, dtype=np.float64)
+        length_bonus = cls.SHORT_PROB * 3 / (3 + np.asarray(text_len, dtype=np.float64))
+        cl_prob = np.where(cer < cls.CL_POINT,
+                           cer / cls.CL_POINT,
+                           np.where(cer < 0.51,
+                                    (0.51 - cer) / (0.51 - cls.CL_POINT),
+                                    0))
+        only_one_use_bonus = np.where(cer < 0.51, 0, cls.ONLY_ONE_USE_BONUS)
+        probs = cls.BASE_PROB + length_bonus + cls.CL_PROB * cl_prob + only_one_use_bonus
+        # try to use all items for training at least once
+        return np.where(np.asarray(times_used) == 0, 1.0, probs)
 
     @classmethod
-    def get_prob(cls, text, cer, times_used):
+    def get_prob(cls, text_len, cer, times_used):
         if times_used == 0:
             # try to use all items for training at least once
             return 1.0
         else:
-            length_bonus = cls.SHORT_PROB * 3 / (3 + len(text))
+            length_bonus = cls.SHORT_PROB * 3 / (3 + text_len)
             cl_prob = 0
             only_one_use_bonus = 0
             if cer < cls.CL_POINT:
@@ -66,13 +81,13 @@ class Curriculum:
 
 if __name__ == '__main__':
     cl = Curriculum()
-    print("%.6g" % cl.get_prob('', 0))
-    print("%.6g" % cl.get_prob('', 0.1))
-    print("%.6g" % cl.get_prob('', 1))
-    print("%.6g" % cl.get_prob('hi', 0))
-    print("%.6g" % cl.get_prob('hi', 1))
-    print("%.6g" % cl.get_prob('hello guys', 0.1))
-    print("%.6g" % cl.get_prob('hello guys', 0.2))
-    print("%.6g" % cl.get_prob('hello world this is the answer', 0))
-    print("%.6g" % cl.get_prob('hello world this is the answer', 0.1))
-    print("%.6g" % cl.get_prob('hello world this is the answer', 1))
+    print("%.6g" % cl.get_prob(0, 0, 1))
+    print("%.6g" % cl.get_prob(0, 0.1, 1))
+    print("%.6g" % cl.get_prob(0, 1, 1))
+    print("%.6g" % cl.get_prob(2, 0, 1))
+    print("%.6g" % cl.get_prob(2, 1, 1))
+    print("%.6g" % cl.get_prob(10, 0.1, 1))
+    print("%.6g" % cl.get_prob(10, 0.2, 1))
+    print("%.6g" % cl.get_prob(30, 0, 1))
+    print("%.6g" % cl.get_prob(30, 0.1, 1))
+    print("%.6g" % cl.get_prob(30, 1, 1))
@@ -0,0 +1,210 @@
+"""Binary curriculum persistence
+
+    <checkpoint>.cur             # small json pointer, one per save
+    .curriculum-<manifest id>/   # next to the pointers, one per manifest
+        snapshot-0000.npz        # full columns, aligned with manifest rows
+        snapshot-0000.log        # append-only records of the rows updated between saves
+        ...
+
+A save appends the rows updated since the previous save to the log
+of the current snapshot, a new snapshot is taken once the log
+outgrows the table. A pointer is a snapshot + the log length at the time of the save,
+so older checkpoints stay loadable.
+
+Usage (csv for humans):
+    python -m data.curriculum_store --curriculum models/checkpoint.cur --output checkpoint.csv
+"""
+import os
+import json
+import hashlib
+import argparse
+
+import numpy as np
+
+
+LOG_DTYPE = np.dtype([('row', '<i4'),
+                      ('cer', '<f4'),
+                      ('wer', '<f4'),
+                      ('times_used', '<i4'),
+                      ('text_len', '<i4')])
+
+
+def row_keys(manifest):
+    # path hashes in manifest row order
+    keys = np.empty_like(manifest.wavs.keys)
+    keys[manifest.wavs.key_rows] = manifest.wavs.keys
+    return keys
+
+
+def manifest_id(manifest):
+    return hashlib.blake2b(row_keys(manifest).tobytes(), digest_size=8).hexdigest()
+
+
+def snapshot_path(root, no):
+    return os.path.join(root, 'snapshot-{:04d}.npz'.format(no))
+
+
+def log_path(root, no):
+    return os.path.join(root, 'snapshot-{:04d}.log'.format(no))
+
+
+def pack_strings(strings):
+    data = [s.encode('utf8') for s in strings]
+    offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(d) for d in data], dtype=np.int64)
+    return np.frombuffer(b''.join(data), dtype=np.uint8), offsets
+
+
+def unpack_strings(buf, offsets):
+    buf = buf.tobytes()
+    return [buf[offsets[i]:offsets[i + 1]].decode('utf8')
+            for i in range(len(offsets) - 1)]
+
+
+class CurriculumStore(object):
+    def __init__(self, root, n_rows):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        # rows updated since the last save to this store
+        self.dirty = np.zeros(n_rows, dtype=np.bool_)
+        # never overwrite snapshots of previous runs
+        existing = [int(fn[len('snapshot-'):-len('.npz')])
+                    for fn in os.listdir(root)
+                    if fn.startswith('snapshot-') and fn.endswith('.npz')]
+        self.snapshot_no = max(existing, default=-1)
+        self.snapshot_taken = False
+        self.log_records = 0
+
+    def save(self, table, pointer_path):
+        n_dirty = int(self.dirty.sum())
+        # transcripts are only stored in snapshots
+        if (not self.snapshot_taken or table.keep_transcripts
+                or self.log_records + n_dirty > len(table)):
+            self.write_snapshot(table)
+        else:
+            self.append_log(table)
+        self.write_pointer(table, pointer_path)
+
+    def write_snapshot(self, table):
+        self.snapshot_no += 1
+        columns = {'keys': row_keys(table.manifest),
+                   'cer': table.cer,
+                   'wer': table.wer,
+                   'times_used': table.times_used,
+                   'text_len': table.text_len}
+        if table.transcripts:
+            rows = sorted(table.transcripts)
+            columns['transcript_rows'] = np.array(rows, dtype=np.int32)
+            columns['text'], columns['text_offsets'] = pack_strings(
+                [table.transcripts[row][0] for row in rows])
+            columns['transcript'], columns['transcript_offsets'] = pack_strings(
+                [table.transcripts[row][1] for row in rows])
+        path = snapshot_path(self.root, self.snapshot_no)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, **columns)
+        os.replace(path + '.tmp', path)
+        self.snapshot_taken = True
+        self.log_records = 0
+        self.dirty[:] = False
+
+    def append_log(self, table):
+        rows = np.flatnonzero(self.dirty)
+        rec = np.zeros(len(rows), dtype=LOG_DTYPE)
+        rec['row'] = rows
+        rec['cer'] = table.cer[rows]
+        rec['wer'] = table.wer[rows]
+        rec['times_used'] = table.times_used[rows]
+        rec['text_len'] = table.text_len[rows]
+        with open(log_path(self.root, self.snapshot_no), 'ab') as f:
+            f.write(rec.tobytes())
+        self.log_records += len(rows)
+        self.dirty[rows] = False
+
+    def write_pointer(self, table, pointer_path):
+        pointer = {'version': 1,
+                   'manifest': os.path.abspath(table.manifest.path),
+                   'store': os.path.relpath(self.root, os.path.dirname(os.path.abspath(pointer_path))),
+                   'snapshot': self.snapshot_no,
+                   'log_records': self.log_records,
+                   'rows': len(table)}
+        with open(pointer_path + '.tmp', 'w') as f:
+            json.dump(pointer, f)
+        os.replace(pointer_path + '.tmp', pointer_path)
+
+
+def store_for(table, pointer_path):
+    root = os.path.join(os.path.dirname(os.path.abspath(pointer_path)),
+                        '.curriculum-{}'.format(manifest_id(table.manifest)))
+    if root not in table.stores:
+        table.stores[root] = CurriculumStore(root, len(table))
+    return table.stores[root]
+
+
+def read_pointer(pointer_path):
+    with open(pointer_path) as f:
+        pointer = json.load(f)
+    root = os.path.join(os.path.dirname(os.path.abspath(pointer_path)), pointer['store'])
+    return pointer, root
+
+
+def load(table, pointer_path):
+    pointer, root = read_pointer(pointer_path)
+    snapshot = np.load(snapshot_path(root, pointer['snapshot']))
+    log = np.zeros(0, dtype=LOG_DTYPE)
+    if pointer['log_records'] > 0:
+        log = np.fromfile(log_path(root, pointer['snapshot']),
+                          dtype=LOG_DTYPE, count=pointer['log_records'])
+
+    # saved rows -> current manifest rows, -1 if not in the manifest
+    keys = snapshot['keys']
+    current = row_keys(table.manifest)
+    if len(keys) == len(current) and (keys == current).all():
+        rows = np.arange(len(keys))
+    else:
+        # i.e. a filtered or re-sorted manifest
+        sorted_keys = table.manifest.wavs.keys
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        if len(sorted_keys):
+            idx = np.searchsorted(sorted_keys, keys).clip(max=len(sorted_keys) - 1)
+            found = sorted_keys[idx] == keys
+            rows[found] = table.manifest.wavs.key_rows[idx[found]]
+    valid = rows >= 0
+
+    for column in ['cer', 'wer', 'times_used', 'text_len']:
+        getattr(table, column)[rows[valid]] = snapshot[column][valid]
+    if table.keep_transcripts and 'transcript_rows' in snapshot:
+        texts = unpack_strings(snapshot['text'], snapshot['text_offsets'])
+        transcripts = unpack_strings(snapshot['transcript'], snapshot['transcript_offsets'])
+        for row, text, transcript in zip(snapshot['transcript_rows'], texts, transcripts):
+            if rows[row] >= 0:
+                table.transcripts[int(rows[row])] = (text, transcript)
+
+    # later records override earlier ones, keep the last record of each row
+    log = log[::-1]
+    _, last = np.unique(log['row'], return_index=True)
+    log = log[last]
+    log_rows = rows[log['row']]
+    log = log[log_rows >= 0]
+    log_rows = log_rows[log_rows >= 0]
+    for column in ['cer', 'wer', 'times_used', 'text_len']:
+        getattr(table, column)[log_rows] = log[column]
+    print('Manifest_paths {}, curriculum paths {}, matched {}, log records {}'.format(len(table),
+                                                                                      len(keys),
+                                                                                      int(valid.sum()),
+                                                                                      len(log)))
+
+
+if __name__ == '__main__':
+    from data.manifest import ManifestTable, CurriculumTable
+
+    parser = argparse.ArgumentParser(description='Exports a binary curriculum to csv')
+    parser.add_argument('--curriculum', required=True, help='Path to a .cur file')
+    parser.add_argument('--manifest', default=None, help='Manifest csv, the one used in training by default')
+    parser.add_argument('--output', required=True, help='Output csv')
+    args = parser.parse_args()
+    pointer, _ = read_pointer(args.curriculum)
+    manifest = ManifestTable.from_csv(args.manifest or pointer['manifest'])
+    table = CurriculumTable(manifest)
+    table.load(args.curriculum)
+    table.write_csv(args.output)
+    print('Saved {:,} rows to {}'.format(len(table), args.output))
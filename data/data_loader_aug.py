@@ -1,27 +1,21 @@
-import csv
-import shutil
-import hashlib
-
 import os
-import gc
 import math
 import random
-import subprocess
-from pathlib import Path
+import warnings
 from glob import glob
-from collections import Counter
 from tempfile import NamedTemporaryFile
 
 import librosa
 import numpy as np
-import scipy.ndimage
 
 import tqdm
 import torch
 import torchaudio
 import scipy.signal
+from scipy.ndimage import maximum_filter1d
 
 from torch.utils.data import Dataset
+from torch.utils.data import get_worker_info
 from torch.distributed import get_rank
 from torch.utils.data import DataLoader
 from torch.utils.data.sampler import Sampler
@@ -32,24 +26,42 @@ from data.pytorch_stft import (MelSTFT,
                                STFT)
 from data.phoneme_labels import PhonemeLabels
 from data.curriculum import Curriculum
+from data.manifest import ManifestTable, CurriculumTable
+from data.token_store import TokenStore, make_fingerprint
+from data.noise_bank import NoiseBank
+from data.utils import probe_duration
+from data.ir_bank import get_bank
 from data.audio_aug import (ChangeAudioSpeed,
                             Shift,
                             AudioDistort,
                             PitchShift,
                             AddNoise,
                             Compose,
+                            max_aug_duration,
                             OneOf,
                             OneOrOther,
                             AddEcho,
                             SoxPhoneCodec,
-                            TorchAudioSoxChain)
+                            TorchAudioSoxChain,
+                            FastChangeAudioSpeed,
+                            FastPitchShift,
+                            FastSoxChain)
 from data.spectrogram_aug import (SCompose,
                                   SOneOf,
                                   SComposePipelines,
                                   SOneOrOther,
                                   FrequencyMask,
-                                  TimeMask)
-from data.audio_loader import load_audio_norm
+                                  TimeMask,
+                                  BatchSOneOf,
+                                  BatchFrequencyMask,
+                                  BatchTimeMask)
+from data.audio_loader import load_audio_norm, wav_info
+from data.tempo_pitch import approx_ratio, resample_ratio, fix_length
+from data.feature_store import FeatureStore
+from data.shards import ShardReader, ShardedIterableDataset, is_shard_dir
+from data.batch_features import (BatchFeatureCollate,
+                                 normalize_batch)
+from data.collate import Collator
 
 from scipy.io import wavfile
 
@@ -95,10 +107,12 @@ class NoiseInjection(object):
     def __init__(self,
                  path=None,
                  sample_rate=16000,
-                 noise_levels=(0, 0.5)):
+                 noise_levels=(0, 0.5),
+                 bank_path=None):
         """
         Adds noise to an input signal with specific SNR. Higher the noise level, the more noise added.
         Modified code from https://github.com/willfrey/audio/blob/master/torchaudio/transforms.py
+        :param bank_path: if set, noises are decoded once into a noise bank there instead of calling sox per sample
         """
         if not os.path.exists(path):
             print("Directory doesn't exist: {}".format(path))
@@ -106,19 +120,32 @@ class NoiseInjection(object):
         self.paths = path is not None and librosa.util.find_files(path)
         self.sample_rate = sample_rate
         self.noise_levels = noise_levels
+        self.noise_bank = None
+        if bank_path is not None:
+            self.noise_bank = NoiseBank.load_or_build(bank_path, self.paths, sample_rate)
 
     def inject_noise(self, data):
-        noise_path = np.random.choice(self.paths)
         noise_level = np.random.uniform(*self.noise_levels)
+        if self.noise_bank is not None:
+            noise_dst = self.noise_bank.random_slice(len(data))
+            if noise_dst is not None:
+                return self.add_noise(data, noise_dst, noise_level)
+        noise_path = np.random.choice(self.paths)
         return self.inject_noise_sample(data, noise_path, noise_level)
 
     def inject_noise_sample(self, data, noise_path, noise_level):
-        noise_len = get_audio_length(noise_path)
-        data_len = len(data) / self.sample_rate
-        noise_start = np.random.rand() * (noise_len - data_len)
-        noise_end = noise_start + data_len
-        noise_dst, sample_rate_ = audio_with_sox(noise_path, self.sample_rate, noise_start, noise_end)
-        assert sample_rate_ == self.sample_rate
+        # read only the window we need from a memory mapped wav, no sox
+        noise_sample_rate, noise_len = wav_info(noise_path)
+        ratio = approx_ratio(self.sample_rate / noise_sample_rate)
+        data_len = int(np.ceil(len(data) / ratio))
+        noise_start = np.random.randint(max(noise_len - data_len, 0) + 1)
+        noise_dst, _ = load_audio_norm(noise_path, mmap=True,
+                                       offset=noise_start, length=data_len)
+        noise_dst = fix_length(resample_ratio(noise_dst, ratio), len(data))
+        return self.add_noise(data, noise_dst, noise_level)
+
+    @staticmethod
+    def add_noise(data, noise_dst, noise_level):
         assert len(data) == len(noise_dst)
         noise_energy = np.sqrt(noise_dst.dot(noise_dst)) / noise_dst.size
         data_energy = np.sqrt(data.dot(data)) / data.size
@@ -134,12 +161,14 @@ TEMPOS = {
 
 
 class SpectrogramParser(AudioParser):
-    def __init__(self, audio_conf, cache_path, normalize=False, augment=False, channel=-1):
+    def __init__(self, audio_conf, cache_path, normalize=False, augment=False, channel=-1,
+                 feature_cache=None):
         """
         Parses audio file into spectrogram with optional normalization and various augmentations
         :param audio_conf: Dictionary containing the sample rate, window and the window length/stride in seconds
         :param normalize(default False):  Apply standard mean and deviation normalization to audio tensor
         :param augment(default False):  Apply random tempo and gain perturbations
+        :param feature_cache(default None): Cache un-augmented features in cache_path, float32 / float16 / uint8
         """
         super(SpectrogramParser, self).__init__()
         self.window_stride = audio_conf['window_stride']
@@ -151,6 +180,8 @@ class SpectrogramParser(AudioParser):
         self.channel = channel
         self.cache_path = cache_path
         self.noiseInjector = None
+        # path -> (wav, sample_rate), overridden by datasets w/o plain wav files
+        self.audio_loader = load_audio_norm
 
         self.pytorch_mel = audio_conf.get('pytorch_mel', False)
         self.pytorch_stft = audio_conf.get('pytorch_stft', False)
@@ -181,33 +212,35 @@ class SpectrogramParser(AudioParser):
             print(self.stft)
         """
         self.noiseInjector = NoiseInjection(audio_conf['noise_dir'], self.sample_rate,
-                                            audio_conf['noise_levels']) if audio_conf.get(
+                                            audio_conf['noise_levels'],
+                                            bank_path=os.path.join(cache_path, 'noise')) if audio_conf.get(
             'noise_dir') is not None else None
         """
         self.noise_prob = audio_conf.get('noise_prob')
 
-    def load_audio_cache(self, audio_path, tempo_id):
-        tempo_name, tempo = TEMPOS[tempo_id]
-        chan = 'avg' if self.channel == -1 else str(self.channel)
-        f_path = Path(audio_path)
-        f_hash = hashlib.sha1(f_path.read_bytes()).hexdigest()[:9]
-        cache_fn = Path(self.cache_path, f_hash[:2],
-                        f_path.name + '.' + f_hash[2:] + '.' + tempo_name + '.' + chan + '.npy')
-        cache_fn.parent.mkdir(parents=True, exist_ok=True)
-        old_cache_fn = audio_path + '-' + tempo_name + '-' + chan + '.npy'
-        if os.path.exists(old_cache_fn) and not os.path.exists(cache_fn):
-            print(f"Moving {old_cache_fn} to {cache_fn}")
-            shutil.move(old_cache_fn, cache_fn)
-        spec = None
-        if os.path.exists(cache_fn):
-            # print("Loading", cache_fn)
-            try:
-                spec = np.load(cache_fn).item()['spect']
-            except Exception as e:
-                import traceback
-                print("Can't load file", cache_fn, 'with exception:', str(e))
-                traceback.print_exc()
-        return cache_fn, spec
+        self.feature_store = None
+        if feature_cache:
+            fingerprint = {'sample_rate': self.sample_rate,
+                           'window_size': self.window_size,
+                           'window_stride': self.window_stride,
+                           'window': audio_conf['window'],
+                           'pytorch_mel': self.pytorch_mel,
+                           'pytorch_stft': self.pytorch_stft,
+                           'normalize': self.normalize,
+                           'channel': self.channel}
+            self.feature_store = FeatureStore(os.path.join(cache_path, 'features'),
+                                              fingerprint=fingerprint,
+                                              dtype=feature_cache)
+            print('Using feature store in {}, {}'.format(self.feature_store.root,
+                                                        feature_cache))
+
+    def features_are_deterministic(self):
+        # only features w/o any random augs can be cached
+        return (not getattr(self, 'denoise', False)
+                and getattr(self, 'augs', None) is None
+                and not getattr(self, 'aug_prob_spect', 0)
+                and not getattr(self, 'aug_prob_8khz', 0)
+                and self.noiseInjector is None)
 
     def parse_audio(self, audio_path):
         # only useful for old pipeline
@@ -216,29 +249,39 @@ class SpectrogramParser(AudioParser):
         else:
             tempo_id = 0
 
-        if False: # if USE_CACHE:
-            cache_fn, spect = self.load_audio_cache(audio_path, tempo_id)
-        else:
-            cache_fn, spect = None, None
-
-        # FIXME: If one needs to reset cache
-        # spect = None
+        spect = None
+        # the clean STFT of the denoise targets, reused if no noise gets added
+        noisy_D = None
+        batch_features = getattr(self, 'batch_features', False)
+        use_store = (self.feature_store is not None
+                     and not batch_features
+                     and self.features_are_deterministic())
+        if use_store:
+            spect = self.feature_store.get(audio_path)
+            if spect is not None:
+                with warnings.catch_warnings():
+                    # a read-only view into the store
+                    # it is never modified in place below
+                    warnings.simplefilter('ignore')
+                    spect = torch.from_numpy(spect)
 
         if spect is None:
             if self.augment or True: # always use the pipeline with augs
                 if self.aug_prob > -1: # always use the pipeline with augs
                     if self.denoise:
                         # apply the non-noise augs
-                        y, mask, sample_rate = self.make_denoise_tensors(audio_path,
-                                                                         TEMPOS[tempo_id][1])
+                        y, mask, noisy_D, sample_rate = self.make_denoise_tensors(audio_path,
+                                                                                  TEMPOS[tempo_id][1])
                     else:
                         y, sample_rate = load_randomly_augmented_audio(audio_path, self.sample_rate,
                                                                        channel=self.channel,
                                                                        tempo_range=TEMPOS[tempo_id][1],
-                                                                       transforms=self.augs)
+                                                                       transforms=self.augs,
+                                                                       loader=self.audio_loader)
                 else: # never use this for now
                     y, sample_rate = load_randomly_augmented_audio(audio_path, self.sample_rate,
-                                                                   channel=self.channel, tempo_range=TEMPOS[tempo_id][1])
+                                                                   channel=self.channel, tempo_range=TEMPOS[tempo_id][1],
+                                                                   loader=self.audio_loader)
             else: # never use this for now
                 # FIXME: We never call this
                 y, sample_rate = load_audio(audio_path, channel=self.channel)
@@ -246,8 +289,19 @@ class SpectrogramParser(AudioParser):
                 add_noise = np.random.binomial(1, self.noise_prob)
                 if add_noise:
                     y = self.noiseInjector.inject_noise(y)
+                    noisy_D = None
+
+            if batch_features:
+                # features are computed for the whole batch in the collate function
+                if not np.isfinite(y).all():
+                    y = np.clip(y, -1, 1)
+                    print('Audio buffer is not finite everywhere, clipping')
+                return torch.from_numpy(y.astype(np.float32))
 
-            spect = self.audio_to_stft(y, sample_rate)
+            if noisy_D is not None:
+                spect = self.postprocess_stft(np.abs(noisy_D), sample_rate)
+            else:
+                spect = self.audio_to_stft(y, sample_rate)
             # use sonopy stft
             # https://github.com/MycroftAI/sonopy/blob/master/sonopy.py#L61
             # spect = self.audio_to_stft_numpy(y, sample_rate)
@@ -257,19 +311,12 @@ class SpectrogramParser(AudioParser):
             if not self.pytorch_mel:
                 spect = self.normalize_audio(spect)
 
-            # FIXME: save to the file, but only if it's for
-            if False:  # if USE_CACHE:
-                if tempo_id == 0:
-                    try:
-                        np.save(str(cache_fn) + '.tmp.npy', {'spect': spect})
-                        os.rename(str(cache_fn) + '.tmp.npy', cache_fn)
-                        # print("Saved to", cache_fn)
-                    except KeyboardInterrupt:
-                        os.unlink(cache_fn)
+            if use_store:
+                self.feature_store.put(audio_path, spect)
 
         if not self.pytorch_mel:
             if self.augment and self.normalize == 'max_frame':
-                spect.add_(torch.rand(1) - 0.5)
+                spect = spect + (torch.rand(1) - 0.5)
 
         if self.denoise:
             # unify and check format
@@ -303,12 +350,16 @@ class SpectrogramParser(AudioParser):
                     )
                 spect = magnitudes.squeeze(0)
         else:
-            D = librosa.stft(y, n_fft=self.n_fft, hop_length=self.hop_length,
-                            win_length=self.n_fft, window=self.window)
             # spect, phase = librosa.magphase(D)
             # 3x faster
-            spect = np.abs(D)
+            spect = np.abs(self.complex_stft(y))
+        return self.postprocess_stft(spect, sample_rate)
+
+    def complex_stft(self, y):
+        return librosa.stft(y, n_fft=self.n_fft, hop_length=self.hop_length,
+                            win_length=self.n_fft, window=self.window)
 
+    def postprocess_stft(self, spect, sample_rate):
         if not self.pytorch_mel:
             shape = spect.shape
             if shape[0] < 161:
@@ -355,45 +406,11 @@ class SpectrogramParser(AudioParser):
         return spect[:161]
 
     def normalize_audio(self, spect):
-        # S = log(S+1)
-        if self.normalize == 'mean':
-            spect = np.log1p(spect)
-            spect = torch.FloatTensor(spect)
-            mean = spect.mean()
-            spect.add_(-mean)
-        elif self.normalize == 'norm':
-            spect = np.log1p(spect)
-            spect = torch.FloatTensor(spect)
-            mean = spect.mean()
-            spect.add_(-mean)
-            std = spect.std(dim=0, keepdim=True)
-            spect.div_(std.mean())
-        elif self.normalize == 'frame':
-            spect = np.log1p(spect)
-            spect = torch.FloatTensor(spect)
-            mean = spect.mean(dim=0, keepdim=True)
-            # std = spect.std(dim=0, keepdim=True)
-            mean = torch.FloatTensor(scipy.ndimage.filters.gaussian_filter1d(mean.numpy(), 50))
-            # std = torch.FloatTensor(scipy.ndimage.filters.gaussian_filter1d(std.numpy(), 20))
-            spect.add_(-mean.mean())
-            # spect.div_(std.mean() + 1e-8)
-        elif self.normalize == 'max_frame':
-            spect = np.log1p(spect * 1048576)
-            spect = torch.FloatTensor(spect)
-            mean = spect.mean(dim=0, keepdim=True)
-            # std = spect.std(dim=0, keepdim=True)
-            mean = torch.FloatTensor(scipy.ndimage.filters.gaussian_filter1d(mean.numpy(), 20))
-            max_mean = mean.mean()
-            # std = torch.FloatTensor(scipy.ndimage.filters.gaussian_filter1d(std.numpy(), 20))
-            spect.add_(-max_mean)
-            # print(spect.min(), spect.max(), spect.mean())
-            # spect.div_(std + 1e-8)
-        elif not self.normalize or self.normalize == 'none':
-            spect = np.log1p(spect)
-            spect = torch.FloatTensor(spect)
-        else:
-            raise Exception("No such normalization")
-        return spect
+        # S = log(S+1), a batch of one
+        spect = torch.as_tensor(spect, dtype=torch.float32).unsqueeze(0)
+        lengths = torch.LongTensor([spect.size(2)])
+        with torch.no_grad():
+            return normalize_batch(spect, lengths, self.normalize)[0]
 
     def parse_transcript(self, transcript_path):
         raise NotImplementedError
@@ -402,31 +419,14 @@ class SpectrogramParser(AudioParser):
         # noise was just
         # multiplied by alpha and added to signal w/o normalization
         # hence it can be just extracted by subtraction
-        only_noise = noisy_wav - wav
-        n = len(only_noise)
-
+        # the stft is linear, so the noise stft is a subtraction as well
         eps = 1e-4
 
-        if False:
-            # we do not use this padding in our standard pre-processing
-            only_noise = librosa.util.fix_length(only_noise,
-                                                 n + self.n_fft // 2)
-            noisy_wav = librosa.util.fix_length(noisy_wav,
-                                                n + self.n_fft // 2)
-
-        only_noise_D = librosa.stft(only_noise,
-                                    n_fft=self.n_fft,
-                                    hop_length=self.hop_length,
-                                    win_length=self.n_fft,
-                                    window=self.window)
-        noisy_D = librosa.stft(noisy_wav,
-                               n_fft=self.n_fft,
-                               hop_length=self.hop_length,
-                               win_length=self.n_fft,
-                               window=self.window)
-
-        noisy_mag, noisy_phase = librosa.magphase(noisy_D)
-        only_noise_mag, only_noise_phase = librosa.magphase(only_noise_D)
+        D = self.complex_stft(wav)
+        noisy_D = self.complex_stft(noisy_wav)
+
+        noisy_mag = np.abs(noisy_D)
+        only_noise_mag = np.abs(noisy_D - D)
 
         only_noise_freq_max = only_noise_mag / only_noise_mag.max(axis=1)[:, None]
         noisy_mag_freq_max = noisy_mag / noisy_mag.max(axis=1)[:, None]
@@ -440,7 +440,8 @@ class SpectrogramParser(AudioParser):
         y, sample_rate = load_randomly_augmented_audio(audio_path, self.sample_rate,
                                                        channel=self.channel,
                                                        tempo_range=tempo_id,
-                                                       transforms=self.augs)
+                                                       transforms=self.augs,
+                                                       loader=self.audio_loader)
 
         # https://pytorch.org/docs/stable/nn.html#conv1d
         stft_output_len = int((len(y) + 2 * self.n_fft//2 - (self.n_fft - 1) - 1) / self.hop_length + 1)
@@ -454,7 +455,7 @@ class SpectrogramParser(AudioParser):
             mask = np.zeros((161, stft_output_len))
             return y, mask, sample_rate
 
-        if np.all(y == y_noise):
+        if y_noise is y or np.array_equal(y, y_noise):
             # no noise applied
             mask = np.zeros((161, stft_output_len))
         else:
@@ -473,22 +474,32 @@ class SpectrogramParser(AudioParser):
                              normalize_spect=True):
 
         """Try predicting just an original STFT mask / values
+        Returns the noisy wav, the target, the clean STFT if it is also
+        the noisy one (no noise added) and the sample rate,
+        otherwise the noisy STFT is computed after noise injection in parse_audio
         """
         y, sample_rate = load_randomly_augmented_audio(audio_path, self.sample_rate,
                                                        channel=self.channel,
                                                        tempo_range=tempo_id,
-                                                       transforms=self.augs)
+                                                       transforms=self.augs,
+                                                       loader=self.audio_loader)
         if self.aug_prob > 0:
             y_noise = self.noise_augs(**{'wav': y,
                                          'sr': sample_rate})['wav']
         else:
             y_noise = y
 
-        or_spect = self.audio_to_stft(y, sample_rate)
+        if self.pytorch_mel or self.pytorch_stft:
+            or_spect = self.audio_to_stft(y, sample_rate)
+            noisy_D = None
+        else:
+            D = self.complex_stft(y)
+            noisy_D = D if y_noise is y else None
+            or_spect = self.postprocess_stft(np.abs(D), sample_rate)
         if normalize_spect:
             if True:
                 eps = 1e-4
-                or_spect = or_spect.numpy()
+                or_spect = np.asarray(or_spect, dtype=np.float32)
                 or_spect *= 1 / (eps + self.spect_rolling_max_normalize(or_spect))
                 or_spect = torch.FloatTensor(or_spect)
             elif False:
@@ -499,29 +510,30 @@ class SpectrogramParser(AudioParser):
                 or_spect_max, _ = or_spect.max(dim=1)
                 or_spect = or_spect / or_spect_max.unsqueeze(1)
 
-        return y_noise, or_spect, sample_rate
+        return y_noise, or_spect, noisy_D, sample_rate
 
     @staticmethod
     def spect_rolling_max_normalize(a,
                                     window=50,
                                     axis=1):
-        # calcuates a window sized rolling maximum over the first axis
-        # the result is duplicated
-        npad = ((0, 0), (window//2, window-window//2))
-        b = np.pad(a, pad_width=npad, mode='constant', constant_values=0)
-        shape = b.shape[:-1] + (b.shape[-1] - window, window)
-        # print(shape)
-        strides = b.strides + (b.strides[-1],)
-        rolling = np.lib.stride_tricks.as_strided(b,
-                                                shape=shape,
-                                                strides=strides)
-        rolling_max = np.max(rolling, axis=-1)
-        assert rolling_max.shape == a.shape
-        return rolling_max.max(axis=0)
+        # window sized rolling maximum over time of the per frame maximum
+        # the max over frequencies commutes with the rolling max, so it goes first
+        # zero padded, the same as the strided version for magnitudes
+        frame_max = a.max(axis=1 - axis)
+        return maximum_filter1d(frame_max, size=window,
+                                mode='constant', cval=0)
 
 TS_CACHE = {}
 TS_PHONEME_CACHE = {}
 
+
+def label_array(ts):
+    # compact int32 arrays, collate just concatenates them
+    if len(ts) > 0 and isinstance(ts[0], (list, tuple)):
+        # double supervision, ctc and s2s targets
+        return tuple(np.asarray(t, dtype=np.int32) for t in ts)
+    return np.asarray(ts, dtype=np.int32)
+
 class SpectrogramDataset(Dataset, SpectrogramParser):
     def __init__(self, audio_conf, manifest_filepath, cache_path, labels, normalize=False, augment=False,
                  max_items=None, curriculum_filepath=None,
@@ -530,7 +542,12 @@ class SpectrogramDataset(Dataset, SpectrogramParser):
                  naive_split=False,
                  phonemes_only=False,
                  omit_spaces=False,
-                 subword_regularization=False):
+                 subword_regularization=False,
+                 feature_cache=None,
+                 batch_features=False,
+                 keep_transcripts=True,
+                 token_cache=False,
+                 token_cache_workers=0):
         """
         Dataset that loads tensors via a csv containing file paths to audio files and transcripts separated by
         a comma. Each new line is a different sample. Example below:
@@ -546,21 +563,19 @@ class SpectrogramDataset(Dataset, SpectrogramParser):
         :param labels: String containing all the possible characters to map to
         :param normalize: Apply standard mean and deviation normalization to audio tensor
         :param augment(default False):  Apply random tempo and gain perturbations
-        :param curriculum_filepath: Path to curriculum csv as describe above
+        :param curriculum_filepath: Path to curriculum csv as describe above or to a binary .cur curriculum
+        :param feature_cache: Cache un-augmented features in cache_path, float32 / float16 / uint8
+        :param batch_features: Return augmented waves, features are computed per batch in the collate function
+        :param keep_transcripts: Keep reference / predicted transcripts in the curriculum to save them later
+        :param token_cache: Tokenize all transcripts once into a memory-mapped token store in cache_path
+        :param token_cache_workers: Processes used to build the token store
         """
-        with open(manifest_filepath, newline='') as f:
-            reader = csv.reader(f)
-            ids = [(self.parse_mf_row(row)) for row in reader]
-        if max_items:
-            ids = ids[:max_items]
-        # print("Found entries:", len(ids))
-        # self.all_ids = ids
-        self.curriculum = None
-        self.all_ids = ids
-        # reduce memory footprint when train from scratch due to pytorch 
-        # due to dataloader forking cow strategy
-        self.ids = []
-        self.size = len(self.all_ids)
+        # columnar manifest, i.e. a few numpy arrays instead of millions of tuples
+        # does not get copied into the forked dataloader workers
+        self.manifest = ManifestTable.from_csv(manifest_filepath, max_items=max_items)
+        # manifest rows selected by the curriculum, empty - all rows
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.size = len(self.manifest)
         self.use_bpe = audio_conf.get('use_bpe', False)
         self.phonemes_only = phonemes_only
         if self.use_bpe:
@@ -574,6 +589,8 @@ class SpectrogramDataset(Dataset, SpectrogramParser):
                                     subword_regularization=subword_regularization)
         else:
             self.labels = Labels(labels)
+        # sampled encodings have to be re-sampled each time
+        self.subword_regularization = subword_regularization
 
         self.aug_type = audio_conf.get('aug_type', 0)
 
@@ -582,6 +599,14 @@ class SpectrogramDataset(Dataset, SpectrogramParser):
         self.aug_prob_spect = audio_conf.get('aug_prob_spect')
         self.phoneme_count = audio_conf.get('phoneme_count', 0) # backward compatible
         self.denoise = audio_conf.get('denoise', False)
+        self.batch_features = batch_features
+        if self.batch_features and self.denoise:
+            print('Batch features are not supported for denoising')
+            raise ValueError('Batch features are not supported for denoising')
+        # echo / reverb convolved for the whole batch in the collate function
+        self.batch_echo_prob = audio_conf.get('batch_echo_prob', 0) if batch_features else 0
+        if self.batch_echo_prob > 0:
+            self.ir_bank = get_bank(audio_conf.get('sample_rate'))
 
         if self.phoneme_count > 0:
             self.phoneme_label_parser = PhonemeLabels(audio_conf.get('phoneme_map', None))
@@ -590,27 +615,37 @@ class SpectrogramDataset(Dataset, SpectrogramParser):
             print('Using sound augs!')
             self.aug_samples = glob(audio_conf.get('noise_dir'))
             print('Found {} noise samples for augmentations'.format(len(self.aug_samples)))
+            # all noises decoded and resampled once, shared by the workers
+            self.noise_bank = NoiseBank.load_or_build(os.path.join(cache_path, 'noise'),
+                                                      self.aug_samples,
+                                                      audio_conf.get('sample_rate'))
             # plain vanilla aug pipeline
             # the probability of harder augs is lower
             # aug probs will be normalized inside of OneOf
+            # in-memory WSOLA / polyphase speed and pitch augs instead of librosa / sox
+            if audio_conf.get('sox_free_augs', False):
+                speed_aug, pitch_aug, sox_chain = FastChangeAudioSpeed, FastPitchShift, FastSoxChain
+            else:
+                speed_aug, pitch_aug, sox_chain = ChangeAudioSpeed, PitchShift, TorchAudioSoxChain
             if self.aug_type == 0:
                 # all augs
                 aug_list = [
                     AddNoise(limit=0.2, # noise is scaled to 0.2 (0.05)
                              prob=self.aug_prob,
-                             noise_samples=self.aug_samples),
-                    ChangeAudioSpeed(limit=0.15,
-                                     prob=self.aug_prob,
-                                     sr=audio_conf.get('sample_rate'),
-                                     max_duration=MAX_DURATION_AUG),
+                             noise_samples=self.aug_samples,
+                             noise_bank=self.noise_bank),
+                    speed_aug(limit=0.15,
+                              prob=self.aug_prob,
+                              sr=audio_conf.get('sample_rate'),
+                              max_duration=MAX_DURATION_AUG),
                     AudioDistort(limit=0.05, # max distortion clipping 0.05
                                  prob=self.aug_prob), # /2
                     Shift(limit=audio_conf.get('sample_rate')*0.5,
                           prob=self.aug_prob,
                           sr=audio_conf.get('sample_rate'),
                           max_duration=MAX_DURATION_AUG), # shift 2 seconds max
-                    PitchShift(limit=2, #  half-steps
-                               prob=self.aug_prob)  # /2
+                    pitch_aug(limit=2, #  half-steps
+                              prob=self.aug_prob)  # /2
                 ]
             elif self.aug_type == 4:
                 # all augs
@@ -620,7 +655,8 @@ class SpectrogramDataset(Dataset, SpectrogramParser):
                 aug_list = [
                     AddNoise(limit=0.2,
                              prob=self.aug_prob,
-                             noise_samples=self.aug_samples),
+                             noise_samples=self.aug_samples,
+                             noise_bank=self.noise_bank),
                     AudioDistort(limit=0.05,
                                  prob=self.aug_prob),
                     Shift(limit=audio_conf.get('sample_rate')*0.5,
@@ -630,27 +666,32 @@ class SpectrogramDataset(Dataset, SpectrogramParser):
                     AddEcho(prob=self.aug_prob),
                     # librosa augs are of low quality
                     # so replaces PitchShift and ChangeAudioSpeed
-                    TorchAudioSoxChain(prob=self.aug_prob),
+                    sox_chain(prob=self.aug_prob),
                     # SoxPhoneCodec(prob=self.aug_prob/2)
                 ]
+                # sox per sample stalls the workers, so only w/o sox
+                if audio_conf.get('codec_aug') in ['inprocess', 'pool']:
+                    aug_list.append(SoxPhoneCodec(prob=self.aug_prob/2,
+                                                  engine=audio_conf.get('codec_aug')))
             elif self.aug_type == 5:
                 # preset for denoising
                 aug_list = [
                     AddNoise(limit=0.5, # noise is scaled to 0.2 (0.05)
                              prob=self.aug_prob,
-                             noise_samples=self.aug_samples),
-                    ChangeAudioSpeed(limit=0.15,
-                                     prob=self.aug_prob/2,
-                                     sr=audio_conf.get('sample_rate'),
-                                     max_duration=MAX_DURATION_AUG),
+                             noise_samples=self.aug_samples,
+                             noise_bank=self.noise_bank),
+                    speed_aug(limit=0.15,
+                              prob=self.aug_prob/2,
+                              sr=audio_conf.get('sample_rate'),
+                              max_duration=MAX_DURATION_AUG),
                     AudioDistort(limit=0.05, # max distortion clipping 0.05
                                  prob=self.aug_prob/2), # /2
                     Shift(limit=audio_conf.get('sample_rate')*0.5,
                           prob=self.aug_prob,
                           sr=audio_conf.get('sample_rate'),
                           max_duration=MAX_DURATION_AUG), # shift 2 seconds max
-                    PitchShift(limit=2, #  half-steps
-                               prob=self.aug_prob/2)  # /2
+                    pitch_aug(limit=2, #  half-steps
+                              prob=self.aug_prob/2)  # /2
                 ]
             if self.denoise:
                 self.noise_augs = OneOf(
@@ -666,6 +707,24 @@ class SpectrogramDataset(Dataset, SpectrogramParser):
         else:
             self.augs = None
 
+        self.batch_augs_spect = None
+        if self.aug_prob_spect > 0 and audio_conf.get('batch_spect_augs', False) and not batch_features:
+            # per sample features are normalized in the workers, masking has to happen before that
+            print('Batched spectrogram augs need batch features, using per sample spectrogram augs')
+        elif self.aug_prob_spect > 0 and audio_conf.get('batch_spect_augs', False):
+            # applied to the whole batch in the collate function, before normalization
+            print('Using batched spectrogram augs!')
+            self.batch_augs_spect = BatchSOneOf([
+                BatchFrequencyMask(bands=2,
+                                   prob=self.aug_prob_spect,
+                                   dropout_width=20),
+                BatchTimeMask(bands=2,
+                              prob=self.aug_prob_spect,
+                              dropout_length=50,
+                              max_dropout_ratio=.15)
+            ], prob=self.aug_prob)
+            self.aug_prob_spect = 0
+
         if self.aug_prob_spect > 0:
             print('Using spectrogram augs!')
             aug_list = [
@@ -683,91 +742,89 @@ class SpectrogramDataset(Dataset, SpectrogramParser):
         else:
             self.augs_spect = None
 
-        cr_column_set = set(['wav', 'text', 'transcript', 'offsets',
-                             'times_used', 'cer', 'wer',
-                             'duration'])
-
+        self.aug_seed = None
+        self.curriculum = CurriculumTable(self.manifest,
+                                          keep_transcripts=keep_transcripts)
+        if self.manifest.has_domains:
+            print('Using domains')
+        self.domains = self.manifest.domain_names
+        print('Domain list {}'.format(self.domains))
         if curriculum_filepath:
-            with open(curriculum_filepath, newline='') as f:
-                reader = csv.DictReader(f)
-                rows = [row for row in reader]
-                if len(rows[0]) == 3:
-                    duration_dict = {wav: dur
-                                     for wav, txt, dur in ids}
-                    domain_dict = {}
-                    self.domains = []
-                else:
-                    print('Creating diration_dict and domain_dict')
-                    duration_dict = {wav: dur
-                                     for wav, txt, dur, domain in ids}
-                    domain_dict = {wav: domain
-                                   for wav, txt, dur, domain in ids}
-                    self.domains = list(set(domain
-                                            for wav, txt, dur, domain in ids))
-                    print('Setting domains {}'.format(self.domains))
-                for r in rows:
-                    assert set(r.keys()) == cr_column_set or set(r.keys()) == cr_column_set.union({'domain'})
-                    r['cer'] = float(r['cer'])
-                    r['wer'] = float(r['wer'])
-                    r['times_used'] = int(r['times_used'])
-                    r['duration'] = float(r['duration']) if 'duration' in r else duration_dict[r['wav']]
-                    r['domain'] = str(r['domain']) if 'domain' in r else domain_dict[r['wav']]
-                self.curriculum = {row['wav']: row for row in rows}
-                print('Curriculum loaded from file {}'.format(curriculum_filepath))
-                # make sure that curriculum contains
-                # only items we have in the manifest
-                curr_paths = set(self.curriculum.keys())
-                manifest_paths = set([tup[0] for tup in ids])  # wavs, avoid ifs
-                print('Manifest_paths {}, curriculum paths {}'.format(
-                    len(manifest_paths),
-                    len(curr_paths)
-                ))
-                if curr_paths != manifest_paths:
-                    self.curriculum = {wav: self.curriculum[wav] for wav in manifest_paths}
-                    print('Filtering the curriculum file')
-                assert set(self.curriculum.keys()) == set([tup[0] for tup in ids])  # wavs, avoid ifs
-                del domain_dict, duration_dict
-                gc.collect()
-        else:
-            if len(ids[0]) == 3:
-                self.curriculum = {wav: {'wav': wav,
-                                         'text': '',
-                                         'transcript': '',
-                                         'offsets': None,
-                                         'times_used': 0,
-                                         'duration': dur,
-                                         'cer': 0.999,
-                                         'wer': 0.999} for wav, txt, dur in tq(ids, desc='Loading')}
-                self.domains = []
-            elif len(ids[0]) == 4:
-                print('Using domains')
-                self.curriculum = {wav: {'wav': wav,
-                                         'text': '',
-                                         'transcript': '',
-                                         'offsets': None,
-                                         'times_used': 0,
-                                         'domain': domain,
-                                         'duration': dur,
-                                         'cer': 0.999,
-                                         'wer': 0.999} for wav, txt, dur, domain in tq(ids, desc='Loading initial CR')}
-                self.domains = list(set(domain
-                                        for wav, txt, dur, domain
-                                        in tq(ids, desc='Loading domains')
-                                        ))
-                print('Domain list {}'.format(self.domains))
-            else:
-                raise ValueError()
-        del ids
-        gc.collect()
-        super(SpectrogramDataset, self).__init__(audio_conf, cache_path, normalize, augment)
+            self.curriculum.load(curriculum_filepath)
+            print('Curriculum loaded from file {}'.format(curriculum_filepath))
+
+        self.token_store = None
+        if token_cache and not self.subword_regularization:
+            transcript_paths = [self.manifest.txts[i] for i in range(len(self.manifest))]
+            if self.phonemes_only:
+                transcript_paths = [self.get_phoneme_path(path) for path in transcript_paths]
+            self.token_store = TokenStore.load_or_build(os.path.join(cache_path, 'tokens'),
+                                                        make_fingerprint(self.labels.fingerprint()),
+                                                        transcript_paths,
+                                                        self.tokenize_transcript,
+                                                        num_workers=token_cache_workers)
+        super(SpectrogramDataset, self).__init__(audio_conf, cache_path, normalize, augment,
+                                                 feature_cache=feature_cache)
+        if self.manifest.peaks is not None:
+            # normalize by the precomputed peaks w/o scanning the whole file first
+            self.audio_loader = self.load_manifest_audio
+
+    def load_manifest_audio(self, path, channel=-1):
+        return load_audio_norm(path, channel, mmap=True, peak=self.manifest.peak(path))
+
+    def set_aug_seed(self, seed):
+        """Seeds the augs of each sample by its position in the epoch,
+        i.e. the same augs whichever worker gets the sample, also after resuming
+        """
+        self.aug_seed = seed
+
+    def seed_sample(self, index):
+        seed = (self.aug_seed * 1000003 + index) % 2 ** 32
+        random.seed(seed)
+        np.random.seed(seed)
+        # CPU only, the augs never touch CUDA
+        torch.default_generator.manual_seed(seed)
 
     def __getitem__(self, index):
+        if self.aug_seed is None:
+            return self.load_item(index)
+        if get_worker_info() is not None:
+            # the worker owns its RNGs
+            self.seed_sample(index)
+            return self.load_item(index)
+        # in the training process (no workers, shard streams),
+        # the model RNGs and the restored rng_state are left alone
+        py_state, np_state = random.getstate(), np.random.get_state()
+        try:
+            with torch.random.fork_rng(devices=[]):
+                self.seed_sample(index)
+                return self.load_item(index)
+        finally:
+            random.setstate(py_state)
+            np.random.set_state(np_state)
+
+    def load_item(self, index):
         if len(self.ids) == 0:
             # not using CR
             # hence no set_curriculum_epoch was incurred
-            sample = self.all_ids[index]
-        else:
-            sample = self.ids[index]
+            return self.get_row(index)
+        return self.get_row(self.ids[index])
+
+    def max_aug_duration(self, durations):
+        """Upper bound of the durations after the wav augs"""
+        if self.augs is None:
+            return durations
+        return max_aug_duration(self.augs.transforms, durations)
+
+    def get_row(self, row):
+        return self.get_sample(self.manifest.row(int(row)))
+
+    def selected_rows(self):
+        if len(self.ids) == 0:
+            return np.arange(len(self.manifest))
+        return self.ids
+
+    def get_sample(self, sample):
         audio_path, transcript_path, dur = sample[0], sample[1], sample[2]
 
         spect = self.parse_audio(audio_path)
@@ -785,24 +842,17 @@ class SpectrogramDataset(Dataset, SpectrogramParser):
             assert len(spect) == 3
         return spect, reference, audio_path
 
-    def get_curriculum_info(self, item):
-        if len(item) == 3:
-            audio_path, transcript_path, _dur = item
-        elif len(item) == 4:
-            audio_path, transcript_path, _dur, domain = item
-        else:
-            raise ValueError()
+    def get_curriculum_info(self, row):
+        return self.curriculum.get(row)
 
-        if audio_path not in self.curriculum:
-            return self.get_reference_transcript(transcript_path), 0.999, 0
-        return (self.curriculum[audio_path]['text'],
-                self.curriculum[audio_path]['cer'],
-                self.curriculum[audio_path]['times_used'])
+    def get_times_used(self, audio_path):
+        return int(self.curriculum.times_used[self.manifest.find(audio_path)])
 
     def set_curriculum_epoch(self, epoch,
                              sample=False,
                              sample_size=0.5,
                              cl_point=0.10):
+        all_rows = np.arange(len(self.manifest))
         if sample:
             full_epoch = sample_size * epoch
 
@@ -816,26 +866,20 @@ class SpectrogramDataset(Dataset, SpectrogramParser):
             print('Set CL Point to be {}, full epochs elapsed {}'.format(Curriculum.CL_POINT,
                                                                          full_epoch))
 
-            print('Getting dataset sample, size {}'.format(int(len(self.all_ids) * sample_size)))
-            self.ids = list(
-                Curriculum.sample(self.all_ids,
-                                  self.get_curriculum_info,
-                                  epoch=epoch,
-                                  min=len(self.all_ids) * sample_size,
-                                  domains=self.domains)
-            )
-            # ensure the exact sample size
-            if len(self.ids) > (int(len(self.all_ids) * sample_size)+100):
-                print('Subsampling the chosen curriculum')
-                self.ids = random.sample(self.ids,
-                                         k=int(len(self.all_ids) * sample_size))
+            print('Getting dataset sample, size {}'.format(int(len(all_rows) * sample_size)))
+            self.ids = Curriculum.sample(self.curriculum.text_len,
+                                         self.curriculum.cer,
+                                         self.curriculum.times_used,
+                                         epoch=epoch,
+                                         size=int(len(all_rows) * sample_size),
+                                         domains=self.manifest.domains if len(self.domains) > 0 else None)
             if len(self.domains) > 0:
                 print('check equiprobable sampling')
-                domains = [domain for wav, txt, dur, domain in self.ids]
-                domain_cnt = Counter(domains)
-                print(domain_cnt)
+                domain_cnt = np.bincount(self.manifest.domains[self.ids],
+                                         minlength=len(self.domains))
+                print(dict(zip(self.domains, domain_cnt.tolist())))
         else:
-            self.ids = self.all_ids.copy()
+            self.ids = all_rows
         np.random.seed(epoch)
         np.random.shuffle(self.ids)
         self.size = len(self.ids)
@@ -845,51 +889,42 @@ class SpectrogramDataset(Dataset, SpectrogramParser):
                           reference, transcript,
                           offsets, cer, wer,
                           times_used=0):
-        self.curriculum[audio_path] = {
-            'wav': audio_path,
-            'text': reference,
-            'transcript': transcript,
-            'offsets': offsets,
-            'times_used': times_used,
-            'domain': self.curriculum[audio_path].get('domain', 'default_domain'),
-            'duration': self.curriculum[audio_path]['duration'],
-            'cer': cer,
-            'wer': wer
-        }
+        # offsets are not used and are not stored
+        self.curriculum.update(self.manifest.find(audio_path),
+                               reference, transcript,
+                               cer, wer, times_used)
 
     def save_curriculum(self, fn):
-        zero_times_used = 0
-        nonzero_time_used = 0
         temp_file = 'current_curriculum_state.txt'
-        with open(fn, 'w') as f:
-            fields = ['wav', 'text', 'transcript', 'offsets',
-                      'times_used', 'cer', 'wer',
-                      'duration', 'domain']
-            writer = csv.DictWriter(f, fields)
-            writer.writeheader()
-            for cl in self.curriculum.values():
-                if 'domain' not in cl:
-                    cl['domain'] = 'default'
-                writer.writerow(cl)
-                if cl['times_used'] > 0:
-                    nonzero_time_used += 1
-                else:
-                    zero_times_used += 1
+        # .cur - binary incremental, .csv - full csv dump
+        zero_times_used, nonzero_time_used = self.curriculum.save(fn)
         with open(temp_file, "w") as f:
             f.write('Non used files {:,} / used files {:,}'.format(zero_times_used,
                                                                    nonzero_time_used)+"\n")
 
     def parse_transcript(self, transcript_path):
+        if self.token_store is not None:
+            ts = self.token_store.get(transcript_path)
+            if ts is not None:
+                return ts
+        if self.subword_regularization:
+            return self.tokenize_transcript(transcript_path)
         global TS_CACHE
         if transcript_path not in TS_CACHE:
-            if not transcript_path:
-                ts = self.labels.parse('')
-            else:
-                with open(transcript_path, 'r', encoding='utf8') as transcript_file:
-                    ts = self.labels.parse(transcript_file.read())
-            TS_CACHE[transcript_path] = ts
+            TS_CACHE[transcript_path] = self.tokenize_transcript(transcript_path)
         return TS_CACHE[transcript_path]
 
+    def tokenize_transcript(self, transcript_path):
+        if not transcript_path:
+            ts = self.labels.parse('')
+        else:
+            ts = self.labels.parse(self.read_transcript_text(transcript_path))
+        return label_array(ts)
+
+    def read_transcript_text(self, transcript_path):
+        with open(transcript_path, 'r', encoding='utf8') as transcript_file:
+            return transcript_file.read()
+
     def parse_phoneme(self, phoneme_path):
         global TS_PHONEME_CACHE
         if phoneme_path not in TS_PHONEME_CACHE:
@@ -898,25 +933,13 @@ class SpectrogramDataset(Dataset, SpectrogramParser):
             else:
                 with open(phoneme_path, 'r', encoding='utf8') as phoneme_file:
                     ts = self.phoneme_label_parser.parse(phoneme_file.read())
-            TS_PHONEME_CACHE[phoneme_path] = ts
+            TS_PHONEME_CACHE[phoneme_path] = label_array(ts)
         return TS_PHONEME_CACHE[phoneme_path]
 
     def get_phoneme_path(self,
                          transcript_path):
         return transcript_path.replace('.txt','_phoneme.txt')
 
-    @staticmethod
-    def parse_mf_row(row):
-        if len(row) == 3:
-            # wav, txt, duration
-            return row[0], row[1], row[2]
-        elif len(row) == 4:
-            # wav, txt, duration, domain
-            return row[0], row[1], row[2], row[3]
-        else:
-            raise ValueError('Wrong manifest format')
-
-
     def __len__(self):
         return self.size
 
@@ -924,182 +947,94 @@ class SpectrogramDataset(Dataset, SpectrogramParser):
         return self.labels.render_transcript(self.parse_transcript(txt))
 
 
-def _collate_fn(batch):
-    def func(p):
-        return p[0].size(1)
-
-    batch = sorted(batch, key=lambda sample: sample[0].size(1), reverse=True)
-    longest_sample = max(batch, key=func)[0]
-    freq_size = longest_sample.size(0)
-    minibatch_size = len(batch)
-    max_seqlength = longest_sample.size(1)
-    inputs = torch.zeros(minibatch_size, 1, freq_size, max_seqlength)
-    input_percentages = torch.FloatTensor(minibatch_size)
-    target_sizes = torch.IntTensor(minibatch_size)
-    targets = []
-    filenames = []
-    for x in range(minibatch_size):
-        sample = batch[x]
-        tensor = sample[0]
-        target = sample[1]
-        filenames.append(sample[2])
-        seq_length = tensor.size(1)
-        inputs[x][0].narrow(1, 0, seq_length).copy_(tensor)
-        input_percentages[x] = seq_length / float(max_seqlength)
-        target_sizes[x] = len(target)
-        targets.extend(target)
-    targets = torch.IntTensor(targets)
-    return inputs, targets, filenames, input_percentages, target_sizes
-
-
-def _collate_fn_double(batch):
-    def func(p):
-        return p[0].size(1)
-
-    batch = sorted(batch, key=lambda sample: sample[0].size(1), reverse=True)
-    longest_sample = max(batch, key=func)[0]
-    freq_size = longest_sample.size(0)
-    minibatch_size = len(batch)
-    max_seqlength = longest_sample.size(1)
-    inputs = torch.zeros(minibatch_size, 1, freq_size, max_seqlength)
-    input_percentages = torch.FloatTensor(minibatch_size)
-    filenames = []
-
-    ctc_target_sizes = torch.IntTensor(minibatch_size)
-    ctc_targets = []
-
-    s2s_target_sizes = torch.IntTensor(minibatch_size)
-    s2s_targets = []
-
-    for x in range(minibatch_size):
-        sample = batch[x]
-        tensor = sample[0]
-        target = sample[1]
-
-        ctc_target = target[0]
-        s2s_target = target[1]
-
-        filenames.append(sample[2])
-        seq_length = tensor.size(1)
-        inputs[x][0].narrow(1, 0, seq_length).copy_(tensor)
-        input_percentages[x] = seq_length / float(max_seqlength)
-
-        ctc_target_sizes[x] = len(ctc_target)
-        ctc_targets.extend(ctc_target)
-        s2s_target_sizes[x] = len(s2s_target)
-        s2s_targets.extend(s2s_target)
-
-    ctc_targets = torch.IntTensor(ctc_targets)
-    s2s_targets = torch.IntTensor(s2s_targets)
-
-    return (inputs,
-            ctc_targets, s2s_targets,
-            filenames, input_percentages,
-            ctc_target_sizes, s2s_target_sizes)
-
-
-def _collate_fn_denoise(batch):
-    def func(p):
-        return p[0][0].size(1)
-    # first batch element is (tensor, mask)
-    batch = sorted(batch, key=lambda sample: sample[0][0].size(1), reverse=True)
-    longest_sample = max(batch, key=func)[0][0]
-    freq_size = longest_sample.size(0)
-    minibatch_size = len(batch)
-    max_seqlength = longest_sample.size(1)
-    inputs = torch.zeros(minibatch_size, 1, freq_size, max_seqlength)
-    masks  = torch.zeros(minibatch_size, 1, freq_size, max_seqlength)
-    input_percentages = torch.FloatTensor(minibatch_size)
-    target_sizes = torch.IntTensor(minibatch_size)
-    targets = []
-    filenames = []
-    for x in range(minibatch_size):
-        sample = batch[x]
-        tensor = sample[0][0]
-        mask   = sample[0][1]
-        target = sample[1]
-        filenames.append(sample[2])
-        seq_length = tensor.size(1)
-        assert seq_length == mask.size(1)
-        inputs[x][0].narrow(1, 0, seq_length).copy_(tensor)
-        masks[x][0].narrow(1, 0, seq_length).copy_(mask)
-        input_percentages[x] = seq_length / float(max_seqlength)
-        target_sizes[x] = len(target)
-        targets.extend(target)
-    targets = torch.IntTensor(targets)
-    return inputs, targets, filenames, input_percentages, target_sizes, masks
-
-
-def _collate_fn_phoneme(batch):
-    def func(p):
-        return p[0].size(1)
-    # simple failsafe for validation
-    if len(batch[0])==3:
-        return _collate_fn(batch)
-    batch = sorted(batch, key=lambda sample: sample[0].size(1), reverse=True)
-    longest_sample = max(batch, key=func)[0]
-    freq_size = longest_sample.size(0)
-    minibatch_size = len(batch)
-    max_seqlength = longest_sample.size(1)
-    inputs = torch.zeros(minibatch_size, 1, freq_size, max_seqlength)
-    input_percentages = torch.FloatTensor(minibatch_size)
-    target_sizes = torch.IntTensor(minibatch_size)
-    phoneme_target_sizes = torch.IntTensor(minibatch_size)
-    targets = []
-    phoneme_targets = []
-    filenames = []
-    for x in range(minibatch_size):
-        sample = batch[x]
-        tensor = sample[0]
-        target = sample[1]
-        phoneme_target = sample[3]
-        filenames.append(sample[2])
-        seq_length = tensor.size(1)
-        inputs[x][0].narrow(1, 0, seq_length).copy_(tensor)
-        input_percentages[x] = seq_length / float(max_seqlength)
-        target_sizes[x] = len(target)
-        phoneme_target_sizes[x] = len(phoneme_target)
-        targets.extend(target)
-        phoneme_targets.extend(phoneme_target)
-    targets = torch.IntTensor(targets)
-    phoneme_targets = torch.IntTensor(phoneme_targets)
-    return inputs, targets, filenames, input_percentages, target_sizes, phoneme_targets, phoneme_target_sizes
+class ShardedSpectrogramDataset(SpectrogramDataset):
+    def __init__(self, audio_conf, manifest_filepath, cache_path, labels, **kwargs):
+        """
+        Same as SpectrogramDataset, but audio and transcripts are read from
+        shards packed by data/shards.py, manifest_filepath is the shard folder.
+        Manifest rows are still used as keys, so curriculum files
+        and samplers work as is
+        """
+        self.shards = ShardReader(manifest_filepath)
+        super(ShardedSpectrogramDataset, self).__init__(audio_conf,
+                                                        os.path.join(manifest_filepath, 'manifest.csv'),
+                                                        cache_path, labels, **kwargs)
+        # the manifest keeps the shard order, i.e. manifest row == shard index row
+        self.audio_loader = self.load_shard_audio
+        print('Using {:,} sharded utterances from {}'.format(len(self.manifest),
+                                                            manifest_filepath))
+
+    def load_shard_audio(self, path, channel=-1):
+        return self.shards.read_audio(self.manifest.wavs.find(path))
+
+    def read_transcript_text(self, transcript_path):
+        row = self.manifest.txts.find(transcript_path)
+        if row >= 0:
+            return self.shards.read_text(row)
+        # i.e. phoneme transcripts are not packed
+        return super(ShardedSpectrogramDataset, self).read_transcript_text(transcript_path)
+
+
+def dataset_for_manifest(manifest_filepath):
+    if is_shard_dir(manifest_filepath):
+        return ShardedSpectrogramDataset
+    return SpectrogramDataset
+
+
+def get_collate_fn(dataset, collate_fn):
+    # i.e. ShardedIterableDataset
+    dataset = getattr(dataset, 'dataset', dataset)
+    if getattr(dataset, 'batch_features', False):
+        return BatchFeatureCollate(dataset, collate_fn)
+    return collate_fn
 
 
 class AudioDataLoader(DataLoader):
     def __init__(self, *args, **kwargs):
         """
         Creates a data loader for AudioDatasets.
+        :param collate_report_every: print collate time / memory stats every N batches
         """
+        report_every = kwargs.pop('collate_report_every', 0)
         super(AudioDataLoader, self).__init__(*args, **kwargs)
-        self.collate_fn = _collate_fn
+        self.collate_fn = get_collate_fn(self.dataset,
+                                         Collator('ctc', report_every=report_every))
 
 
 class AudioDataLoaderDouble(DataLoader):
     def __init__(self, *args, **kwargs):
         """
         Creates a data loader for AudioDatasets.
+        :param collate_report_every: print collate time / memory stats every N batches
         """
+        report_every = kwargs.pop('collate_report_every', 0)
         super(AudioDataLoaderDouble, self).__init__(*args, **kwargs)
-        self.collate_fn = _collate_fn_double
+        self.collate_fn = get_collate_fn(self.dataset,
+                                         Collator('double', report_every=report_every))
 
 
 class AudioDataLoaderDenoise(DataLoader):
     def __init__(self, *args, **kwargs):
         """
         Creates a data loader for AudioDatasets.
+        :param collate_report_every: print collate time / memory stats every N batches
         """
+        report_every = kwargs.pop('collate_report_every', 0)
         super(AudioDataLoaderDenoise, self).__init__(*args, **kwargs)
-        self.collate_fn = _collate_fn_denoise
+        self.collate_fn = get_collate_fn(self.dataset,
+                                         Collator('denoise', report_every=report_every))
 
 
 class AudioDataLoaderPhoneme(DataLoader):
     def __init__(self, *args, **kwargs):
         """
         Creates a data loader for AudioDatasets.
+        :param collate_report_every: print collate time / memory stats every N batches
         """
+        report_every = kwargs.pop('collate_report_every', 0)
         super(AudioDataLoaderPhoneme, self).__init__(*args, **kwargs)
-        self.collate_fn = _collate_fn_phoneme
+        self.collate_fn = get_collate_fn(self.dataset,
+                                         Collator('phoneme', report_every=report_every))
 
 
 class BucketingSampler(Sampler):
@@ -1120,12 +1055,13 @@ class BucketingSampler(Sampler):
     def __len__(self):
         return len(self.bins)
 
-    def shuffle(self, epoch):
-        np.random.shuffle(self.bins)
+    def shuffle(self, epoch, rng=None):
+        # rng - a seeded RandomState, the same order on all the ranks
+        (rng or np.random).shuffle(self.bins)
 
 
 class BucketingLenSampler(Sampler):
-    def __init__(self, data_source, batch_size=1):
+    def __init__(self, data_source, batch_size=1, num_buckets=100):
         """
         A sampler to use with curriculum learning
         Due to drastically different durations of the samples
@@ -1134,13 +1070,12 @@ class BucketingLenSampler(Sampler):
         """
         super(BucketingLenSampler, self).__init__(data_source)
         self.data_source = data_source
-        ids = list(range(0, len(data_source)))
-        # data_source.ids - ids sampled by curriculum
-        durations = [item[2] for item in data_source.ids]
-        assert len(durations) == len(ids)
-        # sort ids by ascending duration
-        ids = [_id for _, _id in sorted(zip(durations, ids),
-               key=lambda pair: pair[0])]
+        # data_source.ids - manifest rows sampled by curriculum
+        # bucket boundaries are computed once per manifest,
+        # grouping by bucket is a linear radix sort
+        buckets = data_source.manifest.duration_buckets(data_source.selected_rows(), num_buckets)
+        assert len(buckets) == len(data_source)
+        ids = np.argsort(buckets, kind='stable').tolist()
         self.bins = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
 
     def __iter__(self):
@@ -1151,8 +1086,66 @@ class BucketingLenSampler(Sampler):
     def __len__(self):
         return len(self.bins)
 
-    def shuffle(self, epoch):
-        np.random.shuffle(self.bins)
+    def shuffle(self, epoch, rng=None):
+        # rng - a seeded RandomState, the same order on all the ranks
+        (rng or np.random).shuffle(self.bins)
+
+
+class FrameBudgetSampler(Sampler):
+    def __init__(self, data_source, max_frames, num_buckets=64,
+                 max_batch_size=None):
+        """
+        Batches of similar duration holding up to max_frames padded frames,
+        i.e. max_len * batch_size is bounded instead of the batch size
+        Buckets are duration quantiles of the manifest, each bucket's batch size
+        is set by its longest utterance after the length changing augs
+        Wrap into BalancedDistributedSampler for distributed training
+        """
+        super(FrameBudgetSampler, self).__init__(data_source)
+        self.data_source = data_source
+        manifest = data_source.manifest
+        rows = data_source.selected_rows()
+        self.buckets = manifest.duration_buckets(rows, num_buckets)
+
+        upper = np.append(manifest.duration_boundaries(num_buckets),
+                          manifest.durations.max())
+        # tempo / shift augs make the utterances longer than in the manifest
+        upper = data_source.max_aug_duration(upper)
+        frames = np.floor(upper * data_source.sample_rate / data_source.hop_length) + 1
+        self.bucket_sizes = np.maximum(max_frames // frames, 1).astype(np.int64)
+        if max_batch_size:
+            self.bucket_sizes = np.minimum(self.bucket_sizes, max_batch_size)
+        if int(frames.max()) > max_frames:
+            print('Warning - utterances of {} frames do not fit into {} frames, batches of 1'.format(
+                int(frames.max()), max_frames))
+        # the first epoch goes by ascending duration
+        order = np.argsort(manifest.durations[rows], kind='stable')
+        self.pack(order)
+
+    def pack(self, order):
+        """Groups the ids in `order` by bucket, cuts each bucket into batches"""
+        order = order[np.argsort(self.buckets[order], kind='stable')]
+        counts = np.bincount(self.buckets[order], minlength=len(self.bucket_sizes))
+        bins = []
+        start = 0
+        for count, size in zip(counts, self.bucket_sizes):
+            ids = order[start:start + count].tolist()
+            bins.extend(ids[i:i + size] for i in range(0, count, size))
+            start += count
+        self.bins = bins
+
+    def __iter__(self):
+        return iter(self.bins)
+
+    def __len__(self):
+        return len(self.bins)
+
+    def shuffle(self, epoch, rng=None):
+        # deterministic by epoch, the same on all the replicas
+        if rng is None:
+            rng = np.random.RandomState(epoch)
+        self.pack(rng.permutation(len(self.data_source)))
+        self.bins = [self.bins[i] for i in rng.permutation(len(self.bins))]
 
 
 class DistributedBucketingSampler(Sampler):
@@ -1193,9 +1186,160 @@ class DistributedBucketingSampler(Sampler):
         self.bins = [self.bins[i] for i in bin_ids]
 
 
+class BalancedDistributedSampler(Sampler):
+    def __init__(self, sampler, num_replicas=None, rank=None):
+        """
+        Deals the batches of a bucketing sampler to the ranks so that
+        the batches of each step have similar padded frames
+        Batches are sorted by padded frames and cut into steps of num_replicas,
+        inside a step the largest batch goes to the rank with the least frames so far
+        The left over batches make the last step, their utterances are re-batched
+        by duration under the padded frames of the largest of them,
+        the shortest one is repeated only if they cannot be split into whole steps
+        The wrapped sampler is re-shuffled (and re-packed) each epoch with the same seed
+        Deterministic per epoch, self.bins are the batches of this rank, like in
+        the other samplers, i.e. can be sliced to resume
+        """
+        super(BalancedDistributedSampler, self).__init__(sampler.data_source)
+        if num_replicas is None:
+            num_replicas = get_world_size()
+        if rank is None:
+            rank = get_rank()
+        self.sampler = sampler
+        self.data_source = sampler.data_source
+        self.num_replicas = num_replicas
+        self.rank = rank
+        data_source = self.data_source
+        durations = data_source.manifest.durations[data_source.selected_rows()]
+        self.frames = (durations * data_source.sample_rate // data_source.hop_length + 1).astype(np.int64)
+        self.deal()
+
+    def padded_frames(self, ids):
+        return len(ids) * int(self.frames[ids].max())
+
+    def split_left_over(self, bins):
+        """Re-batches the utterances of the left over batches into steps of num_replicas batches"""
+        ids = [i for b in bins for i in b]
+        ids = sorted(ids, key=lambda i: self.frames[i], reverse=True)
+        # no new batch gets more padded frames than the largest left over one
+        budget = max(self.padded_frames(b) for b in bins)
+        chunks = [[]]
+        for i in ids:
+            # ids go by descending duration, the first one is the longest
+            if chunks[-1] and (len(chunks[-1]) + 1) * self.frames[chunks[-1][0]] > budget:
+                chunks.append([])
+            chunks[-1].append(i)
+        while len(chunks) % self.num_replicas:
+            splittable = [c for c in chunks if len(c) > 1]
+            if not splittable:
+                break
+            chunk = max(splittable, key=self.padded_frames)
+            k = chunks.index(chunk)
+            half = len(chunk) // 2
+            chunks[k:k + 1] = [chunk[:half], chunk[half:]]
+        # fewer utterances than ranks, all the ranks need a batch
+        shortest = chunks[-1][-1]
+        while len(chunks) % self.num_replicas:
+            chunks.append([shortest])
+        return [chunks[k:k + self.num_replicas]
+                for k in range(0, len(chunks), self.num_replicas)]
+
+    def deal(self, rng=None):
+        bins = [list(ids) for ids in self.sampler.bins]
+        costs = np.array([self.padded_frames(ids) for ids in bins])
+        order = np.argsort(costs, kind='stable')
+        n_steps = len(bins) // self.num_replicas
+        steps = [[bins[i] for i in order[k * self.num_replicas:(k + 1) * self.num_replicas]]
+                 for k in range(n_steps)]
+        left_over = [bins[k] for k in order[n_steps * self.num_replicas:]]
+        if left_over:
+            steps.extend(self.split_left_over(left_over))
+        if rng is not None:
+            steps = [steps[k] for k in rng.permutation(len(steps))]
+
+        totals = np.zeros(self.num_replicas, dtype=np.int64)
+        self.step_frames = np.zeros((len(steps), self.num_replicas), dtype=np.int64)
+        self.bins = []
+        for k, step in enumerate(steps):
+            step = sorted(step, key=self.padded_frames, reverse=True)
+            ranks = np.argsort(totals, kind='stable')
+            for r, ids in zip(ranks, step):
+                self.step_frames[k, r] = self.padded_frames(ids)
+                if r == self.rank:
+                    self.bins.append(ids)
+            totals += self.step_frames[k]
+        if len(steps) > 0 and self.rank == 0:
+            skew = self.step_frames.max(axis=1) / self.step_frames.mean(axis=1)
+            print('Dealt {} steps to {} ranks, padded frames per step '
+                  'max / mean: {:.3f} on average, {:.3f} at worst'.format(len(steps), self.num_replicas,
+                                                                       skew.mean(), skew.max()))
+
+    def __iter__(self):
+        for ids in self.bins:
+            yield ids
+
+    def __len__(self):
+        return len(self.bins)
+
+    def shuffle(self, epoch):
+        # the same on all the ranks
+        rng = np.random.RandomState(epoch)
+        self.sampler.shuffle(epoch, rng)
+        self.deal(rng)
+
+
+class ShardRangeSampler(Sampler):
+    def __init__(self, data_source, batch_size=1, range_size=1024, num_streams=1):
+        """
+        Batches inside ranges of consecutive shard rows, for ShardedIterableDataset
+        The selected rows are cut into ranges in shard order, each range
+        into batches of similar duration
+        Ranges are dealt to num_streams streams, one per loader worker, and the
+        batches of the streams are interleaved, i.e. worker w gets bins[w::num_streams]
+        and reads whole ranges front to back (up to the tail of the epoch)
+        self.bins are in loader order, like in the other samplers, i.e. can be sliced to resume
+        """
+        super(ShardRangeSampler, self).__init__(data_source)
+        self.data_source = data_source
+        self.batch_size = batch_size
+        self.num_streams = max(num_streams, 1)
+        rows = data_source.selected_rows()
+        self.durations = data_source.manifest.durations[rows]
+        # dataset ids in shard order
+        order = np.argsort(rows, kind='stable')
+        self.ranges = [order[i:i + range_size] for i in range(0, len(order), range_size)]
+        self.plan(np.arange(len(self.ranges)))
+
+    def plan(self, range_order, rng=None):
+        streams = [[] for _ in range(self.num_streams)]
+        for k in range_order:
+            ids = self.ranges[k]
+            ids = ids[np.argsort(self.durations[ids], kind='stable')].tolist()
+            bins = [ids[i:i + self.batch_size] for i in range(0, len(ids), self.batch_size)]
+            if rng is not None:
+                bins = [bins[i] for i in rng.permutation(len(bins))]
+            # the stream with the fewest batches so far
+            min(streams, key=len).extend(bins)
+        self.bins = [stream[j]
+                     for j in range(max(len(stream) for stream in streams))
+                     for stream in streams if j < len(stream)]
+
+    def __iter__(self):
+        return iter(self.bins)
+
+    def __len__(self):
+        return len(self.bins)
+
+    def shuffle(self, epoch, rng=None):
+        # deterministic by epoch
+        if rng is None:
+            rng = np.random.RandomState(epoch)
+        self.plan(rng.permutation(len(self.ranges)), rng)
+
+
 def get_audio_length(path):
-    output = subprocess.check_output(['soxi -D \"%s\"' % path.strip().replace('"', '\\"')], shell=True)
-    return float(output)
+    # header only, no soxi process
+    return probe_duration(path)
 
 
 def audio_with_sox(path, sample_rate, start_time, end_time):
@@ -1237,9 +1381,10 @@ def augment_audio_with_augs(path,
                             sample_rate,
                             transforms,
                             channel=-1,
-                            noise_path=None):  # channels: -1 = both, 0 = left, 1 = right
+                            noise_path=None,
+                            loader=load_audio_norm):  # channels: -1 = both, 0 = left, 1 = right
 
-    y, _sample_rate = load_audio_norm(path)
+    y, _sample_rate = loader(path)
     if _sample_rate!=sample_rate:
         y = librosa.resample(y, _sample_rate, sample_rate)
     assert len(y.shape)==1
@@ -1254,7 +1399,8 @@ def augment_audio_with_augs(path,
 
 def load_randomly_augmented_audio(path, sample_rate=16000, tempo_range=(0.85, 1.15),
                                   gain_range=(-10, 10), channel=-1,
-                                  transforms=None):
+                                  transforms=None,
+                                  loader=load_audio_norm):
     """
     Picks tempo and gain uniformly, applies it to the utterance by using sox utility.
     Returns the augmented utterance.
@@ -1267,7 +1413,8 @@ def load_randomly_augmented_audio(path, sample_rate=16000, tempo_range=(0.85, 1.
         audio, sample_rate_ = augment_audio_with_augs(path=path,
                                                       sample_rate=sample_rate,
                                                       transforms=transforms,
-                                                      channel=channel)
+                                                      channel=channel,
+                                                      loader=loader)
     else: # never use this for now
         audio, sample_rate_ = augment_audio_with_sox(path=path, sample_rate=sample_rate,
                                                      tempo=tempo_value, gain=gain_value, channel=channel)
@@ -0,0 +1,220 @@
+import os
+import json
+import socket
+import hashlib
+
+import numpy as np
+
+
+# one fixed-size record per stored spectrogram
+# key / check - content address (path + size + mtime + audio conf fingerprint)
+# writer / shard / offset - where the payload lives
+INDEX_DTYPE = np.dtype([('key', '<u8'),
+                        ('check', '<u4'),
+                        ('shard', '<i4'),
+                        ('offset', '<i8'),
+                        ('rows', '<i4'),
+                        ('cols', '<i4'),
+                        ('dtype', 'u1'),
+                        ('scale', '<f4'),
+                        ('bias', '<f4')])
+
+DTYPES = {'float32': 0,
+          'float16': 1,
+          'uint8': 2}
+
+NP_DTYPES = {0: np.float32,
+             1: np.float16,
+             2: np.uint8}
+
+SHARD_SIZE = 1024 ** 3  # roll over to a new shard after 1 GB
+
+
+class FeatureStore(object):
+    """Content-addressed spectrogram store
+
+    Features are appended to large shard files, each DataLoader worker
+    writes its own shards and its own index file, so no locking is needed.
+    Readers memory map the shards and slice them without copying.
+
+    Values are stored as is (float32) or quantized:
+    - float16
+    - uint8, linear per utterance quantization of the log-magnitudes
+    """
+    VERSION = 1
+
+    def __init__(self, root, fingerprint, dtype='float32',
+                 shard_size=SHARD_SIZE):
+        if dtype not in DTYPES:
+            raise ValueError('Unsupported feature store dtype {}'.format(dtype))
+        self.root = root
+        self.fingerprint = self.make_fingerprint(fingerprint)
+        self.dtype = dtype
+        self.shard_size = shard_size
+        os.makedirs(self.root, exist_ok=True)
+        # everything below is per process
+        # and is (re)initialized lazily after a fork
+        self._pid = None
+
+    @classmethod
+    def make_fingerprint(cls, conf):
+        # any change of the feature extraction params
+        # invalidates the cached features
+        if isinstance(conf, str):
+            return conf
+        return json.dumps({'version': cls.VERSION, **conf},
+                          sort_keys=True, default=str)
+
+    def make_key(self, path):
+        st = os.stat(path)
+        h = hashlib.blake2b('{}|{}|{}|{}'.format(os.path.abspath(path),
+                                                 st.st_size,
+                                                 st.st_mtime_ns,
+                                                 self.fingerprint).encode('utf8'),
+                            digest_size=12).digest()
+        return (int(np.frombuffer(h[:8], dtype='<u8')[0]),
+                int(np.frombuffer(h[8:], dtype='<u4')[0]))
+
+    def _init_process(self):
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._writer_name = '{}-{}'.format(socket.gethostname(), self._pid)
+        self._shard_file = None
+        self._shard_no = -1
+        self._index_file = None
+        self._pending = {}
+        self._mmaps = {}
+        self.load_index()
+
+    def load_index(self):
+        self._writers = []
+        records = []
+        writer_ids = []
+        for fn in sorted(os.listdir(self.root)):
+            if not (fn.startswith('index-') and fn.endswith('.idx')):
+                continue
+            with open(os.path.join(self.root, fn), 'rb') as f:
+                buf = f.read()
+            # drop a partially written tail record, if any
+            n = len(buf) // INDEX_DTYPE.itemsize
+            if n == 0:
+                continue
+            records.append(np.frombuffer(buf[:n * INDEX_DTYPE.itemsize],
+                                         dtype=INDEX_DTYPE))
+            writer_ids.append(np.full(n, len(self._writers), dtype=np.int32))
+            self._writers.append(fn[len('index-'):-len('.idx')])
+        if records:
+            records = np.concatenate(records)
+            writer_ids = np.concatenate(writer_ids)
+            order = np.argsort(records['key'], kind='stable')
+            self._index = records[order]
+            self._index_writers = writer_ids[order]
+        else:
+            self._index = np.zeros(0, dtype=INDEX_DTYPE)
+            self._index_writers = np.zeros(0, dtype=np.int32)
+
+    def __len__(self):
+        self._init_process()
+        return len(self._index) + len(self._pending)
+
+    def _lookup(self, key, check):
+        if key in self._pending:
+            return self._pending[key]
+        i = np.searchsorted(self._index['key'], key)
+        while i < len(self._index) and self._index['key'][i] == key:
+            if self._index['check'][i] == check:
+                return self._writers[self._index_writers[i]], self._index[i]
+            i += 1
+        return None
+
+    def _shard_path(self, writer, shard_no):
+        return os.path.join(self.root, 'shard-{}-{:04d}.bin'.format(writer, shard_no))
+
+    def _get_mmap(self, writer, shard_no, end):
+        mm = self._mmaps.get((writer, shard_no))
+        if mm is None or len(mm) < end:
+            # shards are append only, remap if the shard has grown
+            mm = np.memmap(self._shard_path(writer, shard_no),
+                           dtype=np.uint8, mode='r')
+            self._mmaps[(writer, shard_no)] = mm
+        return mm
+
+    def get(self, path):
+        """Returns a float32 (F, T) array or None if not cached
+        float32 features are a read-only zero-copy view into the shard
+        """
+        self._init_process()
+        try:
+            key, check = self.make_key(path)
+        except OSError:
+            return None
+        found = self._lookup(key, check)
+        if found is None:
+            return None
+        writer, rec = found
+        dtype = np.dtype(NP_DTYPES[int(rec['dtype'])])
+        offset = int(rec['offset'])
+        rows, cols = int(rec['rows']), int(rec['cols'])
+        end = offset + rows * cols * dtype.itemsize
+        mm = self._get_mmap(writer, int(rec['shard']), end)
+        spect = mm[offset:end].view(dtype).reshape(rows, cols)
+        if dtype == np.float16:
+            spect = spect.astype(np.float32)
+        elif dtype == np.uint8:
+            spect = spect.astype(np.float32) * rec['scale'] + rec['bias']
+        return spect
+
+    def quantize(self, spect):
+        if self.dtype == 'float16':
+            return spect.astype(np.float16), 1.0, 0.0
+        elif self.dtype == 'uint8':
+            # spectrograms are already log-magnitudes
+            # so a linear 8-bit grid is good enough
+            lo, hi = float(spect.min()), float(spect.max())
+            scale = (hi - lo) / 255 if hi > lo else 1.0
+            q = np.round((spect - lo) / scale).clip(0, 255).astype(np.uint8)
+            return q, scale, lo
+        return spect.astype(np.float32), 1.0, 0.0
+
+    def put(self, path, spect):
+        self._init_process()
+        try:
+            key, check = self.make_key(path)
+        except OSError:
+            return
+        if hasattr(spect, 'numpy'):
+            spect = spect.numpy()
+        assert spect.ndim == 2
+        payload, scale, bias = self.quantize(spect)
+        payload = np.ascontiguousarray(payload)
+
+        if self._shard_file is None or self._shard_file.tell() >= self.shard_size:
+            self._next_shard()
+        offset = self._shard_file.tell()
+        self._shard_file.write(payload.tobytes())
+        # the payload has to hit the file before the index record
+        # so that readers never see a record pointing past the end of a shard
+        self._shard_file.flush()
+
+        rec = np.zeros(1, dtype=INDEX_DTYPE)
+        rec['key'] = key
+        rec['check'] = check
+        rec['shard'] = self._shard_no
+        rec['offset'] = offset
+        rec['rows'], rec['cols'] = payload.shape
+        rec['dtype'] = DTYPES[self.dtype]
+        rec['scale'] = scale
+        rec['bias'] = bias
+        if self._index_file is None:
+            self._index_file = open(os.path.join(self.root,
+                                                 'index-{}.idx'.format(self._writer_name)), 'ab')
+        self._index_file.write(rec.tobytes())
+        self._index_file.flush()
+        self._pending[key] = (self._writer_name, rec[0])
+
+    def _next_shard(self):
+        if self._shard_file is not None:
+            self._shard_file.close()
+        self._shard_no += 1
+        self._shard_file = open(self._shard_path(self._writer_name, self._shard_no), 'ab')
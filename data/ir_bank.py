@@ -0,0 +1,125 @@
+"""Synthetic impulse response bank for echo / reverb augs
+
+Impulse responses are synthesized once per process,
+then each sample is one FFT convolution, no matter how many echoes there are:
+
+- taps - a direct path + sparse echoes, like the old AddEcho
+- decay - a direct path + an exponentially decaying noise tail, a cheap room
+"""
+import random
+
+import numpy as np
+import torch
+from scipy.signal import oaconvolve
+
+
+def dampen(ms):
+    if ms < 50:
+        return 0.8
+    if ms < 100:
+        return 0.5
+    return 0.3
+
+
+# the IR length depends only on the latest arrival,
+# the tap count just bounds the echo density
+MAX_TAPS = 8
+# the old single echo alpha range
+MAX_ECHO_ALPHA = 0.8
+IR_KINDS = ('taps', 'decay')
+
+
+def taps_ir(sr, rng,
+            max_taps=MAX_TAPS,
+            sound_speed=0.33,
+            echo_arrivals_ms=list(range(0, 400, 10))):
+    shifts, alphas = [], []
+    for _ in range(rng.randint(1, max_taps)):
+        echo_arrival = rng.choice(echo_arrivals_ms)
+        shifts.append(int(sr * echo_arrival * sound_speed / 1000) + 1)
+        # vary dampening a bit
+        alphas.append(dampen(echo_arrival) * rng.uniform(0.5, 1))
+    alphas = np.array(alphas, dtype=np.float32)
+    # several taps together stay within the old single echo range
+    if alphas.sum() > MAX_ECHO_ALPHA:
+        alphas *= MAX_ECHO_ALPHA / alphas.sum()
+    ir = np.zeros(max(shifts) + 1, dtype=np.float32)
+    ir[0] = 1
+    np.add.at(ir, shifts, alphas)
+    # (wav + alpha * echo) / (1 + alpha), i.e. one tap is exactly the old AddEcho
+    return ir / ir.sum()
+
+
+def decay_ir(sr, rng,
+             rt60_range=(0.1, 0.6),
+             drr_db_range=(0, 10)):
+    rt60 = rng.uniform(*rt60_range)
+    t = np.arange(int(rt60 * sr)) / sr
+    # -60 dB at rt60
+    tail = np.random.RandomState(rng.randrange(2 ** 31)).randn(len(t)) * np.exp(-6.9 * t / rt60)
+    tail[0] = 0
+    # direct to reverberant energy ratio
+    drr = 10 ** (rng.uniform(*drr_db_range) / 10)
+    tail *= np.sqrt(1 / drr / (tail ** 2).sum())
+    ir = tail.astype(np.float32)
+    ir[0] = 1
+    return ir / np.sqrt((ir ** 2).sum())
+
+
+def convolve(wav, ir):
+    """Same length as wav, the tail is cut off"""
+    return oaconvolve(wav, ir)[:len(wav)].astype(np.float32)
+
+
+def batch_convolve(waves, irs):
+    """FFT convolution of a padded (B, L) batch with padded (B, K) responses
+    Tails go into the padding / are cut off, i.e. mask by the lengths afterwards
+    """
+    n = waves.size(1) + irs.size(1) - 1
+    n_fft = 1 << (n - 1).bit_length()
+    spect = torch.fft.rfft(waves, n=n_fft) * torch.fft.rfft(irs, n=n_fft)
+    return torch.fft.irfft(spect, n=n_fft)[:, :waves.size(1)]
+
+
+class IRBank(object):
+    def __init__(self, sr, size=512, seed=0,
+                 kinds=IR_KINDS,
+                 taps_conf=None):
+        rng = random.Random(seed)
+        irs = []
+        for i in range(size):
+            if kinds[i % len(kinds)] == 'taps':
+                irs.append(taps_ir(sr, rng, **(taps_conf or {})))
+            else:
+                irs.append(decay_ir(sr, rng))
+        self.sr = sr
+        self.lengths = np.array([len(ir) for ir in irs])
+        self.irs = np.zeros((size, self.lengths.max()), dtype=np.float32)
+        for i, ir in enumerate(irs):
+            self.irs[i, :len(ir)] = ir
+
+    def __len__(self):
+        return len(self.irs)
+
+    def random_ir(self):
+        i = random.randrange(len(self))
+        return self.irs[i, :self.lengths[i]]
+
+    def __call__(self, wav):
+        return convolve(wav, self.random_ir())
+
+    def random_batch(self, batch_size):
+        """(B, K) tensor of random responses, for batch_convolve"""
+        idx = np.random.randint(len(self), size=batch_size)
+        return torch.from_numpy(self.irs[idx, :self.lengths[idx].max()])
+
+
+_BANKS = {}
+
+
+def get_bank(sr, kinds=IR_KINDS, taps_conf=None):
+    # one bank per process and config
+    key = (sr, tuple(kinds), repr(sorted((taps_conf or {}).items())))
+    if key not in _BANKS:
+        _BANKS[key] = IRBank(sr, kinds=kinds, taps_conf=taps_conf)
+    return _BANKS[key]
@@ -59,3 +59,7 @@ class Labels:
 
     def render_transcript(self, codes):
         return ''.join([self.labels[i] for i in codes])
+
+    def fingerprint(self):
+        # everything that changes the parse output
+        return {'type': 'chars', 'labels': self.labels}
@@ -0,0 +1,279 @@
+"""Columnar manifest and curriculum storage
+
+Millions of per-utterance tuples / dicts are gigabytes of python objects,
+and forked DataLoader workers slowly copy them because of refcount updates.
+Here everything lives in a handful of numpy arrays instead:
+
+    PathTable       - interned directory prefixes + one utf8 buffer of file names
+    ManifestTable   - wav, txt, duration[, domain] columns,
+                      + optional wav peaks from <manifest>.peaks.npy
+    CurriculumTable - cer / wer / times_used / text length per manifest row
+                      saved as csv or in a binary store, see data/curriculum_store.py
+"""
+import csv
+import hashlib
+from array import array
+
+import numpy as np
+
+from data import curriculum_store
+from data.audio_loader import load_peaks
+
+
+DEFAULT_DOMAIN = 'default_domain'
+
+
+def path_key(path):
+    return int.from_bytes(hashlib.blake2b(path.encode('utf8'),
+                                          digest_size=8).digest(), 'little')
+
+
+class PathTable(object):
+    """Append-only table of paths, frozen into numpy arrays
+
+    Paths usually share a few directories, so directory prefixes are interned
+    and only file names are stored per row.
+    Lookups by path go through a sorted array of 64-bit path hashes.
+    """
+    def __init__(self):
+        self.prefixes = []
+        self._prefix_codes = {}
+        self._codes = array('i')
+        self._names = bytearray()
+        self._offsets = array('q', [0])
+        self._keys = array('Q')
+
+    def append(self, path):
+        prefix, sep, name = path.rpartition('/')
+        prefix += sep
+        code = self._prefix_codes.get(prefix)
+        if code is None:
+            code = len(self.prefixes)
+            self._prefix_codes[prefix] = code
+            self.prefixes.append(prefix)
+        self._codes.append(code)
+        self._names += name.encode('utf8')
+        self._offsets.append(len(self._names))
+        self._keys.append(path_key(path))
+
+    def freeze(self):
+        self.codes = np.array(self._codes, dtype=np.int32)
+        self.names = np.frombuffer(bytes(self._names), dtype=np.uint8)
+        self.offsets = np.array(self._offsets, dtype=np.int64)
+        keys = np.array(self._keys, dtype=np.uint64)
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.key_rows = order.astype(np.int32)
+        del self._prefix_codes, self._codes, self._names, self._offsets, self._keys
+        return self
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.prefixes[self.codes[i]] + self.names[start:end].tobytes().decode('utf8')
+
+    def find(self, path):
+        """Row of the path or -1"""
+        key = np.uint64(path_key(path))
+        i = int(np.searchsorted(self.keys, key))
+        while i < len(self.keys) and self.keys[i] == key:
+            row = int(self.key_rows[i])
+            # 64-bit hash collisions are unlikely, but cheap to rule out
+            if self[row] == path:
+                return row
+            i += 1
+        return -1
+
+    def __contains__(self, path):
+        return self.find(path) >= 0
+
+
+class ManifestTable(object):
+    def __init__(self, path=None):
+        self.path = path
+        self.wavs = PathTable()
+        self.txts = PathTable()
+        self.domain_names = []
+        self.has_domains = False
+        self._boundaries = {}
+        # precomputed peak normalization stats, see data/audio_loader.py
+        self.peaks = None
+
+    @staticmethod
+    def parse_row(row):
+        if len(row) == 3:
+            # wav, txt, duration
+            return row[0], row[1], row[2]
+        elif len(row) == 4:
+            # wav, txt, duration, domain
+            return row[0], row[1], row[2], row[3]
+        else:
+            raise ValueError('Wrong manifest format')
+
+    @classmethod
+    def from_csv(cls, manifest_filepath, max_items=None):
+        table = cls(manifest_filepath)
+        durations = array('f')
+        domains = array('h')
+        domain_codes = {}
+        n_cols = None
+        with open(manifest_filepath, newline='') as f:
+            for i, row in enumerate(csv.reader(f)):
+                if max_items and i >= max_items:
+                    break
+                row = cls.parse_row(row)
+                if n_cols is None:
+                    n_cols = len(row)
+                elif len(row) != n_cols:
+                    print('Mixed 3 and 4 column rows in {}'.format(manifest_filepath))
+                    raise ValueError('Wrong manifest format')
+                table.wavs.append(row[0])
+                table.txts.append(row[1])
+                durations.append(float(row[2]))
+                if n_cols == 4:
+                    code = domain_codes.get(row[3])
+                    if code is None:
+                        code = len(table.domain_names)
+                        domain_codes[row[3]] = code
+                        table.domain_names.append(row[3])
+                    domains.append(code)
+        table.wavs.freeze()
+        table.txts.freeze()
+        table.durations = np.array(durations, dtype=np.float32)
+        table.has_domains = n_cols == 4
+        if table.has_domains:
+            table.domains = np.array(domains, dtype=np.int16)
+        else:
+            table.domains = np.full(len(table.durations), -1, dtype=np.int16)
+        table.peaks = load_peaks(manifest_filepath, len(table.durations))
+        return table
+
+    def __len__(self):
+        return len(self.durations)
+
+    def domain(self, i):
+        code = self.domains[i]
+        return self.domain_names[code] if code >= 0 else DEFAULT_DOMAIN
+
+    def row(self, i):
+        """Manifest row as a (wav, txt, duration[, domain]) tuple"""
+        if self.has_domains:
+            return (self.wavs[i], self.txts[i],
+                    float(self.durations[i]), self.domain_names[self.domains[i]])
+        return self.wavs[i], self.txts[i], float(self.durations[i])
+
+    def find(self, wav):
+        return self.wavs.find(wav)
+
+    def peak(self, wav):
+        """Precomputed peak of a wav or None"""
+        if self.peaks is None:
+            return None
+        i = self.find(wav)
+        return float(self.peaks[i]) if i >= 0 else None
+
+    def duration_boundaries(self, num_buckets):
+        """Duration quantiles splitting the manifest into num_buckets equal buckets"""
+        if num_buckets not in self._boundaries:
+            quantiles = np.linspace(0, 1, num_buckets + 1)[1:-1]
+            self._boundaries[num_buckets] = np.quantile(self.durations, quantiles).astype(np.float32)
+        return self._boundaries[num_buckets]
+
+    def duration_buckets(self, rows, num_buckets):
+        """Bucket of each row, 0 .. num_buckets - 1"""
+        return np.searchsorted(self.duration_boundaries(num_buckets),
+                               self.durations[rows], side='left').astype(np.int16)
+
+
+class CurriculumTable(object):
+    """Per utterance curriculum state, rows are aligned with the manifest
+
+    Reference / predicted transcripts are only needed to be written out,
+    so they are kept (in a sparse dict) only if keep_transcripts is set,
+    otherwise only the reference length is stored
+    """
+    COLUMNS = ['wav', 'text', 'transcript', 'offsets',
+               'times_used', 'cer', 'wer',
+               'duration', 'domain']
+
+    def __init__(self, manifest, keep_transcripts=True):
+        self.manifest = manifest
+        self.keep_transcripts = keep_transcripts
+        n = len(manifest)
+        self.cer = np.full(n, 0.999, dtype=np.float32)
+        self.wer = np.full(n, 0.999, dtype=np.float32)
+        self.times_used = np.zeros(n, dtype=np.int32)
+        self.text_len = np.zeros(n, dtype=np.int32)
+        self.transcripts = {}
+        # binary stores this table was saved to, see data/curriculum_store.py
+        self.stores = {}
+
+    def __len__(self):
+        return len(self.cer)
+
+    def load_csv(self, curriculum_filepath):
+        found = 0
+        total = 0
+        with open(curriculum_filepath, newline='') as f:
+            reader = csv.DictReader(f)
+            cr_column_set = set(self.COLUMNS) - {'domain'}
+            fields = set(reader.fieldnames)
+            assert fields == cr_column_set or fields == cr_column_set.union({'domain'})
+            for r in reader:
+                total += 1
+                # only items we have in the manifest
+                row = self.manifest.find(r['wav'])
+                if row < 0:
+                    continue
+                found += 1
+                self.cer[row] = float(r['cer'])
+                self.wer[row] = float(r['wer'])
+                self.times_used[row] = int(r['times_used'])
+                self.text_len[row] = len(r['text'])
+                if self.keep_transcripts and (r['text'] or r['transcript']):
+                    self.transcripts[row] = (r['text'], r['transcript'])
+        print('Manifest_paths {}, curriculum paths {}, matched {}'.format(len(self),
+                                                                          total,
+                                                                          found))
+
+    def get(self, row):
+        return self.text_len[row], self.cer[row], self.times_used[row]
+
+    def update(self, row, reference, transcript, cer, wer, times_used):
+        self.cer[row] = cer
+        self.wer[row] = wer
+        self.times_used[row] = times_used
+        self.text_len[row] = len(reference)
+        if self.keep_transcripts:
+            self.transcripts[row] = (reference, transcript)
+        for store in self.stores.values():
+            store.dirty[row] = True
+
+    def load(self, fn):
+        """csv or binary (.cur) curriculum"""
+        if fn.endswith('.csv'):
+            self.load_csv(fn)
+        else:
+            curriculum_store.load(self, fn)
+
+    def save(self, fn):
+        """Returns (non used, used) counts"""
+        if fn.endswith('.csv'):
+            return self.write_csv(fn)
+        curriculum_store.store_for(self, fn).save(self, fn)
+        used = int((self.times_used > 0).sum())
+        return len(self) - used, used
+
+    def write_csv(self, fn):
+        with open(fn, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.COLUMNS)
+            for row in range(len(self)):
+                text, transcript = self.transcripts.get(row, ('', ''))
+                writer.writerow([self.manifest.wavs[row], text, transcript, '',
+                                 self.times_used[row], self.cer[row], self.wer[row],
+                                 self.manifest.durations[row], self.manifest.domain(row)])
+        used = int((self.times_used > 0).sum())
+        return len(self) - used, used
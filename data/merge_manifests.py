@@ -14,6 +14,7 @@ parser.add_argument('--min-duration', default=1, type=int,
 parser.add_argument('--max-duration', default=15, type=int,
                     help='Prunes any samples longer than the max duration (given in seconds, default 15)')
 parser.add_argument('--output-path', default='merged_manifest.csv', help='Output path to merged manifest')
+parser.add_argument('--num-workers', default=None, type=int, help='Processes probing durations, all cpus by default')
 
 args = parser.parse_args()
 
@@ -22,10 +23,19 @@ for file in os.listdir(args.merge_dir):
     if file.endswith(".csv"):
         with open(os.path.join(args.merge_dir, file), 'r') as fh:
             file_paths += fh.readlines()
-file_paths = [file_path.split(',')[0] for file_path in file_paths]
-file_paths = order_and_prune_files(file_paths, args.min_duration, args.max_duration)
+rows = [file_path.strip().split(',') for file_path in file_paths]
+# keep the transcripts of the merged manifests
+transcript_paths = {row[0]: row[1] for row in rows if len(row) > 1}
+file_paths = [row[0] for row in rows]
+file_paths, durations = order_and_prune_files(file_paths, args.min_duration, args.max_duration,
+                                              num_workers=args.num_workers,
+                                              cache_path=args.output_path + '.durations',
+                                              return_durations=True)
 with io.FileIO(args.output_path, "w") as file:
-    for wav_path in tqdm(file_paths, total=len(file_paths)):
-        transcript_path = wav_path.replace('/wav/', '/txt/').replace('.wav', '.txt')
-        sample = os.path.abspath(wav_path) + ',' + os.path.abspath(transcript_path) + '\n'
+    for wav_path, duration in tqdm(zip(file_paths, durations), total=len(file_paths)):
+        transcript_path = transcript_paths.get(wav_path,
+                                               wav_path.replace('/wav/', '/txt/').replace('.wav', '.txt'))
+        sample = '{},{},{:.3f}\n'.format(os.path.abspath(wav_path),
+                                          os.path.abspath(transcript_path),
+                                          duration)
         file.write(sample.encode('utf-8'))
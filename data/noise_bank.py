@@ -0,0 +1,109 @@
+"""Pre-resampled noise bank
+
+All noise files are decoded, resampled and appended once into one float32 file,
+augmentations then slice it through a memory map shared by all workers:
+
+    root/<noise set id>/
+        noise.f32    # all noises, concatenated in a fixed random order
+        index.npy    # (offset, length) of each noise file, in samples
+"""
+import os
+import json
+import random
+import shutil
+import hashlib
+
+import numpy as np
+
+from data.audio_loader import load_audio_norm
+
+
+INDEX_DTYPE = np.dtype([('offset', '<i8'),
+                        ('length', '<i8')])
+
+
+def noise_set_id(paths, sample_rate):
+    conf = [sample_rate]
+    for path in sorted(paths):
+        st = os.stat(path)
+        conf.append((os.path.abspath(path), st.st_size, st.st_mtime_ns))
+    return hashlib.blake2b(json.dumps(conf).encode('utf8'), digest_size=8).hexdigest()
+
+
+class NoiseBank(object):
+    def __init__(self, root):
+        self.root = root
+        self.index = np.load(os.path.join(root, 'index.npy'))
+        self.total = int(self.index['length'].sum())
+        self._pid = None
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def noise(self):
+        # re-opened lazily in each worker
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._noise = np.memmap(os.path.join(self.root, 'noise.f32'),
+                                    dtype=np.float32, mode='r')
+        return self._noise
+
+    def random_slice(self, length):
+        """
+        Random noise of `length` samples or None if there is not enough noise
+        Starts at a random position of a random noise file
+        and continues into the following files, like stacked noise files
+        A read-only view unless it wraps around the end of the bank
+        """
+        if length > self.total:
+            return None
+        rec = self.index[random.randrange(len(self.index))]
+        start = int(rec['offset']) + random.randrange(max(int(rec['length']), 1))
+        end = start + length
+        if end <= self.total:
+            return self.noise[start:end]
+        return np.concatenate((self.noise[start:], self.noise[:end - self.total]))
+
+    @staticmethod
+    def build(root, paths, sample_rate):
+        tmp_root = root + '.{}.tmp'.format(os.getpid())
+        os.makedirs(tmp_root, exist_ok=True)
+        paths = sorted(paths)
+        # a fixed random order, so that files following each other
+        # are not the same kind of noise
+        random.Random(0).shuffle(paths)
+        index = np.zeros(len(paths), dtype=INDEX_DTYPE)
+        offset = 0
+        with open(os.path.join(tmp_root, 'noise.f32'), 'wb') as f:
+            for i, path in enumerate(paths):
+                noise, noise_sample_rate = load_audio_norm(path)
+                assert len(noise.shape) == 1
+                if noise_sample_rate != sample_rate:
+                    import librosa
+                    noise = librosa.resample(noise, orig_sr=noise_sample_rate, target_sr=sample_rate)
+                noise = np.ascontiguousarray(noise, dtype=np.float32)
+                f.write(noise.tobytes())
+                index[i] = (offset, len(noise))
+                offset += len(noise)
+        np.save(os.path.join(tmp_root, 'index.npy'), index)
+        try:
+            os.rename(tmp_root, root)
+        except OSError:
+            # built by another process in the meantime
+            shutil.rmtree(tmp_root)
+
+    @classmethod
+    def load_or_build(cls, root, paths, sample_rate):
+        if len(paths) == 0:
+            print('No noise files found, noise bank is not used')
+            return None
+        bank_root = os.path.join(root, noise_set_id(paths, sample_rate))
+        if not os.path.exists(os.path.join(bank_root, 'index.npy')):
+            print('Building a noise bank from {} files in {}'.format(len(paths), bank_root))
+            os.makedirs(root, exist_ok=True)
+            cls.build(bank_root, paths, sample_rate)
+        bank = cls(bank_root)
+        print('Noise bank with {} files, {:.1f} hours'.format(len(bank),
+                                                            bank.total / sample_rate / 3600))
+        return bank
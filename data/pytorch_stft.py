@@ -66,7 +66,11 @@ class STFT(torch.nn.Module):
         if window is not None:
             assert(win_length >= filter_length)
             # get window and zero center pad it to filter_length
-            fft_window = get_window(window, win_length, fftbins=True)
+            # callables are treated the same way as in librosa.stft
+            if callable(window):
+                fft_window = window(win_length)
+            else:
+                fft_window = get_window(window, win_length, fftbins=True)
             fft_window = pad_center(fft_window, filter_length)
             fft_window = torch.from_numpy(fft_window).float()
 
@@ -77,19 +81,26 @@ class STFT(torch.nn.Module):
         self.register_buffer('forward_basis', forward_basis.float())
         self.register_buffer('inverse_basis', inverse_basis.float())
 
-    def transform(self, input_data):
+    def transform(self, input_data, center=True):
+        """
+        PARAMS
+        ------
+        input_data: torch.FloatTensor with shape (B, T)
+        center: reflect-pad the input, pass False if the batch is already padded
+        """
         num_batches = input_data.size(0)
         num_samples = input_data.size(1)
 
         self.num_samples = num_samples
 
-        # similar to librosa, reflect-pad the input
         input_data = input_data.view(num_batches, 1, num_samples)
-        input_data = F.pad(
-            input_data.unsqueeze(1),
-            (int(self.filter_length / 2), int(self.filter_length / 2), 0, 0),
-            mode='reflect')
-        input_data = input_data.squeeze(1)
+        if center:
+            # similar to librosa, reflect-pad the input
+            input_data = F.pad(
+                input_data.unsqueeze(1),
+                (int(self.filter_length / 2), int(self.filter_length / 2), 0, 0),
+                mode='reflect')
+            input_data = input_data.squeeze(1)
 
         forward_transform = F.conv1d(
             input_data,
@@ -165,11 +176,12 @@ class MelSTFT(torch.nn.Module):
         output = dynamic_range_decompression(magnitudes)
         return output
 
-    def mel_spectrogram(self, y):
+    def mel_spectrogram(self, y, center=True):
         """Computes mel-spectrograms from a batch of waves
         PARAMS
         ------
         y: Variable(torch.FloatTensor) with shape (B, T) in range [-1, 1]
+        center: reflect-pad the input, pass False if the batch is already padded
 
         RETURNS
         -------
@@ -180,7 +192,7 @@ class MelSTFT(torch.nn.Module):
         # add clamping due to augs
         y = torch.clamp(y, -1, 1)
 
-        magnitudes, phases = self.stft_fn.transform(y)
+        magnitudes, phases = self.stft_fn.transform(y, center=center)
         magnitudes = magnitudes.data
         mel_output = torch.matmul(self.mel_basis, magnitudes)
         mel_output = self.spectral_normalize(mel_output)
@@ -0,0 +1,213 @@
+"""Sequential-read shard format for large manifests
+
+Packs a manifest (wav, txt, duration[, domain]) into large shard files with
+int16 PCM and transcript records, so that training reads a few big files
+instead of millions of small ones:
+
+    output_dir/
+        shard-00000.bin ...  # pcm int16 + utf8 transcript records
+        index.npy            # one record per manifest row, in manifest order
+        manifest.csv         # original manifest rows, used as dataset keys
+
+Usage:
+    python -m data.shards --manifest data/train.csv --output-dir data/train_shards
+"""
+import os
+import csv
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+from scipy.io import wavfile
+from torch.utils.data import IterableDataset, get_worker_info
+
+
+INDEX_DTYPE = np.dtype([('shard', '<i4'),
+                        ('pcm_offset', '<i8'),
+                        ('n_samples', '<i8'),
+                        ('sample_rate', '<i4'),
+                        ('text_offset', '<i8'),
+                        ('text_len', '<i4'),
+                        ('duration', '<f4')])
+
+SHARD_SIZE = 1024 ** 3
+
+
+def read_pcm16(wav_path, sample_rate):
+    """Reads a wav as mono int16 PCM, original int16 samples are kept intact"""
+    sr, sound = wavfile.read(wav_path)
+    if sound.ndim > 1 and sound.shape[1] == 1:
+        sound = sound[:, 0]
+    if sound.dtype == np.int16 and sound.ndim == 1 and sr == sample_rate:
+        return sound, sr
+    # same as load_audio_norm, then back to int16
+    abs_max = np.abs(sound).max()
+    sound = sound.astype('float32')
+    if abs_max > 0:
+        sound *= 1 / abs_max
+    if sound.ndim > 1:
+        sound = sound.mean(axis=1)
+    if sr != sample_rate:
+        import librosa
+        sound = librosa.resample(sound, orig_sr=sr, target_sr=sample_rate)
+        sr = sample_rate
+    return (np.clip(sound, -1, 1) * 32767).astype(np.int16), sr
+
+
+def _read_row(args):
+    row, sample_rate = args
+    pcm, sr = read_pcm16(row[0], sample_rate)
+    if row[1]:
+        with open(row[1], 'r', encoding='utf8') as f:
+            text = f.read()
+    else:
+        text = ''
+    return pcm, sr, text.encode('utf8')
+
+
+class ShardWriter(object):
+    def __init__(self, output_dir, shard_size=SHARD_SIZE):
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.shard_no = -1
+        self.f = None
+        self.records = []
+        os.makedirs(output_dir, exist_ok=True)
+
+    def _next_shard(self):
+        if self.f is not None:
+            self.f.close()
+        self.shard_no += 1
+        self.f = open(shard_path(self.output_dir, self.shard_no), 'wb')
+
+    def add(self, pcm, sample_rate, text, duration):
+        if self.f is None or self.f.tell() >= self.shard_size:
+            self._next_shard()
+        rec = np.zeros(1, dtype=INDEX_DTYPE)
+        rec['shard'] = self.shard_no
+        rec['pcm_offset'] = self.f.tell()
+        rec['n_samples'] = len(pcm)
+        rec['sample_rate'] = sample_rate
+        self.f.write(pcm.astype('<i2').tobytes())
+        rec['text_offset'] = self.f.tell()
+        rec['text_len'] = len(text)
+        rec['duration'] = duration
+        self.f.write(text)
+        self.records.append(rec)
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+        index = (np.concatenate(self.records) if self.records
+                 else np.zeros(0, dtype=INDEX_DTYPE))
+        np.save(os.path.join(self.output_dir, 'index.npy'), index)
+
+
+def shard_path(root, shard_no):
+    return os.path.join(root, 'shard-{:05d}.bin'.format(shard_no))
+
+
+def is_shard_dir(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'index.npy'))
+
+
+def pack_manifest(manifest_path, output_dir,
+                  sample_rate=16000,
+                  shard_size=SHARD_SIZE,
+                  num_workers=8):
+    with open(manifest_path, newline='') as f:
+        rows = [row for row in csv.reader(f)]
+    writer = ShardWriter(output_dir, shard_size=shard_size)
+    # ordered imap keeps the manifest order
+    # i.e. duration sorted manifests stay duration sorted in the shards
+    with Pool(num_workers) as pool:
+        it = pool.imap(_read_row, [(row, sample_rate) for row in rows], chunksize=16)
+        for i, (row, (pcm, sr, text)) in enumerate(zip(rows, it)):
+            writer.add(pcm, sr, text, float(row[2]))
+            if i % 10000 == 0:
+                print('Packed {:,} / {:,} utterances'.format(i, len(rows)))
+    writer.close()
+    with open(os.path.join(output_dir, 'manifest.csv'), 'w', newline='') as f:
+        csv.writer(f).writerows(rows)
+    print('Packed {:,} utterances into {} shards'.format(len(rows), writer.shard_no + 1))
+
+
+class ShardReader(object):
+    def __init__(self, root):
+        self.root = root
+        self.index = np.load(os.path.join(root, 'index.npy'), mmap_mode='r')
+        self._pid = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def _shard(self, shard_no):
+        # memmaps are re-opened lazily in each worker
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._mmaps = {}
+        if shard_no not in self._mmaps:
+            self._mmaps[shard_no] = np.memmap(shard_path(self.root, shard_no),
+                                              dtype=np.uint8, mode='r')
+        return self._mmaps[shard_no]
+
+    def read_pcm(self, row):
+        rec = self.index[row]
+        mm = self._shard(int(rec['shard']))
+        offset = int(rec['pcm_offset'])
+        pcm = mm[offset:offset + 2 * int(rec['n_samples'])].view('<i2')
+        return pcm, int(rec['sample_rate'])
+
+    def read_audio(self, row):
+        # same semantics as load_audio_norm
+        pcm, sample_rate = self.read_pcm(row)
+        abs_max = np.abs(pcm).max() if len(pcm) else 0
+        sound = pcm.astype('float32')
+        if abs_max > 0:
+            sound *= 1 / abs_max
+        return sound, sample_rate
+
+    def read_text(self, row):
+        rec = self.index[row]
+        mm = self._shard(int(rec['shard']))
+        offset = int(rec['text_offset'])
+        return mm[offset:offset + int(rec['text_len'])].tobytes().decode('utf8')
+
+
+class ShardedIterableDataset(IterableDataset):
+    """Iterable mode for a ShardedSpectrogramDataset
+
+    Yields whole batches of a ShardRangeSampler, loader worker w reads
+    the batches bins[w::num_workers], i.e. its own ranges of consecutive
+    shard rows, the loader then returns them in the order of the bins.
+    Use with batch_size=None, the collate function gets one batch at a time.
+    """
+    def __init__(self, dataset, sampler):
+        self.dataset = dataset
+        self.sampler = sampler
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def __iter__(self):
+        # the bins as of the start of the epoch, workers are forked per epoch
+        bins = self.sampler.bins
+        info = get_worker_info()
+        if info is not None:
+            bins = bins[info.id::info.num_workers]
+        for ids in bins:
+            yield [self.dataset[i] for i in ids]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Packs a manifest into sequential-read shards')
+    parser.add_argument('--manifest', required=True, help='Manifest csv: wav,txt,duration[,domain]')
+    parser.add_argument('--output-dir', required=True)
+    parser.add_argument('--sample-rate', default=16000, type=int)
+    parser.add_argument('--shard-size-mb', default=1024, type=int)
+    parser.add_argument('--num-workers', default=8, type=int)
+    args = parser.parse_args()
+    pack_manifest(args.manifest, args.output_dir,
+                  sample_rate=args.sample_rate,
+                  shard_size=args.shard_size_mb * 1024 ** 2,
+                  num_workers=args.num_workers)
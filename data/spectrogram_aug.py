@@ -1,5 +1,6 @@
 import random
 import cv2
+import torch
 import numpy as np
 import math
 cv2.setNumThreads(0)
@@ -115,6 +116,78 @@ class TimeMask:
                 spect[:, lower_band:higher_band] = 0
         return spect
 
+class BatchSCompose:
+    """Batched augs take a padded (B, 1, F, T) or (B, F, T) tensor,
+    valid lengths in frames and, optionally, a (B,) mask of rows to augment
+    """
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, x, lengths, rows=None):
+        for t in self.transforms:
+            x = t(x, lengths, rows)
+        return x
+
+
+class BatchSOneOf:
+    def __init__(self, transforms, prob=0.5):
+        self.transforms = transforms
+        self.prob = prob
+        # SOneOf forces the picked aug
+        for t in transforms:
+            t.prob = 1.
+
+    def __call__(self, x, lengths, rows=None):
+        fire = torch.rand(x.size(0), device=x.device) < self.prob
+        if rows is not None:
+            fire = fire & rows
+        choice = torch.randint(len(self.transforms), (x.size(0),), device=x.device)
+        for i, t in enumerate(self.transforms):
+            x = t(x, lengths, fire & (choice == i))
+        return x
+
+
+def band_mask(size, lower, upper, fire):
+    """(B, bands) bounds -> (B, size) mask, True inside any fired band"""
+    idx = torch.arange(size, device=lower.device).view(1, 1, -1)
+    inside = (idx >= lower.unsqueeze(2)) & (idx < upper.unsqueeze(2))
+    return (inside & fire.unsqueeze(2)).any(dim=1)
+
+
+class BatchFrequencyMask(FrequencyMask):
+    def __call__(self, x, lengths, rows=None):
+        batch_size, freqs = x.size(0), x.size(-2)
+        assert self.dropout_width < freqs
+        device = x.device
+        fire = torch.rand(batch_size, self.bands, device=device) < self.prob
+        if rows is not None:
+            fire = fire & rows.view(-1, 1)
+        band_width = torch.randint(int(self.dropout_width) + 1, (batch_size, self.bands), device=device)
+        band_center = torch.randint(freqs + 1, (batch_size, self.bands), device=device)
+        lower = (band_center - band_width // 2).clamp(min=0)
+        upper = (band_center + band_width // 2).clamp(max=freqs)
+        mask = band_mask(freqs, lower, upper, fire)
+        return x.masked_fill(mask.view(batch_size, *([1] * (x.dim() - 3)), freqs, 1), 0)
+
+
+class BatchTimeMask(TimeMask):
+    def __call__(self, x, lengths, rows=None):
+        batch_size, frames = x.size(0), x.size(-1)
+        device = x.device
+        lengths = lengths.to(device).long().view(-1, 1)
+        fire = torch.rand(batch_size, self.bands, device=device) < self.prob
+        if rows is not None:
+            fire = fire & rows.view(-1, 1)
+        band_width = torch.randint(int(self.dropout_length) + 1, (batch_size, self.bands), device=device)
+        # dropout should not be more than some % of each utterance
+        band_width = torch.min(band_width, (self.max_dropout_ratio * lengths.float()).long())
+        band_center = (torch.rand(batch_size, self.bands, device=device) * (lengths + 1).float()).long()
+        lower = (band_center - band_width // 2).clamp(min=0)
+        upper = torch.min(band_center + band_width // 2, lengths)
+        mask = band_mask(frames, lower, upper, fire)
+        return x.masked_fill(mask.view(batch_size, *([1] * (x.dim() - 2)), frames), 0)
+
+
 # TODO rewrite to be compatible with spectrograms
 class ShiftScale:
     def __init__(self,
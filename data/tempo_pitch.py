@@ -0,0 +1,106 @@
+"""Sox-free tempo / pitch perturbation on in-memory buffers
+
+- time stretch - WSOLA, offsets are searched frame by frame with one correlation,
+  the overlap-add is done for all frames at once
+- resampling - polyphase, ratios are approximated by small fractions
+  so that the FIR filters can be designed once and cached
+- pitch shift - time stretch + resampling back to the original length
+"""
+from fractions import Fraction
+
+import numpy as np
+from scipy.signal import firwin, resample_poly
+from numpy.lib.stride_tricks import as_strided
+
+
+MAX_DENOMINATOR = 32
+FRAME_LENGTH = 512
+TOLERANCE = 128
+
+_FILTERS = {}
+
+
+def approx_ratio(ratio):
+    return Fraction(ratio).limit_denominator(MAX_DENOMINATOR)
+
+
+def resample_filter(up, down):
+    # same filter as resample_poly designs on each call
+    if (up, down) not in _FILTERS:
+        max_rate = max(up, down)
+        _FILTERS[(up, down)] = firwin(2 * 10 * max_rate + 1, 1. / max_rate,
+                                      window=('kaiser', 5.0))
+    return _FILTERS[(up, down)]
+
+
+def resample_ratio(wav, ratio):
+    """Resamples to len(wav) * ratio samples, ratio is a Fraction"""
+    up, down = ratio.numerator, ratio.denominator
+    if up == down:
+        return wav
+    return resample_poly(wav, up, down,
+                         window=resample_filter(up, down)).astype(np.float32)
+
+
+def frames_view(x, length):
+    # all windows of `length` samples, no copy
+    return as_strided(x, shape=(len(x) - length + 1, length),
+                      strides=(x.strides[0], x.strides[0]), writeable=False)
+
+
+def time_stretch(wav, rate,
+                 frame_length=FRAME_LENGTH,
+                 tolerance=TOLERANCE):
+    """WSOLA time stretch, rate > 1 - faster / shorter, like librosa.effects.time_stretch"""
+    if rate == 1:
+        return wav
+    hop = frame_length // 2
+    n_out = int(round(len(wav) / rate))
+    n_frames = n_out // hop + 2
+    # half a frame of silence in front, so that the first samples
+    # are not faded in by the window
+    positions = np.round(np.arange(n_frames) * hop * rate).astype(np.int64)
+    x = np.zeros(hop + tolerance + positions[-1] + frame_length + tolerance + hop,
+                 dtype=np.float32)
+    x[hop + tolerance:hop + tolerance + len(wav)] = wav
+
+    # frame k should continue frame k - 1 naturally,
+    # i.e. look like the input right after the previous frame
+    offsets = np.zeros(n_frames, dtype=np.int64)
+    for k in range(1, n_frames):
+        prev = tolerance + positions[k - 1] + offsets[k - 1] + hop
+        template = x[prev:prev + frame_length]
+        candidates = x[positions[k]:positions[k] + frame_length + 2 * tolerance]
+        offsets[k] = np.argmax(np.correlate(candidates, template, mode='valid')) - tolerance
+
+    # periodic hann, sums to 1 with 50% overlap
+    window = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(frame_length) / frame_length)).astype(np.float32)
+    starts = tolerance + positions + offsets
+    frames = frames_view(x, frame_length)[starts] * window
+    out = np.zeros((n_frames + 1) * hop, dtype=np.float32).reshape(-1, hop)
+    out[:-1] += frames[:, :hop]
+    out[1:] += frames[:, hop:]
+    return out.reshape(-1)[hop:hop + n_out]
+
+
+def fix_length(wav, length):
+    if len(wav) >= length:
+        return wav[:length]
+    return np.pad(wav, (0, length - len(wav)), mode='constant')
+
+
+def pitch_shift(wav, n_steps):
+    """Shifts pitch by n_steps semitones, keeps the duration"""
+    # stretch 2 ** (n_steps / 12) times, then resample back
+    ratio = approx_ratio(2.0 ** (-n_steps / 12))
+    if ratio == 1:
+        return wav
+    stretched = time_stretch(wav, float(ratio))
+    return fix_length(resample_ratio(stretched, ratio), len(wav))
+
+
+def tempo_pitch(wav, tempo, n_cents):
+    """sox `pitch n_cents tempo tempo` in one stretch and one resampling"""
+    ratio = approx_ratio(2.0 ** (-n_cents / 1200))
+    stretched = time_stretch(wav, tempo * float(ratio))
+    return resample_ratio(stretched, ratio)
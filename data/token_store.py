@@ -0,0 +1,136 @@
+"""Precomputed transcript tokens
+
+One tokenization pass over all the transcripts of a manifest,
+workers then only slice memory-mapped arrays:
+
+    root/<labels fingerprint>/<transcript set id, paths + sizes + mtimes>/
+        keys.npy         # sorted (key, check) transcript path hashes
+        offsets-0.npy    # token spans, aligned with keys
+        tokens-0.npy     # int16 / int32 tokens
+        offsets-1.npy    # double supervision, s2s targets
+        tokens-1.npy
+"""
+import os
+import json
+import hashlib
+from multiprocessing import Pool
+
+import numpy as np
+
+
+KEY_DTYPE = np.dtype([('key', '<u8'),
+                      ('check', '<u4')])
+
+
+def make_fingerprint(conf):
+    return hashlib.blake2b(json.dumps(conf, sort_keys=True, default=str).encode('utf8'),
+                           digest_size=8).hexdigest()
+
+
+def file_digest(path):
+    # tokenizer models are small, hash the contents
+    if not path or not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=8).hexdigest()
+
+
+def file_stat(path):
+    # i.e. transcripts packed into shards only
+    try:
+        st = os.stat(path)
+    except OSError:
+        return -1, -1
+    return st.st_size, st.st_mtime_ns
+
+
+def path_key(path):
+    h = hashlib.blake2b(path.encode('utf8'), digest_size=12).digest()
+    return (int.from_bytes(h[:8], 'little'),
+            int.from_bytes(h[8:], 'little'))
+
+
+# set before forking the pool, bound methods of datasets are too heavy to pickle
+_TOKENIZE = None
+
+
+def _tokenize(path):
+    return _TOKENIZE(path)
+
+
+class TokenStore(object):
+    def __init__(self, root):
+        self.root = root
+        self.keys = np.load(os.path.join(root, 'keys.npy'), mmap_mode='r')
+        self.streams = []
+        i = 0
+        while os.path.exists(os.path.join(root, 'tokens-{}.npy'.format(i))):
+            self.streams.append((np.load(os.path.join(root, 'offsets-{}.npy'.format(i)), mmap_mode='r'),
+                                 np.load(os.path.join(root, 'tokens-{}.npy'.format(i)), mmap_mode='r')))
+            i += 1
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, path):
+        """int32 label array (a tuple of them for double supervision) or None"""
+        key, check = path_key(path)
+        i = int(np.searchsorted(self.keys['key'], np.uint64(key)))
+        while i < len(self.keys) and self.keys['key'][i] == key:
+            if self.keys['check'][i] == check:
+                out = tuple(np.array(tokens[offsets[i]:offsets[i + 1]], dtype=np.int32)
+                            for offsets, tokens in self.streams)
+                return out[0] if len(out) == 1 else out
+            i += 1
+        return None
+
+    @staticmethod
+    def build(root, paths, tokenize, num_workers=0):
+        """tokenize(path) -> label array or a tuple of label arrays"""
+        global _TOKENIZE
+        paths = sorted(set(paths))
+        keys = np.array([path_key(path) for path in paths], dtype=KEY_DTYPE)
+        order = np.argsort(keys['key'], kind='stable')
+        keys = keys[order]
+        paths = [paths[i] for i in order]
+
+        if num_workers > 0:
+            _TOKENIZE = tokenize
+            with Pool(num_workers) as pool:
+                labels = list(pool.imap(_tokenize, paths, chunksize=256))
+            _TOKENIZE = None
+        else:
+            labels = [tokenize(path) for path in paths]
+        labels = [ts if isinstance(ts, tuple) else (ts,) for ts in labels]
+
+        os.makedirs(root, exist_ok=True)
+        files = {'keys.npy': keys}
+        for i in range(len(labels[0]) if labels else 1):
+            stream = [ts[i] for ts in labels]
+            offsets = np.zeros(len(stream) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(ts) for ts in stream])
+            tokens = (np.concatenate(stream) if stream
+                      else np.zeros(0, dtype=np.int32))
+            if len(tokens) == 0 or tokens.max() < np.iinfo(np.int16).max:
+                tokens = tokens.astype(np.int16)
+            files['offsets-{}.npy'.format(i)] = offsets
+            files['tokens-{}.npy'.format(i)] = tokens
+        # keys go last, the store is complete once they are in place
+        for fn in sorted(files, key=lambda fn: fn == 'keys.npy'):
+            tmp = os.path.join(root, fn + '.{}.tmp'.format(os.getpid()))
+            with open(tmp, 'wb') as f:
+                np.save(f, files[fn])
+            os.replace(tmp, os.path.join(root, fn))
+
+    @classmethod
+    def load_or_build(cls, root, fingerprint, paths, tokenize, num_workers=0):
+        paths = sorted(set(paths))
+        # transcripts edited in place get a new store
+        paths_id = hashlib.blake2b('\n'.join('{}\t{}\t{}'.format(path, *file_stat(path))
+                                             for path in paths).encode('utf8'),
+                                   digest_size=8).hexdigest()
+        store_root = os.path.join(root, fingerprint, paths_id)
+        if not os.path.exists(os.path.join(store_root, 'keys.npy')):
+            print('Tokenizing {:,} transcripts into {}'.format(len(paths), store_root))
+            cls.build(store_root, paths, tokenize, num_workers=num_workers)
+        return cls(store_root)
@@ -3,28 +3,145 @@ from __future__ import print_function
 import fnmatch
 import io
 import os
+import struct
+from multiprocessing import Pool
 from tqdm import tqdm
-import subprocess
+import torch
 import torch.distributed as dist
 
 
-def create_manifest(data_path, output_path, min_duration=None, max_duration=None):
+def create_manifest(data_path, output_path, min_duration=None, max_duration=None,
+                    num_workers=None):
     file_paths = [os.path.join(dirpath, f)
                   for dirpath, dirnames, files in os.walk(data_path)
                   for f in fnmatch.filter(files, '*.wav')]
-    file_paths = order_and_prune_files(file_paths, min_duration, max_duration)
+    file_paths, durations = order_and_prune_files(file_paths, min_duration, max_duration,
+                                                  num_workers=num_workers,
+                                                  cache_path=output_path + '.durations',
+                                                  return_durations=True)
     with io.FileIO(output_path, "w") as file:
-        for wav_path in tqdm(file_paths, total=len(file_paths)):
+        for wav_path, duration in tqdm(zip(file_paths, durations), total=len(file_paths)):
             transcript_path = wav_path.replace('/wav/', '/txt/').replace('.wav', '.txt')
-            sample = os.path.abspath(wav_path) + ',' + os.path.abspath(transcript_path) + '\n'
+            sample = '{},{},{:.3f}\n'.format(os.path.abspath(wav_path),
+                                              os.path.abspath(transcript_path),
+                                              duration)
             file.write(sample.encode('utf-8'))
     print('\n')
 
 
-def order_and_prune_files(file_paths, min_duration, max_duration):
+def wav_duration(path):
+    """Duration from the RIFF header, None if it is not a plain wav file"""
+    with open(path, 'rb') as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            return None
+        byte_rate = None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                return None
+            chunk_id, chunk_size = chunk[:4], struct.unpack('<I', chunk[4:])[0]
+            if chunk_id == b'fmt ':
+                fmt = f.read(chunk_size + chunk_size % 2)
+                byte_rate = struct.unpack('<I', fmt[8:12])[0]
+            elif chunk_id == b'data':
+                if not byte_rate:
+                    return None
+                data_size = os.fstat(f.fileno()).st_size - f.tell()
+                # streamed wavs have 0 / 0xFFFFFFFF sizes, take the rest of the file
+                if 0 < chunk_size < 0xFFFFFFFF:
+                    data_size = min(chunk_size, data_size)
+                return data_size / byte_rate
+            else:
+                # chunks are word aligned
+                f.seek(chunk_size + chunk_size % 2, 1)
+
+
+def probe_duration(path):
+    """Duration in seconds w/o decoding the audio, None if it cannot be read"""
+    try:
+        duration = wav_duration(path)
+        if duration is not None:
+            return duration
+        # other formats / compressed wavs
+        try:
+            import soundfile as sf
+            return sf.info(path).duration
+        except ImportError:
+            import librosa
+            y, sr = librosa.load(path, sr=None)
+            return len(y) / sr
+    except Exception as e:
+        print('Cannot read {}: {}'.format(path, str(e)))
+        return None
+
+
+def _stat_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def load_duration_index(cache_path):
+    """path -> (size, mtime_ns, duration)"""
+    index = {}
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            for line in f:
+                parts = line.rstrip('\n').split('\t')
+                if len(parts) == 4:
+                    index[parts[0]] = (int(parts[1]), int(parts[2]), float(parts[3]))
+    return index
+
+
+def probe_durations(file_paths, num_workers=None, cache_path=None):
+    """
+    Durations of many files, probed in a process pool
+    Results are appended to a sidecar index keyed by path / size / mtime,
+    so unchanged files are never probed again
+    """
+    index = load_duration_index(cache_path)
+    durations = [None] * len(file_paths)
+    missing = []
+    for i, path in enumerate(file_paths):
+        key = _stat_key(path)
+        cached = index.get(path)
+        if key is not None and cached is not None and cached[:2] == key:
+            durations[i] = cached[2]
+        elif key is not None:
+            missing.append((i, key))
+    if missing:
+        print('Probing durations of {} files, {} cached'.format(len(missing),
+                                                               len(file_paths) - len(missing)))
+        paths = [file_paths[i] for i, _ in missing]
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        if num_workers > 1:
+            with Pool(num_workers) as pool:
+                probed = list(tqdm(pool.imap(probe_duration, paths, chunksize=256),
+                                   total=len(paths)))
+        else:
+            probed = [probe_duration(path) for path in tqdm(paths)]
+        new_lines = []
+        for (i, key), duration in zip(missing, probed):
+            durations[i] = duration
+            if duration is not None:
+                new_lines.append('{}\t{}\t{}\t{!r}\n'.format(file_paths[i], key[0], key[1], duration))
+        if cache_path:
+            with open(cache_path, 'a') as f:
+                f.writelines(new_lines)
+    return durations
+
+
+def order_and_prune_files(file_paths, min_duration, max_duration,
+                          num_workers=None, cache_path=None,
+                          return_durations=False):
     print("Sorting manifests...")
-    duration_file_paths = [(path, float(subprocess.check_output(
-        ['soxi -D \"%s\"' % path.strip()], shell=True))) for path in file_paths]
+    durations = probe_durations(file_paths, num_workers=num_workers, cache_path=cache_path)
+    duration_file_paths = [(path, duration) for path, duration in zip(file_paths, durations)
+                           if duration is not None]
     if min_duration and max_duration:
         print("Pruning manifests between %d and %d seconds" % (min_duration, max_duration))
         duration_file_paths = [(path, duration) for path, duration in duration_file_paths if
@@ -34,6 +151,8 @@ def order_and_prune_files(file_paths, min_duration, max_duration):
         return element[1]
 
     duration_file_paths.sort(key=func)
+    if return_durations:
+        return [x[0] for x in duration_file_paths], [x[1] for x in duration_file_paths]
     return [x[0] for x in duration_file_paths]  # Remove durations
 
 
@@ -44,6 +163,38 @@ def reduce_tensor(tensor, world_size):
     return rt
 
 
+class StepSkew(object):
+    """Compute time of the training steps on each rank
+    The slowest rank makes all the others wait at the all-reduce,
+    so the per rank means are gathered and logged every `every` steps
+    """
+    def __init__(self, world_size, device, every=100, verbose=True):
+        self.world_size = world_size
+        self.device = device
+        self.every = every
+        self.verbose = verbose
+        self.total = 0.
+        self.steps = 0
+
+    def update(self, seconds):
+        self.total += seconds
+        self.steps += 1
+        if self.steps == self.every:
+            self.report()
+
+    def report(self):
+        mean = torch.tensor([self.total / self.steps], device=self.device)
+        gathered = [torch.zeros_like(mean) for _ in range(self.world_size)]
+        dist.all_gather(gathered, mean)
+        times = torch.cat(gathered).cpu().numpy() * 1000
+        if self.verbose:
+            print('Step compute time per rank, ms: {}\t'
+                  'slowest / mean {:.3f}'.format(' '.join('{:.0f}'.format(t) for t in times),
+                                                 times.max() / times.mean()))
+        self.total = 0.
+        self.steps = 0
+
+
 def get_cer_wer(decoder, transcript, reference):
     reference = reference.strip()
     transcript = transcript.strip()
@@ -3,7 +3,6 @@ import torch
 import torch.nn as nn
 from functools import reduce
 import torch.nn.functional as F
-from torch.autograd import Variable
 from torch.nn.functional import glu
 from collections import OrderedDict
 from torch.nn.parameter import Parameter
@@ -75,6 +74,9 @@ class SequenceWise(nn.Module):
 
 
 class MaskConv(nn.Module):
+    # elementwise modules mapping 0 to 0, a masked input stays masked
+    POINTWISE = (nn.Hardtanh, nn.ReLU, nn.Dropout)
+
     def __init__(self, seq_module):
         """
         Adds padding to the output of the module based on the given lengths. This is to ensure that the
@@ -85,22 +87,41 @@ class MaskConv(nn.Module):
         super(MaskConv, self).__init__()
         self.seq_module = seq_module
 
+    @staticmethod
+    def conv_lengths(module, lengths):
+        if isinstance(module, nn.Conv2d):
+            return ((lengths + 2 * module.padding[1] - module.dilation[1] * (module.kernel_size[1] - 1) - 1)
+                    // module.stride[1] + 1)
+        return lengths
+
+    def is_pointwise(self, module):
+        # batch norm uses batch stats in training, i.e. it reads the padding
+        return (isinstance(module, self.POINTWISE)
+                or (isinstance(module, nn.BatchNorm2d) and not self.training))
+
+    def needs_mask(self, i):
+        # padding has to be zeroed only before modules mixing time steps / reading stats
+        # and at the end, i.e. masking before a pointwise module is deferred
+        modules = self.seq_module
+        return i == len(modules) - 1 or not self.is_pointwise(modules[i + 1])
+
     def forward(self, x, lengths):
         """
         :param x: The input of size BxCxDxT
-        :param lengths: The actual length of each sequence in the batch
-        :return: Masked output from the module
+        :param lengths: The actual length of each input sequence in the batch
+        :return: Masked output from the module and the output lengths
         """
-        for module in self.seq_module:
+        lengths = lengths.to(device=x.device, dtype=torch.long)
+        mask = None
+        for i, module in enumerate(self.seq_module):
             x = module(x)
-            mask = torch.ByteTensor(x.size()).fill_(0)
-            if x.is_cuda:
-                mask = mask.cuda()
-            for i, length in enumerate(lengths):
-                length = length.item()
-                if (mask[i].size(2) - length) > 0:
-                    mask[i].narrow(2, length, mask[i].size(2) - length).fill_(1)
-            x = x.masked_fill(mask, 0)
+            if isinstance(module, nn.Conv2d) or mask is None:
+                # lengths only change in convs, one mask per conv
+                lengths = self.conv_lengths(module, lengths)
+                mask = (torch.arange(x.size(3), device=x.device).unsqueeze(0)
+                        >= lengths.unsqueeze(1)).view(x.size(0), 1, 1, x.size(3))
+            if self.needs_mask(i):
+                x = x.masked_fill(mask, 0)
         return x, lengths
 
 
@@ -129,7 +150,6 @@ class BatchRNN(nn.Module):
         self.rnn.flatten_parameters()
 
     def forward(self, x, output_lengths=None):
-        assert x.is_cuda
         if output_lengths is not None:
             # legacy case
             max_seq_length = x.size(0)
@@ -206,21 +226,36 @@ class Lookahead(nn.Module):
         stdv = 1. / math.sqrt(self.weight.size(1))
         self.weight.data.uniform_(-stdv, stdv)
 
+    def lookahead(self, input, pad):
+        # a depthwise conv over time, each feature has its own (context + 1) filter
+        x = input.permute(1, 2, 0)  # NxHxT
+        if pad:
+            # zeroes for the last context frames
+            x = F.pad(x, (0, self.context))
+        x = F.conv1d(x, self.weight.unsqueeze(1), groups=self.n_features)
+        return x.permute(2, 0, 1)  # TxNxH
+
     def forward(self, input):
-        seq_len = input.size(0)
-        # pad the 0th dimension (T/sequence) with zeroes whose number = context
-        # Once pytorch's padding functions have settled, should move to those.
-        padding = torch.zeros(self.context, *(input.size()[1:])).type_as(input.data)
-        x = torch.cat((input, Variable(padding)), 0)
-
-        # add lookahead windows (with context+1 width) as a fourth dimension
-        # for each seq-batch-feature combination
-        x = [x[i:i + self.context + 1] for i in range(seq_len)]  # TxLxNxH - sequence, context, batch, feature
-        x = torch.stack(x)
-        x = x.permute(0, 2, 3, 1)  # TxNxHxL - sequence, batch, feature, context
-
-        x = torch.mul(x, self.weight).sum(dim=3)
-        return x
+        return self.lookahead(input, pad=True)
+
+    def stream(self, input, buffer=None):
+        """
+        Streaming forward, input comes in chunks of frames (TxNxH)
+        :param buffer: the last (up to) context input frames still waiting for their right context
+        :return: output frames whose context is complete, the new buffer
+        Call flush(buffer) at the end of the stream for the last frames
+        """
+        x = input if buffer is None else torch.cat((buffer, input), 0)
+        if x.size(0) <= self.context:
+            return x.new_zeros(0, *x.size()[1:]), x
+        # x[-0:] would be the whole chunk
+        return self.lookahead(x, pad=False), x[x.size(0) - self.context:]
+
+    def flush(self, buffer):
+        # nothing was streamed / nothing is left
+        if buffer is None or buffer.size(0) == 0:
+            return buffer
+        return self.lookahead(buffer, pad=True)
 
     def __repr__(self):
         return self.__class__.__name__ + '(' \
@@ -228,6 +263,36 @@ class Lookahead(nn.Module):
                + ', context=' + str(self.context) + ')'
 
 
+def output_lengths(lengths, chain):
+    """
+    Output lengths of a model w/o building it, exact integer math
+    :param lengths: input lengths in frames - an int, a numpy array or a tensor
+    :param chain: DeepSpeech.length_chain, also saved in the model package
+    """
+    for kernel, stride, padding, dilation in chain:
+        lengths = (lengths + 2 * padding - dilation * (kernel - 1) - 1) // stride + 1
+    return lengths
+
+
+def inference_mode():
+    # no autograd bookkeeping at all, no_grad on older pytorch
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
+def prepare_inference(model, device, cpu_threads=0):
+    """
+    Eval mode on the device
+    :param cpu_threads: intra-op threads for CPU inference, 0 - pytorch default
+    """
+    if device.type == 'cpu' and cpu_threads > 0:
+        torch.set_num_threads(cpu_threads)
+    model = model.to(device)
+    model.eval()
+    return model
+
+
 DEBUG = 0
 
 
@@ -912,6 +977,9 @@ class DeepSpeech(nn.Module):
                 SequenceWise(fully_connected),
             )
 
+        # output lengths are a fixed function of the topology
+        self.length_chain = self.get_length_chain()
+
     def forward(self, x, lengths=None,
                 trg=None):
         # assert x.is_cuda
@@ -922,7 +990,7 @@ class DeepSpeech(nn.Module):
             output_lengths = self.get_seq_lens(lengths)
             print('Projected output lengths {}'.format(output_lengths))
         else:
-            output_lengths = self.get_seq_lens(lengths).cuda()
+            output_lengths = self.get_seq_lens(lengths).to(x.device)
 
         if self._rnn_type in ['cnn', 'glu_small', 'glu_large', 'large_cnn',
                               'cnn_residual', 'cnn_jasper', 'cnn_jasper_2',
@@ -964,7 +1032,7 @@ class DeepSpeech(nn.Module):
             x = x.transpose(1, 2).transpose(0, 1).contiguous()
         else:
             # x = self.dropout1(x)
-            x, _ = self.conv(x, output_lengths)
+            x, _ = self.conv(x, lengths)
             # x = self.dropout2(x)
             if DEBUG: assert x.is_cuda
             # x = x.to('cuda')
@@ -1001,14 +1069,14 @@ class DeepSpeech(nn.Module):
             else:
                 return x, outs, output_lengths
 
-    def get_seq_lens(self, input_length):
+    def get_length_chain(self):
         """
-        Given a 1D Tensor or Variable containing integer sequence lengths, return a 1D tensor or variable
-        containing the size sequences that will be output by the network.
-        :param input_length: 1D Tensor
-        :return: 1D Tensor scaled by model
+        (kernel, stride, padding, dilation) of the convs changing the sequence length, in order
+        Walks the modules once, see output_lengths
         """
-        seq_len = input_length
+        def conv_params(m, dim):
+            return (m.kernel_size[dim], m.stride[dim], m.padding[dim], m.dilation[dim])
+
         if self._rnn_type in ['cnn_residual_repeat_sep_bpe',
                               'cnn_residual_repeat_sep_down8',
                               'cnn_inv_bottleneck_repeat_sep_down8',
@@ -1023,23 +1091,33 @@ class DeepSpeech(nn.Module):
                               'cnn_residual_repeat_sep_down8_groups16_transformer_variable',
                               'cnn_residual_repeat_sep_down8_groups8_plain_gru_selu_nosc_nobn',
                               'cnn_residual_repeat_sep_down8_groups8_plain_gru_selu_nobn']:
-            for m in self.rnns.modules():
-                if type(m) == nn.modules.conv.Conv1d:
-                    seq_len = ((seq_len + 2 * m.padding[0] - m.dilation[0] * (m.kernel_size[0] - 1) - 1) / m.stride[0] + 1)
+            chain = [conv_params(m, 0) for m in self.rnns.modules()
+                     if type(m) == nn.modules.conv.Conv1d]
         elif self._rnn_type in ['cnn_residual_repeat_sep_down8_denoise']:
-            for m in self.rnns.encoder.modules():
-                if type(m) == nn.modules.conv.Conv1d:
-                    seq_len = ((seq_len + 2 * m.padding[0] - m.dilation[0] * (m.kernel_size[0] - 1) - 1) / m.stride[0] + 1)
+            chain = [conv_params(m, 0) for m in self.rnns.encoder.modules()
+                     if type(m) == nn.modules.conv.Conv1d]
         elif self._rnn_type not in ['tds']:
-            for m in self.conv.modules():
-                if type(m) == nn.modules.conv.Conv2d:
-                    seq_len = ((seq_len + 2 * m.padding[1] - m.dilation[1] * (m.kernel_size[1] - 1) - 1) / m.stride[1] + 1)
+            chain = [conv_params(m, 1) for m in self.conv.modules()
+                     if type(m) == nn.modules.conv.Conv2d]
         elif self._rnn_type == 'tds':
             # all convolutions are forced to be same
-            seq_len = (seq_len + 0.01) // reduce(lambda x, y: x*y, self.rnns.strides)
+            # floor(L / stride) is a kernel = stride conv w/o padding
+            stride = reduce(lambda x, y: x*y, self.rnns.strides)
+            chain = [(stride, stride, 0, 1)]
         else:
             raise NotImplementedError()
-        return seq_len.int()
+        # drop the convs that keep the length
+        return [c for c in chain
+                if c[1] != 1 or 2 * c[2] != c[3] * (c[0] - 1)]
+
+    def get_seq_lens(self, input_length):
+        """
+        Given a 1D Tensor or Variable containing integer sequence lengths, return a 1D tensor or variable
+        containing the size sequences that will be output by the network.
+        :param input_length: 1D Tensor
+        :return: 1D Tensor scaled by model
+        """
+        return output_lengths(input_length.long(), self.length_chain).int()
 
     @classmethod
     def load_model(cls, path):
@@ -1108,6 +1186,7 @@ class DeepSpeech(nn.Module):
         })
         model.rnns.denoise = LinkNetDenoising(filters=[161]+[cnn_width]*3)
         del model.rnns.layers
+        model.length_chain = model.get_length_chain()
 
         if True:
             for block in [model.rnns.encoder]:
@@ -1141,13 +1220,15 @@ class DeepSpeech(nn.Module):
                                      num_layers=decoder_layers,
                                      dropout=dropout,
                                      sos_index=num_classes-2)
+        model.length_chain = model.get_length_chain()
         return model
 
     @staticmethod
     def serialize(model, optimizer=None, epoch=None, iteration=None, loss_results=None, checkpoint=None,
                   cer_results=None, wer_results=None, avg_loss=None, meta=None,
                   checkpoint_cer_results=None, checkpoint_wer_results=None, checkpoint_loss_results=None,
-                  trainval_checkpoint_loss_results=None, trainval_checkpoint_cer_results=None, trainval_checkpoint_wer_results=None):
+                  trainval_checkpoint_loss_results=None, trainval_checkpoint_cer_results=None, trainval_checkpoint_wer_results=None,
+                  sampler_state=None, rng_state=None):
         model = model.module if DeepSpeech.is_parallel(model) else model
         package = {
             'version': model._version,
@@ -1164,6 +1245,8 @@ class DeepSpeech(nn.Module):
             'decoder_layers': model._decoder_layers,
             'kernel_size': model._kernel_size,
             'decoder_girth': model._decoder_girth,
+            # to predict output lengths w/o the model, see output_lengths
+            'length_chain': model.length_chain,
         }
         if hasattr(model, '_phoneme_count'):
             package['phoneme_count'] = model._phoneme_count
@@ -1190,6 +1273,11 @@ class DeepSpeech(nn.Module):
             package['trainval_checkpoint_wer_results'] = trainval_checkpoint_wer_results
         if meta is not None:
             package['meta'] = meta
+        # exact mid-epoch resume
+        if sampler_state is not None:
+            package['sampler_state'] = sampler_state
+        if rng_state is not None:
+            package['rng_state'] = rng_state
         return package
 
     @staticmethod
@@ -1346,7 +1434,7 @@ class ResidualRepeatWav2Letter(nn.Module):
         padding = kernel_size // 2
         se_ratio = config.se_ratio
         skip = config.skip
-        decoder_girth = config.decoder_girth
+        decoder_girth = config.decoder_girth if 'decoder_girth' in config else 1
 
         self.denoise = config.denoise if 'denoise' in config else False
         self.groups = config.groups if 'groups' in config else 1
@@ -6,7 +6,7 @@ from flask import Flask, request, jsonify
 import logging
 from data.data_loader import SpectrogramParser
 from decoder import GreedyDecoder
-from model import DeepSpeech
+from model import DeepSpeech, prepare_inference
 from opts import add_decoder_args, add_inference_args
 from transcribe import transcribe
 
@@ -32,7 +32,7 @@ def transcribe_file():
         with NamedTemporaryFile(suffix=file_extension) as tmp_saved_audio_file:
             file.save(tmp_saved_audio_file.name)
             logging.info('Transcribing file...')
-            transcription, _ = transcribe(tmp_saved_audio_file.name, spect_parser, model, decoder, args.cuda)
+            transcription, _ = transcribe(tmp_saved_audio_file.name, spect_parser, model, decoder, device)
             logging.info('File transcribed')
             res['status'] = "OK"
             res['transcription'] = transcription
@@ -41,7 +41,7 @@ def transcribe_file():
 
 def main():
     import argparse
-    global model, spect_parser, decoder, args
+    global model, spect_parser, decoder, args, device
     parser = argparse.ArgumentParser(description='DeepSpeech transcription server')
     parser.add_argument('--host', type=str, default='0.0.0.0', help='Host to be used by the server')
     parser.add_argument('--port', type=int, default=8888, help='Port to be used by the server')
@@ -53,9 +53,8 @@ def main():
     logging.info('Setting up server...')
     torch.set_grad_enabled(False)
     model = DeepSpeech.load_model(args.model_path)
-    if args.cuda:
-        model.cuda()
-    model.eval()
+    device = torch.device("cuda" if args.cuda else "cpu")
+    model = prepare_inference(model, device, args.cpu_threads)
 
     labels = DeepSpeech.get_labels(model)
     audio_conf = DeepSpeech.get_audio_conf(model)
@@ -0,0 +1,240 @@
+"""Chunked streaming inference for the CNN (ResidualRepeatWav2Letter) models
+
+Each Conv1d keeps the input frames it still needs as its left context,
+i.e. a chunk of spectrogram frames only runs through the new outputs
+and CTC posteriors are emitted as soon as their right context has arrived:
+
+    executor = StreamingExecutor(model)
+    for chunk in spect.split(100, dim=-1):
+        probs = executor.push(chunk)  # N x T' x C or None
+    probs = executor.flush()
+
+Zero padding at the start / end of the utterance is the same as in the offline pass,
+so the posteriors are identical to model(spect, lengths) for models w/o SCSE layers.
+SCSE pools over the whole utterance, so there the average of the frames seen so far
+is used instead, the only part that is not exact.
+The spectrogram has to be normalized beforehand, normalization is per utterance too.
+"""
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from model import (Conv1dSamePadding,
+                   ResCNNRepeatBlock,
+                   ResidualRepeatWav2Letter,
+                   SCSE,
+                   SeparableRepeatBlock,
+                   inference_mode,
+                   relu_fn)
+
+# modules applied to each frame on its own, in eval mode
+POINTWISE = (nn.BatchNorm1d, nn.ReLU, nn.ReLU6, nn.Hardtanh, nn.ELU, nn.SELU,
+             nn.LeakyReLU, nn.Sigmoid, nn.Tanh, nn.Dropout, nn.Identity)
+
+
+def cat(a, b):
+    # None - no frames
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return torch.cat((a, b), dim=-1)
+
+
+class StreamConv(object):
+    def __init__(self, conv):
+        self.conv = conv
+        self.stride = conv.stride if isinstance(conv.stride, int) else conv.stride[0]
+        self.dilation = conv.dilation[0]
+        kernel_size = conv.kernel_size[0]
+        if isinstance(conv, Conv1dSamePadding):
+            # same padding depends on the length unless it is a pointwise conv
+            if kernel_size != 1 or self.stride != 1:
+                raise NotImplementedError('Only 1x1 Conv1dSamePadding can be streamed')
+            self.padding = 0
+        else:
+            self.padding = conv.padding[0]
+        self.span = self.dilation * (kernel_size - 1) + 1
+        self.right_context = self.span - 1 - self.padding
+        self.reset()
+
+    def reset(self):
+        # input frames from the first frame of the next output on
+        self.buffer = None
+
+    def push(self, x):
+        if x is None:
+            return None
+        if self.buffer is None:
+            # zero padding in front, like in the offline pass
+            x = F.pad(x, (self.padding, 0))
+        else:
+            x = torch.cat((self.buffer, x), dim=-1)
+        n = (x.size(-1) - self.span) // self.stride + 1 if x.size(-1) >= self.span else 0
+        # the rest waits for its right context
+        self.buffer = x[..., n * self.stride:]
+        if n == 0:
+            return None
+        return F.conv1d(x[..., :(n - 1) * self.stride + self.span],
+                        self.conv.weight, self.conv.bias,
+                        stride=self.stride, dilation=self.dilation, groups=self.conv.groups)
+
+    def flush(self):
+        if self.buffer is None:
+            return None
+        # zero padding at the end
+        return self.push(self.buffer.new_zeros(*self.buffer.size()[:-1], self.padding))
+
+
+class StreamPointwise(object):
+    right_context = 0
+
+    def __init__(self, module):
+        self.module = module
+
+    def reset(self):
+        pass
+
+    def push(self, x):
+        return None if x is None else self.module(x)
+
+    def flush(self):
+        return None
+
+
+class StreamSCSE(object):
+    """Squeeze and excitation by the average of all the frames so far"""
+    right_context = 0
+
+    def __init__(self, scse):
+        self.scse = scse
+        self.reset()
+
+    def reset(self):
+        self.total = None
+        self.count = 0
+
+    def push(self, x):
+        if x is None:
+            return None
+        total = x.sum(dim=-1, keepdim=True)
+        self.total = total if self.total is None else self.total + total
+        self.count += x.size(-1)
+        x_squeezed = self.scse._se_expand(relu_fn(self.scse._se_reduce(self.total / self.count)))
+        return torch.sigmoid(x_squeezed) * x
+
+    def flush(self):
+        return None
+
+
+class StreamSkip(object):
+    """x + layers(x), inputs wait for the outputs of the layers"""
+    def __init__(self, layers):
+        self.layers = layers
+        self.right_context = layers.right_context
+        self.reset()
+
+    def reset(self):
+        self.layers.reset()
+        self.inputs = None
+
+    def add(self, y):
+        if y is None:
+            return None
+        n = y.size(-1)
+        y = y + self.inputs[..., :n]
+        self.inputs = self.inputs[..., n:]
+        return y
+
+    def push(self, x):
+        self.inputs = cat(self.inputs, x)
+        return self.add(self.layers.push(x))
+
+    def flush(self):
+        return self.add(self.layers.flush())
+
+
+class StreamSequential(object):
+    def __init__(self, modules):
+        self.modules = modules
+        # in input frames
+        self.right_context, stride = 0, 1
+        for m in modules:
+            self.right_context += m.right_context * stride
+            stride *= getattr(m, 'stride', 1)
+        self.stride = stride
+
+    def reset(self):
+        for m in self.modules:
+            m.reset()
+
+    def push(self, x):
+        for m in self.modules:
+            x = m.push(x)
+        return x
+
+    def flush(self):
+        # the frames flushed by each module still go through the following ones
+        x = None
+        for m in self.modules:
+            x = cat(m.push(x), m.flush())
+        return x
+
+
+def build_stream(module):
+    if isinstance(module, nn.Conv1d):
+        return StreamConv(module)
+    if isinstance(module, (ResCNNRepeatBlock, SeparableRepeatBlock)):
+        layers = build_stream(module.layers)
+        return StreamSkip(layers) if module.skip else layers
+    if isinstance(module, nn.Sequential):
+        return StreamSequential([build_stream(m) for m in module])
+    if isinstance(module, SCSE):
+        return StreamSCSE(module)
+    if isinstance(module, POINTWISE):
+        return StreamPointwise(module)
+    raise NotImplementedError('{} cannot be streamed'.format(module.__class__.__name__))
+
+
+class StreamingExecutor(object):
+    def __init__(self, model):
+        """
+        :param model: a DeepSpeech model with a ResidualRepeatWav2Letter encoder
+                      and a pointwise decoder, i.e. cnn_residual_repeat_sep_down8 and alike
+        """
+        model = model.module if hasattr(model, 'module') else model
+        rnns = model.rnns
+        if (not isinstance(rnns, ResidualRepeatWav2Letter)
+                or rnns.denoise or rnns.decoder_type != 'pointwise'):
+            raise NotImplementedError('Only pointwise CNN decoders can be streamed, not {}'.format(model._rnn_type))
+        if model.training:
+            raise ValueError('Call model.eval() first, batch norm and dropout have to be pointwise')
+        self.stream = StreamSequential([build_stream(rnns.layers),
+                                        build_stream(model.fc)])
+        # latency on top of the chunk size, in spectrogram frames
+        self.right_context = self.stream.right_context
+
+    def reset(self):
+        self.stream.reset()
+
+    @staticmethod
+    def probs(x):
+        # N x C x T' => N x T' x C, like DeepSpeech.forward in eval mode
+        return None if x is None else F.softmax(x.transpose(1, 2), dim=-1)
+
+    def push(self, spect):
+        """
+        :param spect: the next N x D x T (or N x 1 x D x T) normalized spectrogram frames
+        :return: N x T' x C posteriors of the newly finalized output frames or None
+        """
+        if spect.dim() == 4:
+            spect = spect.squeeze(1)
+        with inference_mode():
+            return self.probs(self.stream.push(spect))
+
+    def flush(self):
+        """The last posteriors, the stream is reset afterwards"""
+        with inference_mode():
+            probs = self.probs(self.stream.flush())
+        self.reset()
+        return probs
@@ -8,7 +8,7 @@ import pickle
 import numpy as np
 from tqdm import tqdm
 
-from model import DeepSpeech
+from model import DeepSpeech, inference_mode, prepare_inference
 from decoder import GreedyDecoder
 from data.utils import get_cer_wer
 from opts import add_decoder_args, add_inference_args
@@ -119,7 +119,7 @@ if __name__ == '__main__':
     model = DeepSpeech.load_model_package(package)
 
     device = torch.device("cuda" if args.cuda else "cpu")
-    model = model.to(device)
+    model = prepare_inference(model, device, args.cpu_threads)
 
     labels = DeepSpeech.get_labels(model)
     audio_conf = DeepSpeech.get_audio_conf(model)
@@ -222,7 +222,8 @@ if __name__ == '__main__':
         inputs = inputs.to(device)
 
         # print(inputs.shape, inputs.is_cuda, input_sizes.shape, input_sizes.is_cuda)
-        model_outputs = model(inputs, input_sizes)
+        with inference_mode():
+            model_outputs = model(inputs, input_sizes)
 
         if args.predict_2_heads:
             ctc_logits, s2s_logits, output_sizes = model_outputs
@@ -341,7 +342,8 @@ if __name__ == '__main__':
             del out, out0, output_sizes, out_raw_cpu, out_softmax_cpu
         if (i + 1) % 5 == 0 or args.batch_size == 1:
             gc.collect()
-            torch.cuda.empty_cache()
+            if args.cuda:
+                torch.cuda.empty_cache()
 
     if decoder is not None:
         wer_avg = float(total_wer) / num_tokens
@@ -3,6 +3,7 @@ import gc
 import json
 import time
 import tqdm
+import random
 import argparse
 import datetime
 
@@ -16,15 +17,20 @@ from linknet import (SemsegLoss,
                      MaskSimilarity)
 from decoder import GreedyDecoder
 from model import DeepSpeech, supported_rnns
-from data.utils import reduce_tensor, get_cer_wer
-from data.data_loader_aug import (SpectrogramDataset,
+from data.utils import reduce_tensor, get_cer_wer, StepSkew
+from data.data_loader_aug import (dataset_for_manifest,
                                   BucketingSampler,
                                   BucketingLenSampler,
-                                  DistributedBucketingSampler)
+                                  FrameBudgetSampler,
+                                  BalancedDistributedSampler,
+                                  ShardRangeSampler,
+                                  ShardedIterableDataset)
+from data.shards import is_shard_dir
 
 
 import torch
 import warnings
+import numpy as np
 from torch._six import inf
 
 tq = tqdm.tqdm
@@ -33,16 +39,26 @@ VISIBLE_DEVICES = os.environ.get('CUDA_VISIBLE_DEVICES', '').split(',') or ['0']
 
 parser = argparse.ArgumentParser(description='DeepSpeech training')
 parser.add_argument('--train-manifest', metavar='DIR',
-                    help='path to train manifest csv', default='data/train_manifest.csv')
+                    help='path to train manifest csv or a shard folder', default='data/train_manifest.csv')
 parser.add_argument('--cache-dir', metavar='DIR',
                     help='path to save temp audio', default='data/cache/')
+parser.add_argument('--feature-cache', default=None, choices=['float32', 'float16', 'uint8'],
+                    help='Store un-augmented features in a memory-mapped feature store in cache-dir')
+parser.add_argument('--batch-features', action='store_true',
+                    help='Compute features per batch in the collate function, workers only return waves')
+parser.add_argument('--token-cache', action='store_true',
+                    help='Tokenize transcripts once into a memory-mapped token store in cache-dir')
+parser.add_argument('--collate-report-every', default=0, type=int,
+                    help='Print collate time / memory stats every N train batches, 0 - never')
 parser.add_argument('--train-val-manifest', metavar='DIR',
                     help='path to train validation manifest csv', default='')
 parser.add_argument('--val-manifest', metavar='DIR',
                     help='path to validation manifest csv', default='data/val_manifest.csv')
 parser.add_argument('--curriculum', metavar='DIR',
-                    help='path to curriculum file', default='')
+                    help='path to curriculum file, csv or binary .cur', default='')
 parser.add_argument('--use-curriculum',  action='store_true', default=False)
+parser.add_argument('--keep-train-transcripts', action='store_true', default=False,
+                    help='Keep train reference / predicted transcripts in memory to save them in the curriculum csv')
 parser.add_argument('--curriculum-ratio', default=0.5, type=float)
 parser.add_argument('--cl-point', default=0.1, type=float)
 parser.add_argument('--sample-rate', default=16000, type=int, help='Sample rate')
@@ -61,6 +77,17 @@ parser.add_argument('--phonemes-only',  action='store_true', default=False)
 parser.add_argument('--omit-spaces',  action='store_true', default=False)
 parser.add_argument('--subword-regularization',  action='store_true', default=False)
 
+parser.add_argument('--max-frames', default=0, type=int,
+                    help='Batches of up to this many padded spectrogram frames instead of --batch-size ones, 0 - off')
+parser.add_argument('--num-buckets', default=64, type=int,
+                    help='Duration quantile buckets for --max-frames')
+parser.add_argument('--shard-iterable', action='store_true',
+                    help='Read a shard folder train manifest as an iterable dataset, '
+                         'each loader worker reads ranges of consecutive shard rows')
+parser.add_argument('--shard-range-size', default=1024, type=int,
+                    help='Consecutive shard rows per range for --shard-iterable')
+parser.add_argument('--step-skew-every', default=100, type=int,
+                    help='Log per rank step compute time every N steps in distributed training, 0 - off')
 parser.add_argument('--batch-similar-lens', dest='batch_similar_lens', action='store_true',
                     help='Force usage of sampler that batches items with similar duration together')
 
@@ -123,6 +150,14 @@ parser.add_argument('--noise-dir', default=None,
                     help='Directory to inject noise into audio. If default, noise Inject not added')
 parser.add_argument('--noise-prob', default=0.4, type=float, help='Probability of noise being added per sample')
 parser.add_argument('--aug-type', default=0, type=int, help='Type of augs to use')
+parser.add_argument('--sox-free-augs', action='store_true',
+                    help='In-memory WSOLA / polyphase speed and pitch augs instead of librosa / sox ones')
+parser.add_argument('--codec-aug', default='none', choices=['none', 'inprocess', 'pool'],
+                    help='Phone codec aug for aug type 4, in the loader workers or in a shared pool of codec processes')
+parser.add_argument('--batch-echo-prob', default=0, type=float,
+                    help='Probability of echo / reverb from the synthetic IR bank, applied to the whole batch at once, needs --batch-features')
+parser.add_argument('--batch-spect-augs', action='store_true',
+                    help='Apply spectrogram augs to the whole batch in the collate function before normalization, needs --batch-features')
 parser.add_argument('--aug-prob-8khz', default=0, type=float, help='Probability of dropping half of stft frequencies, robustness to 8kHz audio')
 parser.add_argument('--aug-prob-spect', default=0, type=float, help='Probability of applying spectrogram based augmentations')
 parser.add_argument('--noise-min', default=0.0,
@@ -153,8 +188,40 @@ parser.add_argument('--use-lookahead', dest='use_lookahead', action='store_true'
                     help='Use look ahead optimizer')
 
 
-torch.manual_seed(123456)
-torch.cuda.manual_seed_all(123456)
+SEED = 123456
+torch.manual_seed(SEED)
+torch.cuda.manual_seed_all(SEED)
+
+
+def get_rng_state():
+    state = {'python': random.getstate(),
+             'numpy': np.random.get_state(),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def pack_sampler_state(epoch, ids, bins):
+    """Curriculum sample + batches of the epoch, as flat arrays"""
+    return {'epoch': epoch,
+            'ids': np.asarray(ids, dtype=np.int64),
+            'bins': np.array([i for ids_ in bins for i in ids_], dtype=np.int64),
+            'bin_sizes': np.array([len(ids_) for ids_ in bins], dtype=np.int64)}
+
+
+def unpack_bins(state):
+    if len(state['bin_sizes']) == 0:
+        return []
+    return [ids.tolist() for ids in np.split(state['bins'], np.cumsum(state['bin_sizes'])[:-1])]
 
 
 def to_np(x):
@@ -637,7 +704,7 @@ def check_model_quality(epoch, checkpoint, train_loss, train_cer, train_wer):
                     print("CER: {:6.2f}% WER: {:6.2f}% Filename: {}".format(cer/cer_ref*100, wer/wer_ref*100, filenames[x]))
                     print('Reference:', reference, '\nTranscript:', transcript)
 
-                times_used = test_dataset.curriculum[filenames[x]]['times_used']+1
+                times_used = test_dataset.get_times_used(filenames[x])+1
                 test_dataset.update_curriculum(filenames[x],
                                                reference, transcript,
                                                None,
@@ -826,7 +893,7 @@ def calculate_trainval_quality_metrics(checkpoint,
                     print("CER: {:6.2f}% WER: {:6.2f}% Filename: {}".format(cer/cer_ref*100, wer/wer_ref*100, filenames[x]))
                     print('Reference:', reference, '\nTranscript:', transcript)
 
-                times_used = trainval_dataset.curriculum[filenames[x]]['times_used']+1
+                times_used = trainval_dataset.get_times_used(filenames[x])+1
                 trainval_dataset.update_curriculum(filenames[x],
                                                    reference, transcript,
                                                    None,
@@ -872,17 +939,17 @@ def save_validation_curriculums(save_folder,
                                 epoch,
                                 iteration=0):
     if iteration>0:
-        test_path = '%s/test_checkpoint_%04d_epoch_%02d_iter_%05d.csv' % (save_folder, checkpoint + 1, epoch + 1, iteration + 1)
+        test_path = '%s/test_checkpoint_%04d_epoch_%02d_iter_%05d.cur' % (save_folder, checkpoint + 1, epoch + 1, iteration + 1)
     else:
-        test_path = '%s/test_checkpoint_%04d_epoch_%02d.csv' % (save_folder, checkpoint + 1, epoch + 1)
+        test_path = '%s/test_checkpoint_%04d_epoch_%02d.cur' % (save_folder, checkpoint + 1, epoch + 1)
     print("Saving test curriculum to {}".format(test_path))
     test_dataset.save_curriculum(test_path)
 
     if args.train_val_manifest != '':
         if iteration>0:
-            trainval_path = '%s/trainval_checkpoint_%04d_epoch_%02d_iter_%05d.csv' % (save_folder, checkpoint + 1, epoch + 1, iteration + 1)
+            trainval_path = '%s/trainval_checkpoint_%04d_epoch_%02d_iter_%05d.cur' % (save_folder, checkpoint + 1, epoch + 1, iteration + 1)
         else:
-            trainval_path = '%s/trainval_checkpoint_%04d_epoch_%02d.csv' % (save_folder, checkpoint + 1, epoch + 1)
+            trainval_path = '%s/trainval_checkpoint_%04d_epoch_%02d.cur' % (save_folder, checkpoint + 1, epoch + 1)
         print("Saving trainval curriculum to {}".format(trainval_path))
         trainval_dataset.save_curriculum(trainval_path)
 
@@ -939,6 +1006,7 @@ class Trainer:
 
         inputs = inputs.to(device)
         input_sizes = input_sizes.to(device)
+        forward_start = time.time()
 
         split_targets = []
         offset = 0
@@ -1003,13 +1071,20 @@ class Trainer:
         else:
             logits, probs, output_sizes = model(inputs, input_sizes)
 
+        if step_skew is not None:
+            # before any all-reduce, i.e. the time of this rank only
+            if args.cuda:
+                torch.cuda.synchronize()
+            step_skew.update(time.time() - forward_start)
+
+        # the model follows the device of its inputs
         if args.double_supervision:
-            assert ctc_logits.is_cuda
-            assert s2s_logits.is_cuda
+            assert ctc_logits.device == inputs.device
+            assert s2s_logits.device == inputs.device
         else:
-            assert logits.is_cuda
-        assert probs.is_cuda
-        assert output_sizes.is_cuda
+            assert logits.device == inputs.device
+        assert probs.device == inputs.device
+        assert output_sizes.device == inputs.device
 
         decoded_output, _ = decoder.decode(probs, output_sizes,
                                             use_attention=args.use_attention or args.double_supervision)
@@ -1022,8 +1097,7 @@ class Trainer:
         for x in range(len(target_strings)):
             transcript, reference = decoded_output[x][0], target_strings[x][0]
             wer, cer, wer_ref, cer_ref = get_cer_wer(decoder, transcript, reference)
-            # accessing dict should be fast
-            times_used = train_dataset.curriculum[filenames[x]]['times_used']+1
+            times_used = train_dataset.get_times_used(filenames[x])+1
             train_dataset.update_curriculum(filenames[x],
                                             reference, transcript,
                                             None,
@@ -1246,33 +1320,69 @@ class Trainer:
         return loss_value
 
 
-def init_train_set(epoch, from_iter):
-    #train_dataset.set_curriculum_epoch(epoch, sample=True)
-    train_dataset.set_curriculum_epoch(epoch,
-                                       sample=args.use_curriculum,
-                                       sample_size=args.curriculum_ratio,
-                                       cl_point=args.cl_point)
-    global train_loader, train_sampler
-    if not args.distributed:
-        if args.batch_similar_lens:
-            print('Using BucketingLenSampler')
-            train_sampler = BucketingLenSampler(train_dataset, batch_size=args.batch_size)
-        else:
-            train_sampler = BucketingSampler(train_dataset, batch_size=args.batch_size)
-        train_sampler.bins = train_sampler.bins[from_iter:]
+def init_train_set(epoch, from_iter, sampler_state=None):
+    if sampler_state is not None and sampler_state['epoch'] != epoch:
+        sampler_state = None
+    if sampler_state is not None:
+        # the curriculum was updated since, re-sampling would give other ids
+        print('Restoring the data order of epoch {}'.format(epoch + 1))
+        train_dataset.ids = sampler_state['ids']
+        train_dataset.size = len(train_dataset.ids)
     else:
-        train_sampler = DistributedBucketingSampler(train_dataset,
-                                                    batch_size=args.batch_size,
-                                                    num_replicas=args.world_size,
-                                                    rank=args.rank)
-    train_loader = AudioDataLoader(train_dataset,
-                                   num_workers=args.num_workers,
-                                   batch_sampler=train_sampler,
-                                   pin_memory=True)
+        #train_dataset.set_curriculum_epoch(epoch, sample=True)
+        train_dataset.set_curriculum_epoch(epoch,
+                                           sample=args.use_curriculum,
+                                           sample_size=args.curriculum_ratio,
+                                           cl_point=args.cl_point)
+    train_dataset.set_aug_seed(SEED + epoch)
+    global train_loader, train_sampler, epoch_sampler_state
+    if args.shard_iterable:
+        print('Using ShardRangeSampler')
+        train_sampler = ShardRangeSampler(train_dataset,
+                                          batch_size=args.batch_size,
+                                          range_size=args.shard_range_size,
+                                          num_streams=args.num_workers)
+    elif args.max_frames > 0:
+        print('Using FrameBudgetSampler')
+        train_sampler = FrameBudgetSampler(train_dataset,
+                                           max_frames=args.max_frames,
+                                           num_buckets=args.num_buckets)
+    elif args.batch_similar_lens:
+        print('Using BucketingLenSampler')
+        train_sampler = BucketingLenSampler(train_dataset, batch_size=args.batch_size)
+    else:
+        train_sampler = BucketingSampler(train_dataset, batch_size=args.batch_size)
+    if args.distributed:
+        # the same batches on all the ranks, dealt by padded frames
+        train_sampler = BalancedDistributedSampler(train_sampler,
+                                                   num_replicas=args.world_size,
+                                                   rank=args.rank)
 
     if (not args.no_shuffle and epoch != 0) or args.no_sorta_grad:
         print("Shuffling batches for the following epochs")
         train_sampler.shuffle(epoch)
+    if sampler_state is not None and not args.distributed:
+        # BucketingSampler shuffles are not seeded,
+        # distributed samplers are rebuilt deterministically from the ids
+        train_sampler.bins = unpack_bins(sampler_state)
+    epoch_sampler_state = pack_sampler_state(epoch, train_dataset.selected_rows(), train_sampler.bins)
+    # skip the batches done before resuming, after shuffling,
+    # FrameBudgetSampler re-packs its batches when shuffled
+    # the skipped batches are never loaded
+    train_sampler.bins = train_sampler.bins[from_iter:]
+    if args.shard_iterable:
+        # the workers yield whole batches, in the order of train_sampler.bins
+        train_loader = AudioDataLoader(ShardedIterableDataset(train_dataset, train_sampler),
+                                       num_workers=args.num_workers,
+                                       batch_size=None,
+                                       pin_memory=True,
+                                       collate_report_every=args.collate_report_every)
+    else:
+        train_loader = AudioDataLoader(train_dataset,
+                                       num_workers=args.num_workers,
+                                       batch_sampler=train_sampler,
+                                       pin_memory=True,
+                                       collate_report_every=args.collate_report_every)
 
 
 def train(from_epoch, from_iter, from_checkpoint):
@@ -1283,7 +1393,13 @@ def train(from_epoch, from_iter, from_checkpoint):
     checkpoint = from_checkpoint
     best_score = None
     for epoch in range(from_epoch, args.epochs):
-        init_train_set(epoch, from_iter=from_iter)
+        if epoch == from_epoch:
+            init_train_set(epoch, from_iter=from_iter, sampler_state=resume_sampler_state)
+            if resume_rng_state is not None:
+                # continue as if there was no restart
+                set_rng_state(resume_rng_state)
+        else:
+            init_train_set(epoch, from_iter=from_iter)
         trainer.reset_scores()
         total_loss = 0
         num_losses = 1
@@ -1322,8 +1438,10 @@ def train(from_epoch, from_iter, from_checkpoint):
                                                     trainval_checkpoint_loss_results=trainval_checkpoint_plots.loss_results,
                                                     trainval_checkpoint_wer_results=trainval_checkpoint_plots.wer_results,
                                                     trainval_checkpoint_cer_results=trainval_checkpoint_plots.cer_results,
-                                                    avg_loss=total_loss / num_losses), file_path)
-                    train_dataset.save_curriculum(file_path + '.csv')
+                                                    avg_loss=total_loss / num_losses,
+                                                    sampler_state=epoch_sampler_state,
+                                                    rng_state=get_rng_state()), file_path)
+                    train_dataset.save_curriculum(file_path + '.cur')
                     del _optimizer
 
                     check_model_quality(epoch, checkpoint, total_loss / num_losses, trainer.get_cer(), trainer.get_wer())
@@ -1374,8 +1492,8 @@ def train(from_epoch, from_iter, from_checkpoint):
                                             trainval_checkpoint_loss_results=trainval_checkpoint_plots.loss_results,
                                             trainval_checkpoint_wer_results=trainval_checkpoint_plots.wer_results,
                                             trainval_checkpoint_cer_results=trainval_checkpoint_plots.cer_results,
-                                            ), file_path)
-            train_dataset.save_curriculum(file_path + '.csv')
+                                            rng_state=get_rng_state()), file_path)
+            train_dataset.save_curriculum(file_path + '.cur')
             save_validation_curriculums(save_folder, checkpoint + 1, epoch + 1, 0)
             del _optimizer
 
@@ -1404,7 +1522,7 @@ def train(from_epoch, from_iter, from_checkpoint):
                                             trainval_checkpoint_cer_results=trainval_checkpoint_plots.cer_results,
                                             ),
                        args.model_path)
-            train_dataset.save_curriculum(args.model_path + '.csv')
+            train_dataset.save_curriculum(args.model_path + '.cur')
             del _optimizer
             best_score = new_score
 
@@ -1429,6 +1547,9 @@ if __name__ == '__main__':
         AudioDataLoaderVal = AudioDataLoader
 
     args.distributed = args.world_size > 1
+    if args.shard_iterable and (args.distributed or not is_shard_dir(args.train_manifest)):
+        print('--shard-iterable needs a shard folder as --train-manifest and no distributed training')
+        raise ValueError('--shard-iterable')
     args.model_path = os.path.join(args.save_folder, 'best.model')
 
     is_leader = True
@@ -1456,6 +1577,7 @@ if __name__ == '__main__':
     lr_plots = LRPlotWindow(args.id, 'lr_finder', log_x=True)
 
     total_avg_loss, start_epoch, start_iter, start_checkpoint = 0, 0, 0, 0
+    resume_sampler_state, resume_rng_state = None, None
     if args.use_phonemes:
         with open(args.phonemes_path) as phoneme_file:
             phoneme_map = {l: i for i, l
@@ -1556,6 +1678,12 @@ if __name__ == '__main__':
             else:
                 start_iter += 1
                 total_avg_loss = int(package.get('avg_loss', 0))
+                resume_sampler_state = package.get('sampler_state')
+            resume_rng_state = package.get('rng_state')
+            if not args.curriculum and os.path.exists(args.continue_from + '.cur'):
+                # curriculum saved along with the checkpoint
+                args.curriculum = args.continue_from + '.cur'
+                print('Using curriculum {}'.format(args.curriculum))
             plots.loss_results = package['loss_results']
             plots.cer_results = package['cer_results']
             plots.wer_results = package['wer_results']
@@ -1670,22 +1798,39 @@ if __name__ == '__main__':
     print('Label length {}'.format(len(labels)))
     print(labels)
 
+    # data pipeline only, can be changed when resuming
+    audio_conf['sox_free_augs'] = args.sox_free_augs
+    audio_conf['codec_aug'] = args.codec_aug
+    audio_conf['batch_echo_prob'] = args.batch_echo_prob
+    audio_conf['batch_spect_augs'] = args.batch_spect_augs
+    if args.codec_aug == 'pool':
+        from data.codec_sim import start_pool
+        # before the loader workers fork, one slot per worker + main process
+        start_pool(num_clients=args.num_workers + 1)
     print('Audio conf')
     print(audio_conf)
-    train_dataset = SpectrogramDataset(audio_conf=audio_conf, cache_path=args.cache_dir,
-                                       manifest_filepath=args.train_manifest,
-                                       labels=labels, normalize=args.norm, augment=args.augment,
-                                       curriculum_filepath=args.curriculum,
-                                       use_attention=args.use_attention,
-                                       double_supervision=args.double_supervision,
-                                       naive_split=args.naive_split,
-                                       phonemes_only=args.phonemes_only,
-                                       omit_spaces=args.omit_spaces,
-                                       subword_regularization=args.subword_regularization)
+    # shard folders packed by data/shards.py are read sequentially
+    train_dataset = dataset_for_manifest(args.train_manifest)(
+        audio_conf=audio_conf, cache_path=args.cache_dir,
+        manifest_filepath=args.train_manifest,
+        labels=labels, normalize=args.norm, augment=args.augment,
+        curriculum_filepath=args.curriculum,
+        use_attention=args.use_attention,
+        double_supervision=args.double_supervision,
+        naive_split=args.naive_split,
+        phonemes_only=args.phonemes_only,
+        omit_spaces=args.omit_spaces,
+        subword_regularization=args.subword_regularization,
+        feature_cache=args.feature_cache,
+        batch_features=args.batch_features,
+        token_cache=args.token_cache,
+        token_cache_workers=args.num_workers,
+        keep_transcripts=args.keep_train_transcripts)
     test_audio_conf = {**audio_conf,
                        'noise_prob': 0,
                        'aug_prob_8khz':0,
                        'aug_prob_spect':0,
+                       'batch_echo_prob':0,
                        'phoneme_count':0,
                        'phoneme_map':None}
 
@@ -1694,16 +1839,21 @@ if __name__ == '__main__':
     # no augs on test
     # on test, even in case of double supervision
     # we just need s2s data to validate
-    test_dataset = SpectrogramDataset(audio_conf=test_audio_conf,
-                                      cache_path=args.cache_dir,
-                                      manifest_filepath=args.val_manifest,
-                                      labels=labels, normalize=args.norm, augment=False,
-                                      use_attention=args.use_attention or args.double_supervision,
-                                      double_supervision=False,
-                                      naive_split=args.naive_split,
-                                      phonemes_only=args.phonemes_only,
-                                      omit_spaces=args.omit_spaces,
-                                      subword_regularization=False) # turn off augs on val
+    test_dataset = dataset_for_manifest(args.val_manifest)(
+        audio_conf=test_audio_conf,
+        cache_path=args.cache_dir,
+        manifest_filepath=args.val_manifest,
+        labels=labels, normalize=args.norm, augment=False,
+        use_attention=args.use_attention or args.double_supervision,
+        double_supervision=False,
+        naive_split=args.naive_split,
+        phonemes_only=args.phonemes_only,
+        omit_spaces=args.omit_spaces,
+        subword_regularization=False,  # turn off augs on val
+        feature_cache=args.feature_cache,
+        batch_features=args.batch_features,
+        token_cache=args.token_cache,
+        token_cache_workers=args.num_workers)
 
     # if file is specified
     # separate train validation wo domain shift
@@ -1711,20 +1861,25 @@ if __name__ == '__main__':
     # on test, even in case of double supervision
     # we just need s2s data to validate
     if args.train_val_manifest != '':
-        trainval_dataset = SpectrogramDataset(audio_conf=test_audio_conf,
-                                              cache_path=args.cache_dir,
-                                              manifest_filepath=args.train_val_manifest,
-                                              labels=labels, normalize=args.norm, augment=False,
-                                              use_attention=args.use_attention or args.double_supervision,
-                                              double_supervision=False,
-                                              naive_split=args.naive_split,
-                                              phonemes_only=args.phonemes_only,
-                                              omit_spaces=args.omit_spaces,
-                                              subword_regularization=False) # turn off augs on val
+        trainval_dataset = dataset_for_manifest(args.train_val_manifest)(
+            audio_conf=test_audio_conf,
+            cache_path=args.cache_dir,
+            manifest_filepath=args.train_val_manifest,
+            labels=labels, normalize=args.norm, augment=False,
+            use_attention=args.use_attention or args.double_supervision,
+            double_supervision=False,
+            naive_split=args.naive_split,
+            phonemes_only=args.phonemes_only,
+            omit_spaces=args.omit_spaces,
+            subword_regularization=False,  # turn off augs on val
+            feature_cache=args.feature_cache,
+            batch_features=args.batch_features,
+            token_cache=args.token_cache,
+            token_cache_workers=args.num_workers)
 
     if args.reverse_sort:
         # XXX: A hack to test max memory load.
-        train_dataset.ids.reverse()
+        train_dataset.ids = train_dataset.ids[::-1]
 
     test_loader = AudioDataLoaderVal(test_dataset,
                                      batch_size=args.val_batch_size,
@@ -1751,6 +1906,11 @@ if __name__ == '__main__':
     batch_time = AverageMeter()
     data_time = AverageMeter()
     losses = AverageMeter()
+    step_skew = None
+    if args.distributed and args.step_skew_every > 0:
+        step_skew = StepSkew(args.world_size, device,
+                             every=args.step_skew_every,
+                             verbose=is_leader)
 
     if args.denoise:
         mask_accuracy = AverageMeter()
@@ -10,7 +10,7 @@ from decoder import GreedyDecoder
 import torch
 
 from data.data_loader import SpectrogramParser
-from model import DeepSpeech
+from model import DeepSpeech, inference_mode, prepare_inference
 import os.path
 import json
 
@@ -26,6 +26,8 @@ parser.add_argument('--channel', dest='channel', default='-1', type=int,
                     help='Use specified channel for stereo (0=left, 1=right, -1=average all)')
 parser.add_argument('--meta', dest='meta', action='store_true',
                     help='Returns meta information')
+parser.add_argument('--stream-chunk', default=0, type=int,
+                    help='Feed the spectrogram in chunks of this many frames, CNN models only, 0 - whole file')
 parser = add_decoder_args(parser)
 args = parser.parse_args()
 
@@ -60,13 +62,26 @@ def decode_results(model, decoded_output, decoded_offsets):
     return results
 
 
-def transcribe(audio_path, parser, model, decoder, device):
+def transcribe_stream(spect, model, chunk):
+    from streaming import StreamingExecutor
+    executor = StreamingExecutor(model)
+    out = [executor.push(frames) for frames in spect.split(chunk, dim=3)]
+    out.append(executor.flush())
+    out = torch.cat([probs for probs in out if probs is not None], dim=1)
+    return out, torch.IntTensor([out.size(1)])
+
+
+def transcribe(audio_path, parser, model, decoder, device, stream_chunk=0):
     spect = parser.parse_audio_for_transcription(audio_path).contiguous()
     spect = spect.view(1, 1, spect.size(0), spect.size(1))
     spect = spect.to(device)
+    if stream_chunk > 0:
+        out, output_sizes = transcribe_stream(spect, model, stream_chunk)
+        return decoder.decode(out, output_sizes)
     input_sizes = torch.IntTensor([spect.size(3)]).int()
     # print(spect.shape, input_sizes.shape)
-    out0, out, output_sizes = model(spect, input_sizes)
+    with inference_mode():
+        out0, out, output_sizes = model(spect, input_sizes)
     decoded_output, decoded_offsets = decoder.decode(out, output_sizes)
     return decoded_output, decoded_offsets
 
@@ -75,8 +90,7 @@ if __name__ == '__main__':
     torch.set_grad_enabled(False)
     model = DeepSpeech.load_model(args.model_path)
     device = torch.device("cuda" if args.cuda else "cpu")
-    model = model.to(device)
-    model.eval()
+    model = prepare_inference(model, device, args.cpu_threads)
 
     labels = DeepSpeech.get_labels(model)
     audio_conf = DeepSpeech.get_audio_conf(model)
@@ -93,7 +107,8 @@ if __name__ == '__main__':
     parser = SpectrogramParser(audio_conf, cache_path=args.cache_dir, 
                                normalize='max_frame', channel=args.channel, augment=True)
 
-    decoded_output, decoded_offsets = transcribe(args.audio_path, parser, model, decoder, device)
+    decoded_output, decoded_offsets = transcribe(args.audio_path, parser, model, decoder, device,
+                                                 stream_chunk=args.stream_chunk)
     output = decode_results(model, decoded_output, decoded_offsets)
     output['input'] = {
         'channel': args.channel,